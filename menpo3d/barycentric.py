@@ -1,6 +1,7 @@
 import numpy as np
 from menpo.shape import PointCloud, TriMesh
-from .vtkutils import trimesh_to_vtk, VTKClosestPointLocator
+from .bvh import _dot
+from .vtkutils import closest_point_locator
 
 
 def barycentric_coordinates(point, a, b, c):
@@ -13,42 +14,139 @@ def barycentric_coordinates_for_indices(mesh, tri_index, point):
     return barycentric_coordinates(point, a, b, c)
 
 
-def barycentric_points_from_contained_points(self, pointcloud, tri_index):
-    # http://gamedev.stackexchange.com/questions/23743/whats-the-most-efficient-way-to-find-barycentric-coordinates
-    abc_per_tri = self.points[self.trilist[tri_index]]
-
-    a = abc_per_tri[:, 0, :]
-    b = abc_per_tri[:, 1, :]
-    c = abc_per_tri[:, 2, :]
-    p = pointcloud.points
-
-    v0 = b - a
-    v1 = c - a
-    v2 = p - a
-    d00 = (v0 * v0).sum(axis=1)
-    d01 = (v0 * v1).sum(axis=1)
-    d11 = (v1 * v1).sum(axis=1)
-    d20 = (v2 * v0).sum(axis=1)
-    d21 = (v2 * v1).sum(axis=1)
+def _solve_barycentric(ap, edges):
+    # Closed form least squares solution of ap = v * ab + w * ac for every
+    # row, where edges holds ab and ac as edges[:, 0] and edges[:, 1]. Only
+    # (n,) sized temporaries are created along the way.
+    ab, ac = edges[:, 0], edges[:, 1]
+    d00, d01, d11 = _dot(ab, ab), _dot(ab, ac), _dot(ac, ac)
+    d20, d21 = _dot(ap, ab), _dot(ap, ac)
     denom = d00 * d11 - d01 * d01
-    v = (d11 * d20 - d01 * d21) / denom
-    w = (d00 * d21 - d01 * d20) / denom
-    u = 1 - v - w
 
-    return np.vstack([u, v, w]).T
+    out = np.empty((ap.shape[0], 3))
+    # A triangle is degenerate if its area is negligible compared to the
+    # lengths of its sides (Lagrange's identity: denom = |ab x ac| ** 2).
+    degenerate = denom <= 1e-12 * d00 * d11
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out[:, 1] = (d11 * d20 - d01 * d21) / denom
+        out[:, 2] = (d00 * d21 - d01 * d20) / denom
+    if degenerate.any():
+        _solve_degenerate(ap[degenerate], edges[degenerate],
+                          out[:, 1:], degenerate)
+    out[:, 0] = 1 - out[:, 1] - out[:, 2]
+    return out
+
+
+def _solve_degenerate(ap, edges, vw, mask):
+    # A degenerate triangle has (at most) one meaningful direction: its
+    # longest edge. Points are projected onto that edge (clamped to its end
+    # points), and triangles that collapse to a single point put all of the
+    # weight on the first vertex.
+    ab, ac = edges[:, 0], edges[:, 1]
+    bc = ac - ab
+    lengths = np.stack([(ab * ab).sum(axis=1), (ac * ac).sum(axis=1),
+                        (bc * bc).sum(axis=1)], axis=1)
+    longest = lengths.argmax(axis=1)
+    # express the longest edge as start + t * direction, relative to a
+    start = np.where((longest == 2)[:, None], ab, 0)
+    direction = np.choose(longest[:, None], [ab, ac, bc])
+    length = lengths[np.arange(longest.shape[0]), longest]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((ap - start) * direction).sum(axis=1) / length
+    t = np.where(length > 0, np.clip(t, 0, 1), 0)
+    v = np.where(longest == 0, t, np.where(longest == 2, 1 - t, 0))
+    w = np.where(longest == 1, t, np.where(longest == 2, t, 0))
+    vw[mask] = np.stack([v, w], axis=1)
+
+
+def barycentric_coordinates_batch(points, a, b, c):
+    r"""Return the barycentric coordinates of many points, each with respect to
+    its own triangle, in closed form.
+
+    Points that don't lie in the plane of their triangle are first projected
+    onto it (the same least squares solution as
+    :func:`barycentric_coordinates`). Degenerate triangles are handled by
+    projecting onto their longest edge.
+
+    Parameters
+    ----------
+    points : ``(n_points, 3)`` `ndarray`
+        The points.
+    a : ``(n_points, 3)`` `ndarray`
+        The first vertex of the triangle of each point.
+    b : ``(n_points, 3)`` `ndarray`
+        The second vertex of the triangle of each point.
+    c : ``(n_points, 3)`` `ndarray`
+        The third vertex of the triangle of each point.
+
+    Returns
+    -------
+    bcoords : ``(n_points, 3)`` `ndarray`
+        The barycentric coordinates of each point, weighting ``a``, ``b`` and
+        ``c`` respectively.
+    """
+    edges = np.empty((a.shape[0], 2, a.shape[1]))
+    np.subtract(b, a, out=edges[:, 0])
+    np.subtract(c, a, out=edges[:, 1])
+    return _solve_barycentric(points - a, edges)
+
+
+def barycentric_coordinates_for_indices_batch(mesh, tri_indices, points):
+    r"""Return the barycentric coordinates of many points, each with respect to
+    a triangle of ``mesh``, see :func:`barycentric_coordinates_batch`.
+
+    Parameters
+    ----------
+    mesh : :map:`TriMesh`
+        The mesh the triangles belong to.
+    tri_indices : ``(n_points,)`` `ndarray`
+        The index of the triangle of each point.
+    points : ``(n_points, 3)`` `ndarray`
+        The points.
+
+    Returns
+    -------
+    bcoords : ``(n_points, 3)`` `ndarray`
+        The barycentric coordinates of each point.
+    """
+    # a single gather of every triangle, that is then turned into its edges
+    # in place
+    tris = mesh.points[mesh.trilist[tri_indices]]
+    ap = points - tris[:, 0]
+    edges = tris[:, 1:]
+    edges -= tris[:, :1]
+    return _solve_barycentric(ap, edges)
+
+
+def barycentric_points_from_contained_points(self, pointcloud, tri_index):
+    # http://gamedev.stackexchange.com/questions/23743/whats-the-most-efficient-way-to-find-barycentric-coordinates
+    return barycentric_coordinates_for_indices_batch(self, tri_index,
+                                                     pointcloud.points)
 
 
-def snap_pointcloud_to_surface(self, pointcloud):
+def snap_pointcloud_to_surface(self, pointcloud, n_workers=1, cache=False):
     r"""Constrain points in a :map:`PointCloud: to lie as close as possible to
     this :map:`TriMesh`.
 
     Each point in the provided `pointcloud` will be projected to the surface
-    of this mesh in the minimum possible distance.
+    of this mesh in the minimum possible distance. With a single thread and
+    no cache, the closest points are found by a :map:`VTKClosestPointLocator`
+    (the cheapest for one-off snapping), otherwise by a
+    :map:`BVHClosestPointLocator`.
 
     Parameters
     ----------
     pointcloud : :map:`PointCloud`
         The pointcloud that will be projected onto this mesh.
+    n_workers : `int` or ``None``, optional
+        The number of threads used to find the closest points. If ``None``,
+        one thread per CPU is used.
+    cache : :map:`BVHCache` or `bool`, optional
+        The cache that the spatial index of this mesh is looked up in (and
+        added to), so that repeatedly snapping to the same mesh only builds
+        the index once. ``True`` uses the default cache, which keeps the
+        index (and others, up to 512MB) alive for the rest of the process
+        unless it is cleared. ``False`` (the default) disables caching.
 
     Returns
     -------
@@ -56,8 +154,7 @@ def snap_pointcloud_to_surface(self, pointcloud):
         A tuple of the snapped :map`PointCloud` and the indices of the
         triangles involved in the snapping.
     """
-    vtk_mesh = trimesh_to_vtk(self)
-    locator = VTKClosestPointLocator(vtk_mesh)
+    locator = closest_point_locator(self, n_workers=n_workers, cache=cache)
     snapped_points, indices = locator(pointcloud.points)
     return PointCloud(snapped_points, copy=False), indices
 
@@ -114,6 +211,93 @@ def barycentric_coordinate_interpolation(self, per_vertex_interpolant,
     return np.sum(t * bcoords[..., None], axis=1)
 
 
+def barycentric_interpolation_operator(self, bcoords, tri_indices):
+    r"""Compile a set of barycentric coordinates on this mesh into a sparse
+    linear operator that performs
+    :meth:`barycentric_coordinate_interpolation`.
+
+    Building the operator costs about the same as a single interpolation, but
+    it can then be reused across any number of per-vertex fields (and any
+    meshes in dense correspondence with this one) with a single sparse
+    matrix product each, see :func:`apply_barycentric_interpolation_operator`.
+
+    Parameters
+    ----------
+    bcoords : ``(n_samples, 3)`` `ndarray`
+        The barycentric coordinates of each sample.
+    tri_indices : ``(n_samples, )`` `ndarray`
+        The index of the triangle that the above ``bcoords`` correspond to.
+
+    Returns
+    -------
+    operator : ``(n_samples, n_points)`` `scipy.sparse.csr_matrix`
+        A sparse matrix with the three barycentric weights of each sample in
+        its row.
+    """
+    import scipy.sparse as sp
+    n_samples = bcoords.shape[0]
+    # each row has exactly three entries, so the CSR arrays are given
+    # directly rather than via a (sorting) COO conversion
+    indptr = np.arange(0, 3 * n_samples + 1, 3)
+    indices = self.trilist[tri_indices].ravel()
+    return sp.csr_matrix((np.ravel(bcoords), indices, indptr),
+                         shape=(n_samples, self.n_points))
+
+
+def apply_barycentric_interpolation_operator(operator, fields, out=None,
+                                             chunk_size=64):
+    r"""Apply an operator built by
+    :meth:`barycentric_interpolation_operator` to one or many per-vertex
+    fields.
+
+    Parameters
+    ----------
+    operator : ``(n_samples, n_points)`` `scipy.sparse.csr_matrix`
+        The barycentric interpolation operator.
+    fields : ``(n_points, k)`` or ``(n_meshes, n_points, k)`` `ndarray`
+        A single per-vertex field, or a stack of fields (for instance the
+        points of many meshes in dense correspondence). Any array-like that
+        supports slicing along the first axis, such as a memory-mapped
+        `ndarray`, can be used for a stack.
+    out : `ndarray`, optional
+        Where to write the result (for instance a memory-mapped `ndarray`).
+        If ``None``, a new array is returned.
+    chunk_size : `int`, optional
+        For a stack of fields, how many fields are gathered into a single
+        sparse matrix product at a time. This bounds the amount of ``fields``
+        that is held in memory at once.
+
+    Returns
+    -------
+    interpolated : ``(n_samples, k)`` or ``(n_meshes, n_samples, k)`` `ndarray`
+        The interpolated fields.
+    """
+    n_samples, n_points = operator.shape
+    if fields.ndim == 2:
+        if fields.shape[0] != n_points:
+            raise ValueError('fields must be of shape (n_points, k)')
+        if out is None:
+            return operator.dot(fields)
+        out[...] = operator.dot(fields)
+        return out
+    elif fields.ndim != 3 or fields.shape[1] != n_points:
+        raise ValueError('fields must be of shape (n_points, k) or '
+                         '(n_meshes, n_points, k)')
+
+    n_meshes, _, k = fields.shape
+    if out is None:
+        out = np.empty((n_meshes, n_samples, k),
+                       dtype=np.result_type(operator.dtype, fields.dtype))
+    for start in range(0, n_meshes, chunk_size):
+        chunk = np.asarray(fields[start:start + chunk_size])
+        m = chunk.shape[0]
+        # lay the chunk out as a single (n_points, m * k) right hand side
+        rhs = chunk.transpose(1, 0, 2).reshape(n_points, m * k)
+        result = operator.dot(rhs).reshape(n_samples, m, k)
+        out[start:start + m] = result.transpose(1, 0, 2)
+    return out
+
+
 def project_barycentric_coordinates(self, bcoords, tri_indices):
     r"""Projects a set of barycentric coordinates onto this mesh surface,
     returning a :map:`PointCloud`.
@@ -143,3 +327,4 @@ TriMesh.snap_pointcloud_to_surface = snap_pointcloud_to_surface
 TriMesh.barycentric_coordinates_of_pointcloud = barycentric_coordinates_of_pointcloud
 TriMesh.barycentric_coordinate_interpolation = barycentric_coordinate_interpolation
 TriMesh.project_barycentric_coordinates = project_barycentric_coordinates
+TriMesh.barycentric_interpolation_operator = barycentric_interpolation_operator
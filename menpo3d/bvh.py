@@ -0,0 +1,831 @@
+import hashlib
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+
+
+ClosestPointResult = namedtuple('ClosestPointResult',
+                                ['points', 'tri_indices', 'distances',
+                                 'bcoords'])
+
+RayHitResult = namedtuple('RayHitResult',
+                          ['hits', 'tri_indices', 'distances'])
+
+
+def _dot(x, y):
+    # Explicit sum so that the result for a given row never depends on the
+    # length of the array it is part of (no blocked/pairwise reductions).
+    return x[:, 0] * y[:, 0] + x[:, 1] * y[:, 1] + x[:, 2] * y[:, 2]
+
+
+def _closest_point_bcoords(ap, ab, ac, d_ab_ab, d_ab_ac, d_ac_ac):
+    # Vectorized version of the region-based algorithm from Ericson,
+    # Real-Time Collision Detection, section 5.1.5, written in terms of
+    # ap = p - a and the per-triangle dot products (which can be
+    # precomputed) so that only two dot products are needed per query.
+    d1 = _dot(ab, ap)
+    d2 = _dot(ac, ap)
+    d3 = d1 - d_ab_ab
+    d4 = d2 - d_ab_ac
+    d5 = d1 - d_ab_ac
+    d6 = d2 - d_ac_ac
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # default - the projection lies inside the face region
+        denom = va + vb + vc
+        v = vb / denom
+        w = vc / denom
+
+        # edge regions (BC, AC, AB) - applied in reverse priority order so
+        # that the higher priority regions overwrite the lower ones.
+        in_bc = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        w_bc = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        v = np.where(in_bc, 1 - w_bc, v)
+        w = np.where(in_bc, w_bc, w)
+
+        in_ac = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        v = np.where(in_ac, 0, v)
+        w = np.where(in_ac, d2 / (d2 - d6), w)
+
+        in_ab = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = np.where(in_ab, d1 / (d1 - d3), v)
+        w = np.where(in_ab, 0, w)
+
+    # vertex regions (C, B, A)
+    in_c = (d6 >= 0) & (d5 <= d6)
+    v = np.where(in_c, 0, v)
+    w = np.where(in_c, 1, w)
+    in_b = (d3 >= 0) & (d4 <= d3)
+    v = np.where(in_b, 1, v)
+    w = np.where(in_b, 0, w)
+    in_a = (d1 <= 0) & (d2 <= 0)
+    v = np.where(in_a, 0, v)
+    w = np.where(in_a, 0, w)
+
+    # Anything left undefined is a fully degenerate triangle (all three
+    # vertices coincident) - snap to the first vertex.
+    bad = ~(np.isfinite(v) & np.isfinite(w))
+    if np.any(bad):
+        v[bad] = 0
+        w[bad] = 0
+    return v, w
+
+
+def closest_points_on_triangles(p, a, b, c):
+    r"""Return the closest point on each triangle ``(a, b, c)`` to the
+    corresponding point in ``p``, along with its barycentric coordinates.
+
+    Fully vectorized version of the region-based algorithm from Ericson,
+    Real-Time Collision Detection, section 5.1.5. Degenerate (zero area)
+    triangles are handled by the vertex and edge regions.
+
+    Parameters
+    ----------
+    p : ``(n, 3)`` `ndarray`
+        The query points.
+    a, b, c : ``(n, 3)`` `ndarray`
+        The vertices of the triangle paired with each query point.
+
+    Returns
+    -------
+    closest_points, bcoords : ``(n, 3)`` `ndarray`, ``(n, 3)`` `ndarray`
+        The closest points on the triangles and their barycentric
+        coordinates with respect to ``(a, b, c)``.
+    """
+    ab = b - a
+    ac = c - a
+    v, w = _closest_point_bcoords(p - a, ab, ac, _dot(ab, ab), _dot(ab, ac),
+                                  _dot(ac, ac))
+    bcoords = np.empty((p.shape[0], 3), dtype=p.dtype)
+    bcoords[:, 0] = 1 - v - w
+    bcoords[:, 1] = v
+    bcoords[:, 2] = w
+    return a + v[:, None] * ab + w[:, None] * ac, bcoords
+
+
+def _cross(x, y):
+    # np.cross has a lot of overhead for (n, 3) arrays
+    out = np.empty(x.shape)
+    out[:, 0] = x[:, 1] * y[:, 2] - x[:, 2] * y[:, 1]
+    out[:, 1] = x[:, 2] * y[:, 0] - x[:, 0] * y[:, 2]
+    out[:, 2] = x[:, 0] * y[:, 1] - x[:, 1] * y[:, 0]
+    return out
+
+
+def _first_min(group, values, tri_indices, n_tris):
+    # For pairs sorted by group, the index of the pair with the minimum value
+    # in each group, breaking ties on the lowest triangle index so that the
+    # choice never depends on how the pairs were batched.
+    is_start = np.concatenate(([True], group[1:] != group[:-1]))
+    starts = np.flatnonzero(is_start)
+    run = np.cumsum(is_start) - 1
+    is_min = values == np.minimum.reduceat(values, starts)[run]
+    best_tri = np.minimum.reduceat(np.where(is_min, tri_indices, n_tris),
+                                   starts)
+    best = np.flatnonzero(is_min & (tri_indices == best_tri[run]))
+    return best[np.concatenate(([True],
+                                group[best[1:]] != group[best[:-1]]))]
+
+
+def _box_sq_distance(p, lo, hi):
+    # squared distance from each point to the paired axis aligned box
+    d = np.maximum(lo - p, 0) + np.maximum(p - hi, 0)
+    return _dot(d, d)
+
+
+class TriangleBVH(object):
+    r"""A bounding volume hierarchy (an axis aligned bounding box tree) built
+    over the triangles of a mesh, supporting fully vectorized batch queries.
+
+    The tree is a complete binary tree stored implicitly in heap order (the
+    children of node ``i`` are ``2i + 1`` and ``2i + 2``). It is constructed
+    top down by median splits of the triangle centroids along the longest
+    axis of each node, one whole level at a time, so that neither
+    construction nor querying involve any per-triangle or per-point Python
+    work.
+
+    Parameters
+    ----------
+    points : ``(n_points, 3)`` `ndarray`
+        The vertices of the mesh.
+    trilist : ``(n_tris, 3)`` `ndarray`
+        The triangle list of the mesh.
+    leaf_size : `int`, optional
+        The maximum number of triangles stored in each leaf of the tree.
+    """
+    def __init__(self, points, trilist, leaf_size=8):
+        points = np.require(points, dtype=np.float64, requirements=['C'])
+        trilist = np.require(trilist, requirements=['C'])
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('TriangleBVH only supports 3D meshes')
+        n_tris = trilist.shape[0]
+        if n_tris == 0:
+            raise ValueError('Cannot build a TriangleBVH without triangles')
+        self.trilist = trilist
+
+        # Choose the depth so that no leaf has more than leaf_size triangles
+        depth = 0
+        while n_tris > leaf_size * 2 ** depth:
+            depth += 1
+        self.depth = depth
+        n_leaves = 2 ** depth
+
+        centroids = points[trilist].mean(axis=1)
+        perm = np.arange(n_tris)
+        for d in range(depth):
+            n_nodes = 2 ** d
+            bounds = (np.arange(n_nodes + 1) * n_tris) // n_nodes
+            seg_ids = np.repeat(np.arange(n_nodes), np.diff(bounds))
+            c = centroids[perm]
+            lo = np.minimum.reduceat(c, bounds[:-1], axis=0)
+            hi = np.maximum.reduceat(c, bounds[:-1], axis=0)
+            axis = np.argmax(hi - lo, axis=1)
+            extent = (hi - lo)[np.arange(n_nodes), axis]
+            extent[extent == 0] = 1
+            # Sort within each node along its longest axis. The node id is
+            # folded into a single float key (node id + position in [0, 1))
+            # as a single key argsort is much faster than a lexsort.
+            seg_axis = axis[seg_ids]
+            key = ((c[np.arange(n_tris), seg_axis] - lo[seg_ids, seg_axis]) /
+                   (extent[seg_ids] * (1 + 1e-6)))
+            perm = perm[np.argsort(seg_ids + key)]
+
+        # Leaves are padded up to a common size by repeating their last
+        # triangle - the repeats are harmless for every query we support.
+        bounds = (np.arange(n_leaves + 1) * n_tris) // n_leaves
+        sizes = np.diff(bounds)
+        offsets = np.minimum(np.arange(sizes.max()), sizes[:, None] - 1)
+        self.leaf_tris = perm[bounds[:-1, None] + offsets]
+
+        # The position of each triangle in the (flattened) leaf-major storage
+        # and, for each vertex, the triangles that use it (in CSR form).
+        self._tri_slot = np.empty(n_tris, dtype=np.intp)
+        self._tri_slot[self.leaf_tris.ravel()] = np.arange(self.leaf_tris.size)
+        vertex_of = trilist.ravel()
+        self._vertex_tris = np.argsort(vertex_of, kind='mergesort') // 3
+        self._vertex_tris_indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(vertex_of,
+                                        minlength=points.shape[0]))))
+        self.refit(points)
+
+    @property
+    def n_leaves(self):
+        r"""The number of leaves in the tree.
+
+        :type: `int`
+        """
+        return self.leaf_tris.shape[0]
+
+    @property
+    def n_tris(self):
+        r"""The number of triangles indexed by the tree.
+
+        :type: `int`
+        """
+        return self.trilist.shape[0]
+
+    @property
+    def nbytes(self):
+        r"""The total number of bytes held by the arrays of this tree
+        (including the mesh itself).
+
+        :type: `int`
+        """
+        return sum(getattr(self, a).nbytes for a in self._state_arrays)
+
+    @staticmethod
+    def estimate_nbytes(n_points, n_tris, leaf_size=8, trilist_itemsize=8):
+        r"""The number of bytes that a tree would hold (see :attr:`nbytes`),
+        without building it.
+
+        Parameters
+        ----------
+        n_points : `int`
+            The number of vertices of the mesh.
+        n_tris : `int`
+            The number of triangles of the mesh.
+        leaf_size : `int`, optional
+            The maximum number of triangles stored in each leaf of the tree.
+        trilist_itemsize : `int`, optional
+            The size in bytes of each index of the triangle list.
+
+        Returns
+        -------
+        nbytes : `int`
+            The number of bytes held by the arrays of the tree.
+        """
+        depth = 0
+        while n_tris > leaf_size * 2 ** depth:
+            depth += 1
+        n_leaves = 2 ** depth
+        # every leaf is padded up to the size of the largest
+        n_slots = n_leaves * -(-n_tris // n_leaves)
+        index = np.dtype(np.intp).itemsize
+        return (n_points * 3 * 8 + n_tris * 3 * trilist_itemsize +
+                # leaf_tris and the six per slot (3,) float arrays
+                n_slots * (index + 6 * 3 * 8) +
+                # the boxes of all the nodes
+                2 * (2 * n_leaves - 1) * 3 * 8 +
+                # the slot of each triangle and the triangles of each vertex
+                n_tris * index + 3 * n_tris * index + (n_points + 1) * 8)
+
+    # The arrays that fully describe a built tree
+    _state_arrays = ('points', 'trilist', 'leaf_tris', 'lo', 'hi',
+                     '_leaf_a', '_leaf_ab', '_leaf_ac', '_leaf_dots',
+                     '_leaf_lo', '_leaf_hi', '_tri_slot', '_vertex_tris',
+                     '_vertex_tris_indptr')
+
+    def save(self, file):
+        r"""Serialize this tree so that it can later be restored with
+        :meth:`load` without repeating any of the construction work.
+
+        Parameters
+        ----------
+        file : `str` or `file`-like object
+            Where the tree will be written (as an ``.npz`` archive).
+        """
+        state = dict((a, getattr(self, a)) for a in self._state_arrays)
+        np.savez(file, depth=self.depth, slack=self._slack, **state)
+
+    @classmethod
+    def load(cls, file):
+        r"""Restore a tree previously written with :meth:`save`.
+
+        Parameters
+        ----------
+        file : `str` or `file`-like object
+            The ``.npz`` archive written by :meth:`save`.
+
+        Returns
+        -------
+        bvh : :map:`TriangleBVH`
+            The restored tree.
+        """
+        bvh = cls.__new__(cls)
+        with np.load(file) as state:
+            for a in cls._state_arrays:
+                setattr(bvh, a, state[a])
+            bvh.depth = int(state['depth'])
+            bvh._slack = float(state['slack'])
+        bvh._vertex_tree = None
+        return bvh
+
+    def refit(self, points):
+        r"""Recompute the bounding boxes of the tree for a new set of vertex
+        positions, keeping the topology of the tree fixed.
+
+        This is far cheaper than building a new tree and is the right thing
+        to do for a mesh that is smoothly deforming (the tree will remain
+        correct, but may become less efficient under large deformations).
+        The arrays of the tree are updated in place.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The new vertex positions of the mesh.
+        """
+        points = np.require(points, dtype=np.float64, requirements=['C'])
+        self.points = points
+        self._vertex_tree = None
+        # Absolute slack used when pruning, to stay robust to rounding for
+        # queries that lie (almost) exactly on the surface.
+        self._slack = 1e-20 * np.sum(np.ptp(points, axis=0) ** 2)
+
+        # Per-triangle data is stored leaf-major so that solving a leaf is a
+        # contiguous read. Refitting a fitted tree (e.g. of a deforming mesh)
+        # overwrites its arrays in place, and keeps the vertex indices of
+        # every slot (and a scratch array) for the next refit.
+        if getattr(self, '_leaf_a', None) is None:
+            shape = self.leaf_tris.shape + (3,)
+            for a in ('_leaf_a', '_leaf_ab', '_leaf_ac', '_leaf_dots',
+                      '_leaf_lo', '_leaf_hi'):
+                setattr(self, a, np.empty(shape))
+            self.lo = np.empty((2 * self.n_leaves - 1, 3))
+            self.hi = np.empty((2 * self.n_leaves - 1, 3))
+            vertices, scratch = self._refit_buffers()
+        else:
+            if getattr(self, '_refit_state', None) is None:
+                self._refit_state = self._refit_buffers()
+            vertices, scratch = self._refit_state
+        a, ab, ac = self._leaf_a, self._leaf_ab, self._leaf_ac
+        # (mode='clip' as the default mode buffers the output)
+        np.take(points, vertices[0], axis=0, out=a, mode='clip')
+        np.take(points, vertices[1], axis=0, out=ab, mode='clip')
+        np.take(points, vertices[2], axis=0, out=ac, mode='clip')
+        np.minimum(a, ab, out=self._leaf_lo)
+        np.minimum(self._leaf_lo, ac, out=self._leaf_lo)
+        np.maximum(a, ab, out=self._leaf_hi)
+        np.maximum(self._leaf_hi, ac, out=self._leaf_hi)
+        ab -= a
+        ac -= a
+        for k, (x, y) in enumerate(((ab, ab), (ab, ac), (ac, ac))):
+            # (summed in the same order as _dot)
+            dot = self._leaf_dots[..., k]
+            np.multiply(x[..., 0], y[..., 0], out=dot)
+            np.multiply(x[..., 1], y[..., 1], out=scratch)
+            dot += scratch
+            np.multiply(x[..., 2], y[..., 2], out=scratch)
+            dot += scratch
+
+        n_leaves = self.n_leaves
+        lo, hi = self.lo, self.hi
+        np.min(self._leaf_lo, axis=1, out=lo[n_leaves - 1:])
+        np.max(self._leaf_hi, axis=1, out=hi[n_leaves - 1:])
+        for d in range(self.depth - 1, -1, -1):
+            # the nodes of level d, and their left and right children
+            nodes = slice(2 ** d - 1, 2 ** (d + 1) - 1)
+            left = slice(2 ** (d + 1) - 1, 2 ** (d + 2) - 1, 2)
+            right = slice(2 ** (d + 1), 2 ** (d + 2) - 1, 2)
+            np.minimum(lo[left], lo[right], out=lo[nodes])
+            np.maximum(hi[left], hi[right], out=hi[nodes])
+
+    def _refit_buffers(self):
+        # The indices of the three vertices of the triangle of every slot (as
+        # a (3, n_leaves, n_per_leaf) array), and a scratch array for refit
+        vertices = np.ascontiguousarray(
+            np.moveaxis(self.trilist[self.leaf_tris], -1, 0), dtype=np.intp)
+        return vertices, np.empty(self.leaf_tris.shape)
+
+    def _solve(self, query, q_c, slot):
+        # Exact squared distance and barycentric coordinates for each
+        # (query, triangle) pair, triangles given by leaf-major slot.
+        ab = self._leaf_ab.reshape(-1, 3)[slot]
+        ac = self._leaf_ac.reshape(-1, 3)[slot]
+        dots = self._leaf_dots.reshape(-1, 3)[slot]
+        ap = query[q_c] - self._leaf_a.reshape(-1, 3)[slot]
+        v, w = _closest_point_bcoords(ap, ab, ac, dots[:, 0], dots[:, 1],
+                                      dots[:, 2])
+        diff = v[:, None] * ab + w[:, None] * ac - ap
+        return v, w, diff, _dot(diff, diff)
+
+    def _ensure_vertex_tree(self):
+        if self._vertex_tree is None:
+            from scipy.spatial import cKDTree
+            self._vertex_tree = cKDTree(self.points)
+        return self._vertex_tree
+
+    def _upper_bound(self, query):
+        # The distance to the triangles around the nearest vertex is an
+        # upper bound on the distance to the surface, and almost always a
+        # very tight one.
+        vertex = self._ensure_vertex_tree().query(query)[1]
+        start = self._vertex_tris_indptr[vertex]
+        count = self._vertex_tris_indptr[vertex + 1] - start
+        q_c = np.repeat(np.arange(query.shape[0]), count)
+        # index of each pair within its vertex's run of triangles
+        within = np.arange(q_c.shape[0]) - np.repeat(np.cumsum(count) - count,
+                                                     count)
+        tris = self._vertex_tris[np.repeat(start, count) + within]
+        sq_dist = self._solve(query, q_c, self._tri_slot[tris])[-1]
+        upper = np.full(query.shape[0], np.inf)
+        np.minimum.at(upper, q_c, sq_dist)
+        # A little slack guards against pruning the true closest triangle
+        # through rounding when its bound and distance coincide.
+        return upper * (1 + 1e-10) + self._slack
+
+    def _leaves_within(self, query, upper):
+        # Breadth first traversal of every (query, node) pair whose bounding
+        # box is within the upper bound of the query. Returns the surviving
+        # (query, leaf) pairs with the query index sorted.
+        lo, hi = self.lo, self.hi
+        q_index = np.arange(query.shape[0])
+        node = np.zeros(query.shape[0], dtype=np.intp)
+        children = np.array([1, 2])
+        for _ in range(self.depth):
+            q_index = np.repeat(q_index, 2)
+            node = (2 * np.repeat(node, 2) +
+                    np.tile(children, node.shape[0]))
+            keep = (_box_sq_distance(query[q_index], lo[node], hi[node]) <=
+                    upper[q_index])
+            q_index, node = q_index[keep], node[keep]
+        return q_index, node - (self.n_leaves - 1)
+
+    def _closest_points_chunk(self, query, out_points, out_tri_indices,
+                              out_distances, out_bcoords):
+        upper = self._upper_bound(query)
+        q_index, leaf = self._leaves_within(query, upper)
+
+        # Exact distances to every triangle of every surviving leaf.
+        n_per_leaf = self.leaf_tris.shape[1]
+        q_c = np.repeat(q_index, n_per_leaf)
+        slot = (leaf[:, None] * n_per_leaf + np.arange(n_per_leaf)).ravel()
+        # cull triangles whose own bounding box is out of reach first
+        keep = (_box_sq_distance(query[q_c],
+                                 self._leaf_lo.reshape(-1, 3)[slot],
+                                 self._leaf_hi.reshape(-1, 3)[slot]) <=
+                upper[q_c])
+        q_c, slot = q_c[keep], slot[keep]
+        v, w, diff, sq_dist = self._solve(query, q_c, slot)
+        tri_c = self.leaf_tris.ravel()[slot]
+
+        best = _first_min(q_c, sq_dist, tri_c, self.n_tris)
+        v, w = v[best], w[best]
+        out_tri_indices[...] = tri_c[best]
+        out_distances[...] = np.sqrt(sq_dist[best])
+        out_bcoords[:, 0] = 1 - v - w
+        out_bcoords[:, 1] = v
+        out_bcoords[:, 2] = w
+        out_points[...] = query + diff[best]
+
+    def closest_points(self, points, chunk_size=4096, n_workers=1,
+                       out=None):
+        r"""Return the closest points on the mesh for a batch of query
+        points.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The query points.
+        chunk_size : `int`, optional
+            The number of queries that are solved together. Larger chunks
+            amortise more interpreter overhead at the expense of memory.
+        n_workers : `int` or ``None``, optional
+            The number of threads the chunks are spread over. All threads
+            share this (read-only) tree and the heavy lifting is done in
+            NumPy and SciPy kernels that release the GIL. If ``None``, one
+            thread per CPU is used. The result is identical to the serial
+            result, whatever the number of workers.
+        out : `ClosestPointResult`, optional
+            Arrays of the shapes and types of the result to write it into
+            (e.g. to reuse the same arrays for every iteration of a
+            registration).
+
+        Returns
+        -------
+        result : `ClosestPointResult`
+            A named tuple of ``points`` ``(n_points, 3)``, ``tri_indices``
+            ``(n_points,)`` (`intp`), ``distances`` ``(n_points,)`` and
+            ``bcoords`` ``(n_points, 3)`` arrays. ``bcoords`` are the
+            barycentric coordinates of each closest point within its
+            triangle. This is ``out``, if it was provided.
+        """
+        points = np.require(points, dtype=np.float64, requirements=['C'])
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('query points must be of shape (n_points, 3)')
+        n = points.shape[0]
+        if out is None:
+            result = ClosestPointResult(np.empty((n, 3)),
+                                        np.empty(n, dtype=np.intp),
+                                        np.empty(n),
+                                        np.empty((n, 3)))
+        else:
+            result = out
+
+        def solve_chunk(s):
+            self._closest_points_chunk(points[s], *[r[s] for r in result])
+
+        self._map_chunks(solve_chunk, n, chunk_size, n_workers)
+        return result
+
+    def _ray_leaves(self, origins, inv_directions, max_distances):
+        # Breadth first traversal of every (ray, node) pair whose bounding
+        # box is crossed by the ray within its maximum distance (the slab
+        # test). Returns the surviving (ray, leaf) pairs with the ray index
+        # sorted.
+        lo, hi = self.lo, self.hi
+        r_index = np.arange(origins.shape[0])
+        node = np.zeros(origins.shape[0], dtype=np.intp)
+        children = np.array([1, 2])
+        for d in range(self.depth + 1):
+            if d > 0:
+                r_index = np.repeat(r_index, 2)
+                node = (2 * np.repeat(node, 2) +
+                        np.tile(children, node.shape[0]))
+            o, inv = origins[r_index], inv_directions[r_index]
+            t_lo = (lo[node] - o) * inv
+            t_hi = (hi[node] - o) * inv
+            t_near = np.minimum(t_lo, t_hi)
+            t_far = np.maximum(t_lo, t_hi)
+            # (explicit per axis reductions are much faster than .max(axis=1))
+            near = np.maximum(np.maximum(t_near[:, 0], t_near[:, 1]),
+                              np.maximum(t_near[:, 2], 0))
+            far = np.minimum(np.minimum(t_far[:, 0], t_far[:, 1]),
+                             np.minimum(t_far[:, 2], max_distances[r_index]))
+            keep = near <= far
+            r_index, node = r_index[keep], node[keep]
+        return r_index, node - (self.n_leaves - 1)
+
+    def _intersect_rays_chunk(self, origins, directions, max_distances,
+                              out_hits, out_tri_indices, out_distances):
+        # (Near) zero direction components are nudged so that the slab test
+        # never multiplies zero by infinity.
+        inv_directions = 1.0 / np.where(np.abs(directions) < 1e-300, 1e-300,
+                                        directions)
+        with np.errstate(over='ignore', invalid='ignore'):
+            r_index, leaf = self._ray_leaves(origins, inv_directions,
+                                             max_distances)
+
+        n_per_leaf = self.leaf_tris.shape[1]
+        r_c = np.repeat(r_index, n_per_leaf)
+        slot = (leaf[:, None] * n_per_leaf + np.arange(n_per_leaf)).ravel()
+
+        # Moller-Trumbore for every candidate (ray, triangle) pair
+        d = directions[r_c]
+        e1 = self._leaf_ab.reshape(-1, 3)[slot]
+        e2 = self._leaf_ac.reshape(-1, 3)[slot]
+        t_vec = origins[r_c] - self._leaf_a.reshape(-1, 3)[slot]
+        p_vec = _cross(d, e2)
+        q_vec = _cross(t_vec, e1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0 / _dot(e1, p_vec)
+            u = _dot(t_vec, p_vec) * inv_det
+            v = _dot(d, q_vec) * inv_det
+            t = _dot(e2, q_vec) * inv_det
+            hit = ((u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0) &
+                   (t <= max_distances[r_c]))
+        r_c, t, tri_c = r_c[hit], t[hit], self.leaf_tris.ravel()[slot[hit]]
+
+        out_hits[...] = False
+        out_tri_indices[...] = -1
+        out_distances[...] = np.inf
+        if r_c.shape[0] > 0:
+            best = _first_min(r_c, t, tri_c, self.n_tris)
+            out_hits[r_c[best]] = True
+            out_tri_indices[r_c[best]] = tri_c[best]
+            out_distances[r_c[best]] = t[best]
+
+    def intersect_rays(self, origins, directions, max_distances=np.inf,
+                       chunk_size=4096, n_workers=1, out=None):
+        r"""Return the first intersection with the mesh for a batch of rays.
+
+        Parameters
+        ----------
+        origins : ``(n_rays, 3)`` `ndarray`
+            The origin of each ray.
+        directions : ``(n_rays, 3)`` `ndarray`
+            The direction of each ray (need not be normalized). Rays with a
+            zero direction never hit anything.
+        max_distances : `float` or ``(n_rays,)`` `ndarray`, optional
+            Hits further than this (Euclidean) distance from the origin of a
+            ray are ignored.
+        chunk_size : `int`, optional
+            The number of rays that are solved together.
+        n_workers : `int` or ``None``, optional
+            The number of threads the chunks are spread over, see
+            :meth:`closest_points`.
+        out : `RayHitResult`, optional
+            Arrays of the shapes and types of the result to write it into.
+
+        Returns
+        -------
+        result : `RayHitResult`
+            A named tuple of ``hits`` ``(n_rays,)`` `bool`, ``tri_indices``
+            ``(n_rays,)`` (``-1`` where there is no hit) and ``distances``
+            ``(n_rays,)`` (``inf`` where there is no hit) arrays. This is
+            ``out``, if it was provided.
+        """
+        origins = np.require(origins, dtype=np.float64, requirements=['C'])
+        directions = np.require(directions, dtype=np.float64,
+                                requirements=['C'])
+        if (origins.ndim != 2 or origins.shape[1] != 3 or
+                directions.shape != origins.shape):
+            raise ValueError('origins and directions must both be of shape '
+                             '(n_rays, 3)')
+        n = origins.shape[0]
+        lengths = np.sqrt(_dot(directions, directions))
+        valid = lengths > 0
+        directions = directions / np.where(valid, lengths, 1)[:, None]
+        max_distances = np.where(valid, max_distances, -1.0)
+
+        if out is None:
+            result = RayHitResult(np.empty(n, dtype=bool),
+                                  np.empty(n, dtype=np.intp),
+                                  np.empty(n))
+        else:
+            result = out
+
+        def solve_chunk(s):
+            self._intersect_rays_chunk(origins[s], directions[s],
+                                       max_distances[s],
+                                       *[r[s] for r in result])
+
+        self._map_chunks(solve_chunk, n, chunk_size, n_workers)
+        return result
+
+    def intersect_segments(self, starts, ends, chunk_size=4096, n_workers=1,
+                           out=None):
+        r"""Return the intersection with the mesh closest to the start of each
+        of a batch of line segments.
+
+        Parameters
+        ----------
+        starts : ``(n_segments, 3)`` `ndarray`
+            The start point of each segment.
+        ends : ``(n_segments, 3)`` `ndarray`
+            The end point of each segment.
+        chunk_size : `int`, optional
+            The number of segments that are solved together.
+        n_workers : `int` or ``None``, optional
+            The number of threads the chunks are spread over, see
+            :meth:`closest_points`.
+        out : `RayHitResult`, optional
+            Arrays of the shapes and types of the result to write it into.
+
+        Returns
+        -------
+        result : `RayHitResult`
+            As for :meth:`intersect_rays`, with ``distances`` measured from
+            ``starts``.
+        """
+        starts = np.require(starts, dtype=np.float64, requirements=['C'])
+        directions = np.asarray(ends, dtype=np.float64) - starts
+        return self.intersect_rays(starts, directions,
+                                   np.sqrt(_dot(directions, directions)),
+                                   chunk_size=chunk_size, n_workers=n_workers,
+                                   out=out)
+
+    def _map_chunks(self, solve_chunk, n, chunk_size, n_workers):
+        # Call solve_chunk on consecutive slices of range(n), serially or
+        # spread over a pool of threads.
+        chunks = [slice(s, min(s + chunk_size, n))
+                  for s in range(0, n, chunk_size)]
+        if n_workers is None:
+            n_workers = cpu_count()
+        n_workers = min(n_workers, len(chunks))
+        if n_workers > 1:
+            # Make sure the lazily built parts of the tree exist before the
+            # threads start sharing it.
+            self._ensure_vertex_tree()
+            pool = ThreadPool(n_workers)
+            try:
+                pool.map(solve_chunk, chunks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for s in chunks:
+                solve_chunk(s)
+
+
+def _content_key(points, trilist):
+    h = hashlib.sha1()
+    for a in (points, trilist):
+        a = np.ascontiguousarray(a)
+        h.update('{}{}'.format(a.dtype.str, a.shape).encode('utf-8'))
+        h.update(a.view(np.uint8).ravel())
+    return h.hexdigest()
+
+
+class BVHCache(object):
+    r"""A content-addressed cache of :map:`TriangleBVH` instances.
+
+    Trees are keyed by a hash of the points and triangle list of the mesh
+    they index, so asking for the tree of a mesh that has been seen before
+    (even if it is a different object) skips construction entirely. Built
+    trees are held in an in-memory least recently used cache with a byte
+    budget and can optionally also be written to a directory on disk, so
+    that they survive between sessions.
+
+    Note that the trees handed out are shared, so they must not be modified
+    (e.g. via :meth:`TriangleBVH.refit`), and that the in-memory cache keeps
+    the trees that it holds alive until they are evicted or the cache is
+    cleared (for :data:`default_bvh_cache`, up to 512MB for the rest of the
+    process). Trees that could never fit in the budget are built without
+    being hashed or held, unless they can be written to ``cache_dir``.
+
+    Parameters
+    ----------
+    max_bytes : `int`, optional
+        The budget for the in-memory cache. The least recently used trees
+        are evicted to stay within it. Trees larger than the whole budget are
+        never held in memory.
+    cache_dir : `str` or `pathlib.Path` or ``None``, optional
+        If provided, every tree that is built is also serialized into this
+        directory and trees missing from memory are looked for here before
+        being built.
+    leaf_size : `int`, optional
+        The leaf size of the trees that are built.
+    """
+    def __init__(self, max_bytes=512 * 2 ** 20, cache_dir=None, leaf_size=8):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.leaf_size = leaf_size
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        r"""The number of bytes held by the in-memory cache.
+
+        :type: `int`
+        """
+        return sum(t.nbytes for t in self._trees.values())
+
+    def __len__(self):
+        return len(self._trees)
+
+    def clear(self):
+        r"""Empty the in-memory cache (the on-disk cache is left alone).
+        """
+        with self._lock:
+            self._trees.clear()
+
+    def _path(self, key):
+        return Path(str(self.cache_dir)) / '{}.npz'.format(key)
+
+    def get(self, points, trilist):
+        r"""Return the tree for the given mesh, building it only if it has
+        never been seen before.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The vertices of the mesh.
+        trilist : ``(n_tris, 3)`` `ndarray`
+            The triangle list of the mesh.
+
+        Returns
+        -------
+        bvh : :map:`TriangleBVH`
+            The (shared) tree for this mesh.
+        """
+        if self.cache_dir is None:
+            nbytes = TriangleBVH.estimate_nbytes(
+                len(points), len(trilist), leaf_size=self.leaf_size,
+                trilist_itemsize=np.asarray(trilist).itemsize)
+            if nbytes > self.max_bytes:
+                # the tree could never be held, so don't bother hashing the
+                # mesh
+                return TriangleBVH(points, trilist, leaf_size=self.leaf_size)
+        key = _content_key(points, trilist)
+        with self._lock:
+            bvh = self._trees.pop(key, None)
+            if bvh is not None:
+                self._trees[key] = bvh
+                return bvh
+
+        path = self._path(key) if self.cache_dir is not None else None
+        if path is not None and path.exists():
+            bvh = TriangleBVH.load(str(path))
+        else:
+            # Copy so that later in-place changes to the caller's arrays
+            # cannot invalidate the cached tree.
+            bvh = TriangleBVH(np.array(points, dtype=np.float64),
+                              np.array(trilist), leaf_size=self.leaf_size)
+            if path is not None:
+                if not path.parent.exists():
+                    path.parent.mkdir(parents=True)
+                # write then rename so that readers never see partial files
+                tmp_path = path.with_suffix('.{}.tmp'.format(os.getpid()))
+                with open(str(tmp_path), 'wb') as f:
+                    bvh.save(f)
+                os.rename(str(tmp_path), str(path))
+
+        if bvh.nbytes <= self.max_bytes:
+            with self._lock:
+                self._trees[key] = bvh
+                total = self.nbytes
+                while total > self.max_bytes:
+                    total -= self._trees.popitem(last=False)[1].nbytes
+        return bvh
+
+
+default_bvh_cache = BVHCache()
@@ -0,0 +1,200 @@
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import assert_allclose
+from menpo.shape import TriMesh
+import menpo3d
+from menpo3d.bvh import (BVHCache, ClosestPointResult, TriangleBVH,
+                         closest_points_on_triangles)
+from menpo3d.sdf import SignedDistanceGrid
+
+
+def brute_force_distances(mesh, points):
+    tri_points = mesh.points[mesh.trilist]
+    a, b, c = tri_points[:, 0], tri_points[:, 1], tri_points[:, 2]
+    distances = []
+    for p in points:
+        p = np.repeat(p[None], mesh.n_tris, axis=0)
+        closest = closest_points_on_triangles(p, a, b, c)[0]
+        distances.append(np.sqrt(((closest - p) ** 2).sum(axis=1)).min())
+    return np.array(distances)
+
+
+def test_closest_points_on_triangles_regions():
+    a = np.array([[0., 0, 0]] * 4)
+    b = np.array([[1., 0, 0]] * 4)
+    c = np.array([[0., 1, 0]] * 4)
+    p = np.array([[0.25, 0.25, 1],  # face
+                  [-1, -1, 0],      # vertex a
+                  [0.5, -1, 0],     # edge ab
+                  [1, 1, 0]])       # edge bc
+    closest, bcoords = closest_points_on_triangles(p, a, b, c)
+    assert_allclose(closest, [[0.25, 0.25, 0], [0, 0, 0],
+                              [0.5, 0, 0], [0.5, 0.5, 0]])
+    assert_allclose(bcoords, [[0.5, 0.25, 0.25], [1, 0, 0],
+                              [0.5, 0.5, 0], [0, 0.5, 0.5]])
+
+
+def test_bvh_closest_points_match_brute_force():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(0)
+    points = mesh.centre() + rng.randn(200, 3) * mesh.range() * 0.5
+    result = TriangleBVH(mesh.points, mesh.trilist).closest_points(points)
+    assert_allclose(result.distances, brute_force_distances(mesh, points))
+
+
+def test_bvh_bcoords_reconstruct_closest_points():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(1)
+    points = mesh.points + rng.randn(*mesh.points.shape) * 0.001
+    result = TriangleBVH(mesh.points, mesh.trilist).closest_points(points)
+    recon = mesh.project_barycentric_coordinates(result.bcoords,
+                                                 result.tri_indices).points
+    assert_allclose(recon, result.points)
+
+
+def test_bvh_threaded_closest_points_identical_to_serial():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(2)
+    points = mesh.points + rng.randn(*mesh.points.shape) * 0.005
+    bvh = TriangleBVH(mesh.points, mesh.trilist)
+    serial = bvh.closest_points(points)
+    threaded = bvh.closest_points(points, chunk_size=100, n_workers=4)
+    for s, t in zip(serial, threaded):
+        assert np.array_equal(s, t)
+
+
+def test_bvh_closest_points_into_out():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(3)
+    points = mesh.points + rng.randn(*mesh.points.shape) * 0.005
+    bvh = TriangleBVH(mesh.points, mesh.trilist)
+    expected = bvh.closest_points(points)
+    out = ClosestPointResult(*[np.empty_like(r) for r in expected])
+    result = bvh.closest_points(points, out=out)
+    assert result is out
+    for r, e in zip(result, expected):
+        assert_allclose(r, e)
+
+
+def test_bvh_refit_in_place():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(4)
+    bvh = TriangleBVH(mesh.points, mesh.trilist)
+    names = ('lo', 'hi', '_leaf_a', '_leaf_ab', '_leaf_ac', '_leaf_dots',
+             '_leaf_lo', '_leaf_hi')
+    arrays = [getattr(bvh, a) for a in names]
+    deformed = mesh.points + rng.randn(*mesh.points.shape) * 0.002
+    bvh.refit(deformed)
+    points = deformed[rng.randint(0, mesh.n_points, 100)]
+    points += rng.randn(*points.shape) * 0.005
+    assert_allclose(bvh.closest_points(points).distances,
+                    brute_force_distances(TriMesh(deformed, mesh.trilist),
+                                          points))
+    # refitting back to the original points gives back the original tree
+    bvh.refit(mesh.points)
+    expected = TriangleBVH(mesh.points, mesh.trilist)
+    for a, array in zip(names, arrays):
+        # (overwritten, not replaced)
+        assert getattr(bvh, a) is array
+        assert_allclose(array, getattr(expected, a))
+
+
+def test_bvh_cache_reuses_tree_for_same_content():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    cache = BVHCache()
+    bvh = cache.get(mesh.points, mesh.trilist)
+    assert cache.get(mesh.points.copy(), mesh.trilist.copy()) is bvh
+    assert cache.get(mesh.points + 1, mesh.trilist) is not bvh
+    assert len(cache) == 2
+
+
+def test_bvh_cache_evicts_to_stay_within_budget():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    cache = BVHCache()
+    nbytes = cache.get(mesh.points, mesh.trilist).nbytes
+    cache = BVHCache(max_bytes=int(nbytes * 1.5))
+    first = cache.get(mesh.points, mesh.trilist)
+    cache.get(mesh.points + 1, mesh.trilist)
+    assert len(cache) == 1
+    assert cache.get(mesh.points, mesh.trilist) is not first
+
+
+def test_bvh_estimate_nbytes_matches_built_tree():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    for leaf_size in (1, 8, 13):
+        bvh = TriangleBVH(mesh.points, mesh.trilist, leaf_size=leaf_size)
+        assert TriangleBVH.estimate_nbytes(
+            mesh.n_points, mesh.n_tris, leaf_size=leaf_size,
+            trilist_itemsize=mesh.trilist.itemsize) == bvh.nbytes
+
+
+def test_bvh_cache_skips_trees_over_budget():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    cache = BVHCache(max_bytes=1024)
+    bvh = cache.get(mesh.points, mesh.trilist)
+    assert len(cache) == 0
+    assert cache.get(mesh.points, mesh.trilist) is not bvh
+
+
+def test_bvh_cache_on_disk_round_trip():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    points = mesh.points + 0.001
+    cache_dir = tempfile.mkdtemp()
+    try:
+        built = BVHCache(cache_dir=cache_dir).get(mesh.points, mesh.trilist)
+        loaded = BVHCache(cache_dir=cache_dir).get(mesh.points, mesh.trilist)
+        assert loaded is not built
+        for b, l in zip(built.closest_points(points),
+                        loaded.closest_points(points)):
+            assert np.array_equal(b, l)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_intersect_segments_single_triangle():
+    bvh = TriangleBVH(np.array([[0., 0, 0], [1, 0, 0], [0, 1, 0]]),
+                      np.array([[0, 1, 2]]))
+    starts = np.array([[0.25, 0.25, 1],    # through the face
+                       [0.25, 0.25, 1],    # stops short of the face
+                       [1, 1, 1],          # passes outside the triangle
+                       [0.25, 0.25, 1]])   # zero length
+    ends = np.array([[0.25, 0.25, -1],
+                     [0.25, 0.25, 0.5],
+                     [1, 1, -1],
+                     [0.25, 0.25, 1]])
+    result = bvh.intersect_segments(starts, ends)
+    assert np.array_equal(result.hits, [True, False, False, False])
+    assert np.array_equal(result.tri_indices, [0, -1, -1, -1])
+    assert_allclose(result.distances[0], 1)
+
+
+def test_bvh_intersect_rays_matches_single_leaf():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(3)
+    origins = mesh.centre() + rng.randn(500, 3) * mesh.range() * 0.5
+    directions = rng.randn(500, 3)
+    bvh = TriangleBVH(mesh.points, mesh.trilist)
+    # a tree with a single leaf tests every ray against every triangle
+    flat = TriangleBVH(mesh.points, mesh.trilist, leaf_size=mesh.n_tris)
+    result = bvh.intersect_rays(origins, directions, chunk_size=100,
+                                n_workers=4)
+    expected = flat.intersect_rays(origins, directions)
+    assert result.hits.any() and not result.hits.all()
+    for r, e in zip(result, expected):
+        assert np.array_equal(r, e)
+
+
+def test_signed_distance_grid_close_to_exact():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    grid = SignedDistanceGrid(mesh.points, mesh.trilist, resolution=24)
+    rng = np.random.RandomState(4)
+    points = mesh.points + rng.randn(*mesh.points.shape) * 0.002
+    exact = TriangleBVH(mesh.points, mesh.trilist).closest_points(points)
+    closest, tri_indices = grid.closest_points(points)
+    distances = np.sqrt(((closest - points) ** 2).sum(axis=1))
+    # approximate distances can only be too long, and not by much
+    assert np.all(distances >= exact.distances - 1e-12)
+    assert np.all(distances - exact.distances < grid.spacing)
+    assert_allclose(np.abs(grid.signed_distance(points)), exact.distances,
+                    atol=grid.spacing)
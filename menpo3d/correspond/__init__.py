@@ -1 +1,2 @@
-from .nicp import non_rigid_icp
+from .icp import rigid_icp
+from .nicp import non_rigid_icp, non_rigid_icp_many
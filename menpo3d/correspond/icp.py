@@ -0,0 +1,188 @@
+import numpy as np
+from menpo.transform import Similarity
+from menpo3d.vtkutils import BVHClosestPointLocator
+
+
+def _weighted_similarity(points, targets, weights, scale=True):
+    # The weighted least squares similarity (or rigid) transform taking points
+    # to targets (Umeyama's closed form), as an (4, 4) homogeneous matrix
+    total = weights.sum()
+    mean_p = weights.dot(points) / total
+    mean_t = weights.dot(targets) / total
+    p = points - mean_p
+    t = targets - mean_t
+    covariance = (p * weights[:, None]).T.dot(t)
+    U, S, Vt = np.linalg.svd(covariance)
+    # guard against reflections
+    d = np.ones(3)
+    d[2] = np.sign(np.linalg.det(Vt.T.dot(U.T)))
+    R = (Vt.T * d).dot(U.T)
+    if scale:
+        s = (S * d).sum() / weights.dot((p ** 2).sum(axis=1))
+    else:
+        s = 1.0
+    h_matrix = np.eye(4)
+    h_matrix[:3, :3] = s * R
+    h_matrix[:3, 3] = mean_t - s * R.dot(mean_p)
+    return h_matrix
+
+
+def _rotation_matrix(rotation_vector):
+    # Rodrigues' formula for the rotation about rotation_vector by its norm
+    angle = np.linalg.norm(rotation_vector)
+    if angle == 0:
+        return np.eye(3)
+    k = rotation_vector / angle
+    K = np.array([[0, -k[2], k[1]],
+                  [k[2], 0, -k[0]],
+                  [-k[1], k[0], 0]])
+    return np.eye(3) + np.sin(angle) * K + (1 - np.cos(angle)) * K.dot(K)
+
+
+def _weighted_point_to_plane(points, targets, normals, weights, scale=True):
+    # The weighted least squares similarity (or rigid) transform minimizing
+    # the distances from points to the planes through targets, linearized
+    # about the identity (as the rotation vector w, translation t and scale
+    # 1 + s), as a (4, 4) homogeneous matrix
+    A = np.hstack([np.cross(points, normals), normals,
+                   (points * normals).sum(axis=1)[:, None]])
+    if not scale:
+        A = A[:, :6]
+    b = ((targets - points) * normals).sum(axis=1)
+    A_w = A * weights[:, None]
+    x = np.linalg.lstsq(A_w.T.dot(A), A_w.T.dot(b), rcond=None)[0]
+    s = 1 + x[6] if scale else 1.0
+    h_matrix = np.eye(4)
+    h_matrix[:3, :3] = s * _rotation_matrix(x[:3])
+    h_matrix[:3, 3] = x[3:6]
+    return h_matrix
+
+
+def _huber_weights(residuals, k=1.345):
+    # Huber weights for residuals, with the scale estimated by the median
+    # absolute residual (scaled to match the standard deviation of zero mean
+    # normal residuals). This isn't the median absolute deviation - the
+    # residuals aren't centred on their median, as they should be close to
+    # zero (and point to point residuals, being distances, are never
+    # negative).
+    sigma = 1.4826 * np.median(np.abs(residuals))
+    if sigma == 0:
+        return np.ones_like(residuals)
+    r = np.abs(residuals) / (k * sigma)
+    return 1.0 / np.maximum(r, 1)
+
+
+def rigid_icp(source, target, method='point_to_point', scale=True,
+              max_iterations=50, eps=1e-6, trim=None, robust=False,
+              n_workers=1, cache=False, verbose=False):
+    r"""
+    Rigidly align the source to the target with the iterative closest point
+    algorithm, e.g. as a pre-alignment for :func:`non_rigid_icp` (which
+    assumes that its inputs are already rigidly aligned).
+
+    Every iteration finds the closest point on the target to each (aligned)
+    source point, in a single batch query of a :map:`TriangleBVH` built over
+    the target, and then the transform that best aligns the source points
+    to them in closed form.
+
+    Parameters
+    ----------
+    source : :map:`PointCloud`
+        The shape to align (e.g. a :map:`TriMesh` template).
+    target : :map:`TriMesh`
+        The 3D mesh that the source is aligned to.
+    method : ``{'point_to_point', 'point_to_plane'}``, optional
+        Whether each iteration minimizes the distances from the source points
+        to their closest points (solved exactly by weighted Procrustes
+        analysis) or to the tangent planes of the target at them (solved
+        linearized about the current alignment). Point to plane converges in
+        far fewer iterations when the surfaces are close, as source points
+        are free to slide along the target.
+    scale : `bool`, optional
+        If ``True``, a uniform scale is found as well as the rotation and
+        translation.
+    max_iterations : `int`, optional
+        The maximum number of iterations.
+    eps : `float`, optional
+        The alignment has converged when an iteration changes the transform
+        (in the Frobenius norm of its homogeneous matrix) by less than this.
+    trim : `float`, optional
+        If given, only this proportion of the correspondences (the closest
+        ones) are used in each iteration, which makes the alignment robust to
+        partial overlap of the source and target.
+    robust : `bool`, optional
+        If ``True``, correspondences are down weighted by their residual
+        (Huber weights, with the scale estimated from the median absolute
+        residual), reducing the influence of outliers.
+    n_workers : `int` or ``None``, optional
+        The number of threads used for the closest point queries (one per CPU
+        if ``None``).
+    cache : :map:`BVHCache` or `bool`, optional
+        Where to look up the spatial index of the target, see
+        :map:`BVHClosestPointLocator`. Note that a cache keeps the indices
+        that it holds alive for the rest of the process.
+    verbose : `bool`, optional
+        If ``True``, the mean distance to the correspondences is printed
+        every iteration.
+
+    Returns
+    -------
+    transform : :map:`Similarity`
+        The transform that aligns the source to the target.
+
+    Raises
+    ------
+    ValueError
+        If ``method`` is not recognised, ``trim`` is not in ``(0, 1]`` or
+        the source has fewer than 3 points.
+    """
+    if method not in ('point_to_point', 'point_to_plane'):
+        raise ValueError("method must be 'point_to_point' or "
+                         "'point_to_plane'")
+    if trim is not None and not 0 < trim <= 1:
+        raise ValueError('trim must be in (0, 1]')
+    points = source.points
+    n = points.shape[0]
+    if n < 3:
+        raise ValueError('at least 3 source points are needed, '
+                         'got {}'.format(n))
+    n_dropped = 0
+    if trim is not None:
+        # drop the furthest correspondences, always keeping at least 3
+        n_dropped = min(n - int(np.ceil(trim * n)), n - 3)
+    closest_points_on_target = BVHClosestPointLocator.from_trimesh(
+        target, n_workers=n_workers, cache=cache)
+    if method == 'point_to_plane':
+        target_tri_normals = target.tri_normals()
+
+    h_matrix = np.eye(4)
+    for i in range(max_iterations):
+        aligned = points.dot(h_matrix[:3, :3].T) + h_matrix[:3, 3]
+        U, tri_indices = closest_points_on_target(aligned)
+        if method == 'point_to_plane':
+            normals = target_tri_normals[tri_indices]
+            residuals = ((U - aligned) * normals).sum(axis=1)
+        else:
+            residuals = np.sqrt(((U - aligned) ** 2).sum(axis=1))
+
+        weights = np.ones(n)
+        if n_dropped > 0:
+            dropped = np.argpartition(-np.abs(residuals), n_dropped)
+            weights[dropped[:n_dropped]] = 0
+        if robust:
+            weights *= _huber_weights(residuals)
+
+        if verbose:
+            print('{}: mean distance {:.6f}'.format(
+                i, np.abs(residuals).mean()))
+
+        if method == 'point_to_plane':
+            step = _weighted_point_to_plane(aligned, U, normals, weights,
+                                            scale=scale)
+        else:
+            step = _weighted_similarity(aligned, U, weights, scale=scale)
+        h_matrix = step.dot(h_matrix)
+        if np.linalg.norm(step - np.eye(4)) < eps:
+            break
+
+    return Similarity(h_matrix)
@@ -0,0 +1,58 @@
+import numpy as np
+from numpy.testing import assert_allclose
+from nose.tools import raises
+from menpo.shape import PointCloud
+from menpo.transform import Rotation, Translation, UniformScale
+import menpo3d
+from menpo3d.correspond import rigid_icp
+from menpo3d.correspond.icp import _huber_weights
+
+
+def misaligned_bunny():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    centre = bunny.centre()
+    transform = (Translation(-centre)
+                 .compose_before(Rotation.init_from_3d_ccw_angle_around_x(10))
+                 .compose_before(UniformScale(1.1, 3))
+                 .compose_before(Translation(centre + 0.01)))
+    return bunny, transform.apply(bunny)
+
+
+def test_rigid_icp_point_to_point_recovers_similarity():
+    bunny, target = misaligned_bunny()
+    transform = rigid_icp(bunny, target)
+    assert_allclose(transform.apply(bunny.points), target.points, atol=1e-4)
+
+
+def test_rigid_icp_point_to_plane_recovers_similarity():
+    bunny, target = misaligned_bunny()
+    transform = rigid_icp(bunny, target, method='point_to_plane', trim=0.9,
+                          robust=True)
+    assert_allclose(transform.apply(bunny.points), target.points, atol=1e-6)
+
+
+@raises(ValueError)
+def test_rigid_icp_unknown_method_raises():
+    bunny, target = misaligned_bunny()
+    rigid_icp(bunny, target, method='plane_to_plane')
+
+
+@raises(ValueError)
+def test_rigid_icp_too_few_points_raises():
+    bunny, target = misaligned_bunny()
+    rigid_icp(PointCloud(bunny.points[:2]), target)
+
+
+def test_rigid_icp_trim_keeps_at_least_3_points():
+    bunny, target = misaligned_bunny()
+    source = PointCloud(bunny.points[:4])
+    transform = rigid_icp(source, target, trim=0.01)
+    assert transform.apply(source.points).shape == (4, 3)
+
+
+def test_huber_weights_scale_is_the_median_absolute_residual():
+    # distances, all positive - the scale is 1.4826 * 1
+    residuals = np.array([0.5, 1, 1, 1.5, 100])
+    weights = _huber_weights(residuals)
+    assert_allclose(weights[:4], 1)
+    assert_allclose(weights[4], 1.345 * 1.4826 / 100)
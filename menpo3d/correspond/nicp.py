@@ -1,30 +1,36 @@
+import os
+import pickle
+import sys
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+
 import numpy as np
 import scipy.sparse as sp
-from menpo.shape import TriMesh
+from menpo.shape import PointCloud, TriMesh
 from menpo.transform import Translation, UniformScale
-from menpo3d.vtkutils import trimesh_to_vtk, VTKClosestPointLocator
+from menpo3d.bvh import ClosestPointResult, RayHitResult
+from menpo3d.vtkutils import (VTKClosestPointLocator, BVHRayIntersector,
+                               BVHClosestPointLocator, SDFClosestPointLocator,
+                               KDTreeClosestPointLocator,
+                               closest_point_locator, trimesh_to_vtk,
+                               trimesh_from_vtk)
+from menpo3d.barycentric import barycentric_interpolation_operator
+from menpo3d.correspond.solvers import (build_solver, ConjugateGradientSolver,
+                                        SparseLeastSquaresSolver)
 
 try:
-    
-    try:
-        # First try the newer scikit-sparse namespace
-        from sksparse.cholmod import cholesky_AAt
-    except ImportError:
-        # Fall back to the older scikits.sparse namespace
-        from scikits.sparse.cholmod import cholesky_AAt
-
-    # user has cholesky available - provide a fast solve
-    def spsolve(sparse_X, dense_b):
-        factor = cholesky_AAt(sparse_X.T)
-        return factor(sparse_X.T.dot(dense_b)).toarray()
-
+    # the kernel behind sparse matrix products, which (unlike the products)
+    # accumulates into a given output
+    from scipy.sparse._sparsetools import csr_matvecs
 except ImportError:
-    # fallback to (much slower) scipy solve
-    from scipy.sparse.linalg import spsolve as scipy_spsolve
+    csr_matvecs = None
+
 
-    def spsolve(sparse_X, dense_b):
-        return scipy_spsolve(sparse_X.T.dot(sparse_X),
-                             sparse_X.T.dot(dense_b)).toarray()
+# these values have been empirically found to perform well for well rigidly
+# aligned facial meshes
+_default_stiffness = [50, 20, 5, 2, 0.8, 0.5, 0.35, 0.2]
+_default_lm_weight = [5,  2, .5, 0,   0,   0,    0,    0]
 
 
 def node_arc_incidence_matrix(source):
@@ -38,50 +44,551 @@ def node_arc_incidence_matrix(source):
     return sp.coo_matrix((data, (row, col)))
 
 
+class _NICPTemplate(object):
+    r"""Everything about a non-rigid ICP registration that only depends on
+    the source (template) mesh, so that it can be computed once and shared
+    by registrations to many targets.
+
+    The points and the sparse system are kept in ``dtype``.
+    """
+    def __init__(self, source, landmarks=None, prepare=None,
+                 dtype=np.float64):
+        # Scale factors completely change the behavior of the algorithm -
+        # always rescale the source down to a sensible size (so it fits
+        # inside box of diagonal 1) and is centred on the origin. We'll undo
+        # this after the fit so the user can use whatever scale they prefer.
+        # (The levels of a multi-resolution fit share the transform of the
+        # full resolution template.)
+        if prepare is None:
+            tr = Translation(-1 * source.centre())
+            sc = UniformScale(1.0 / np.sqrt(np.sum(source.range() ** 2)), 3)
+            prepare = tr.compose_before(sc)
+        self.prepare = prepare
+        # the extent of the source, for cropping targets
+        self.bounds = source.bounds()
+        self.diagonal = np.sqrt(np.sum(source.range() ** 2))
+        # store how to undo the similarity transform
+        self.restore = self.prepare.pseudoinverse()
+
+        source = self.prepare.apply(source)
+        self.source = source
+        self.landmarks = landmarks
+        self.dtype = np.dtype(dtype)
+        self.points = source.points.astype(dtype)
+
+        n_dims = source.n_dims
+        # Homogeneous dimension (1 extra for translation effects)
+        h_dims = n_dims + 1
+        n = source.n_points  # record number of points
+        self.n_dims, self.h_dims, self.n = n_dims, h_dims, n
+
+        self.vertex_normals = _VertexNormals(source.trilist, n, dtype=dtype)
+
+        M_s = node_arc_incidence_matrix(source)
+
+        # weight matrix
+        G = np.identity(h_dims)
+
+        self.M_kron_G_s = sp.kron(M_s, G).tocsr().astype(dtype)
+
+        if landmarks is not None:
+            self.source_lm_index = source.distance_to(
+                source.landmarks[landmarks].lms).argmin(axis=0)
+
+        # The sparsity pattern of A_s is fixed for the whole registration -
+        # only the values change. We build its CSR structure once (the
+        # stiffness rows, the D block with one row of h_dims entries per
+        # vertex and the landmark rows) and from then on just overwrite the
+        # matching slices of A_s.data. This also lets the solver reuse its
+        # symbolic analysis.
+        D_s = sp.csr_matrix((np.ones(n * h_dims, dtype=dtype),
+                             np.arange(n * h_dims),
+                             np.arange(0, n * h_dims + 1, h_dims)),
+                            shape=(n, n * h_dims))
+        to_stack_A = [self.M_kron_G_s, D_s]
+        if landmarks is not None:
+            to_stack_A.append(D_s[self.source_lm_index])
+        self.A_s = sp.vstack(to_stack_A, format='csr')
+        self.n_stiff_rows = self.M_kron_G_s.shape[0]
+        self.nnz_stiff = self.M_kron_G_s.nnz
+        self._coupled = None
+
+    def coupled_system(self):
+        r"""The stiffness term and sparsity structure of the system with a
+        point to plane data term, which couples the columns of ``X``.
+
+        The unknowns are ``X`` flattened (so the ``h_dims * n_dims`` entries
+        of the transform of each vertex are contiguous), and the row blocks
+        are the stiffness term, ``n_dims`` point to point rows and one point
+        to plane row per vertex and ``n_dims`` rows per landmark. Only built
+        (once) if needed.
+
+        Returns
+        -------
+        M_kron_G_s : `scipy.sparse.csr_matrix`
+            The stiffness term (for ``alpha`` of ``1``).
+        A_s : `scipy.sparse.csr_matrix`
+            The system matrix, with the stiffness term and the data term of
+            the template points in place.
+        """
+        if self._coupled is None:
+            n, h_dims, n_dims = self.n, self.h_dims, self.n_dims
+            n_x = n * h_dims * n_dims
+            M_kron_G_s = sp.kron(self.M_kron_G_s,
+                                 sp.identity(n_dims, dtype=self.dtype),
+                                 format='csr')
+            M_kron_G_s.sort_indices()
+            # point row n_dims * i + k has an entry for X[h_dims * i + a, k]
+            # for each a
+            columns = (h_dims * n_dims * np.arange(n)[:, None, None] +
+                       n_dims * np.arange(h_dims) +
+                       np.arange(n_dims)[:, None])
+            D_s = sp.csr_matrix((np.ones(n_x, dtype=self.dtype),
+                                 columns.ravel(),
+                                 np.arange(0, n_x + 1, h_dims)),
+                                shape=(n * n_dims, n_x))
+            # and plane row i has an entry for each of X[h_dims * i:, :]
+            N_s = sp.csr_matrix((np.ones(n_x, dtype=self.dtype),
+                                 np.arange(n_x),
+                                 np.arange(0, n_x + 1, h_dims * n_dims)),
+                                shape=(n, n_x))
+            to_stack_A = [M_kron_G_s, D_s, N_s]
+            if self.landmarks is not None:
+                to_stack_A.append(D_s[(n_dims * self.source_lm_index[:, None] +
+                                       np.arange(n_dims)).ravel()])
+            self._coupled = (M_kron_G_s,
+                             sp.vstack(to_stack_A, format='csr'))
+        return self._coupled
+
+
+def _normalize_rows(vectors, norms):
+    # Normalize each row of vectors in place (leaving zero rows as they are),
+    # with norms as scratch space
+    np.einsum('ij,ij->i', vectors, vectors, out=norms)
+    np.sqrt(norms, out=norms)
+    np.maximum(norms, np.finfo(norms.dtype).tiny, out=norms)
+    vectors /= norms[:, None]
+
+
+class _VertexNormals(object):
+    r"""The vertex normals of a deforming mesh of fixed topology, computed
+    into preallocated buffers.
+
+    As in :meth:`menpo.shape.TriMesh.vertex_normals`, the vertex normals are
+    the normalized sum of the (normalized) normals of the triangles around
+    each vertex - here that sum is a product with a sparse (n_points, n_tris)
+    face to vertex incidence matrix built once, accumulated into a buffer
+    that is returned (and overwritten) by every call.
+    """
+    def __init__(self, trilist, n_points, dtype=np.float64):
+        n_tris = trilist.shape[0]
+        self.corners = [np.ascontiguousarray(trilist[:, i]) for i in range(3)]
+        self.face_to_vertex = sp.csr_matrix(
+            (np.ones(3 * n_tris, dtype=dtype),
+             (trilist.T.ravel(), np.tile(np.arange(n_tris), 3))),
+            shape=(n_points, n_tris))
+        self._corner_points = np.empty((3, n_tris, 3), dtype=dtype)
+        self._face_normals = np.empty((n_tris, 3), dtype=dtype)
+        self._tri_scratch = np.empty(n_tris, dtype=dtype)
+        self._point_scratch = np.empty(n_points, dtype=dtype)
+        self._vertex_normals = np.empty((n_points, 3), dtype=dtype)
+
+    def __call__(self, points):
+        a, ab, ac = self._corner_points
+        for corner, out in zip(self.corners, self._corner_points):
+            np.take(points, corner, axis=0, out=out)
+        np.subtract(ab, a, out=ab)
+        np.subtract(ac, a, out=ac)
+        # the cross product ab x ac, one component at a time
+        normals, scratch = self._face_normals, self._tri_scratch
+        for i, (j, k) in enumerate(((1, 2), (2, 0), (0, 1))):
+            np.multiply(ab[:, j], ac[:, k], out=normals[:, i])
+            np.multiply(ab[:, k], ac[:, j], out=scratch)
+            normals[:, i] -= scratch
+        _normalize_rows(normals, scratch)
+        m = self.face_to_vertex
+        if csr_matvecs is None:
+            vertex_normals = m.dot(normals)
+        else:
+            vertex_normals = self._vertex_normals
+            vertex_normals.fill(0)
+            csr_matvecs(m.shape[0], m.shape[1], 3, m.indptr, m.indices,
+                        m.data, normals.ravel(), vertex_normals.ravel())
+        _normalize_rows(vertex_normals, self._point_scratch)
+        return vertex_normals
+
+
+def _crop(mesh, keep_tris):
+    # The sub-mesh of the triangles of mesh where keep_tris is True (and
+    # their vertices), and the index into mesh.trilist of each of its
+    # triangles
+    tri_map = np.flatnonzero(keep_tris)
+    if tri_map.size == 0:
+        raise ValueError('no triangles of the target are inside the region '
+                         'of interest')
+    trilist = mesh.trilist[tri_map]
+    used = np.unique(trilist)
+    point_map = np.empty(mesh.n_points, dtype=trilist.dtype)
+    point_map[used] = np.arange(used.size)
+    cropped = TriMesh(mesh.points[used], trilist=point_map[trilist])
+    for group in mesh.landmarks.group_labels:
+        cropped.landmarks[group] = mesh.landmarks[group]
+    return cropped, tri_map
+
+
+def _crop_target(template, target, crop_margin=None, crop_radius=None):
+    # Crop the target to the region the template can reach - the triangles
+    # that overlap the bounding box of the source grown by crop_margin
+    # and/or those with a vertex within crop_radius of a landmark (both as
+    # a proportion of the diagonal of the source). Returns the target (as
+    # is, if neither is set) and the index of each triangle of it into the
+    # original target (or None). Point cloud targets are cropped to the
+    # points in the same region, and their points indexed instead.
+    if crop_margin is None and crop_radius is None:
+        return target, None
+    if not isinstance(target, TriMesh):
+        return _crop_point_cloud(template, target, crop_margin=crop_margin,
+                                 crop_radius=crop_radius)
+    keep_tris = np.ones(target.n_tris, dtype=bool)
+    if crop_margin is not None:
+        margin = crop_margin * template.diagonal
+        lo, hi = template.bounds
+        tri_points = target.points[target.trilist]
+        keep_tris &= np.all(tri_points.max(axis=1) >= lo - margin, axis=1)
+        keep_tris &= np.all(tri_points.min(axis=1) <= hi + margin, axis=1)
+    if crop_radius is not None:
+        if template.landmarks is None:
+            raise ValueError('crop_radius requires landmarks')
+        lms = target.landmarks[template.landmarks].lms
+        near = (target.distance_to(lms).min(axis=1) <=
+                crop_radius * template.diagonal)
+        keep_tris &= near[target.trilist].any(axis=1)
+    return _crop(target, keep_tris)
+
+
+def _crop_point_cloud(template, target, crop_margin=None, crop_radius=None):
+    keep = np.ones(target.n_points, dtype=bool)
+    if crop_margin is not None:
+        margin = crop_margin * template.diagonal
+        lo, hi = template.bounds
+        keep &= np.all(target.points >= lo - margin, axis=1)
+        keep &= np.all(target.points <= hi + margin, axis=1)
+    if crop_radius is not None:
+        if template.landmarks is None:
+            raise ValueError('crop_radius requires landmarks')
+        lms = target.landmarks[template.landmarks].lms
+        keep &= (target.distance_to(lms).min(axis=1) <=
+                 crop_radius * template.diagonal)
+    point_map = np.flatnonzero(keep)
+    if point_map.size == 0:
+        raise ValueError('no points of the target are inside the region of '
+                         'interest')
+    cropped = PointCloud(target.points[point_map])
+    for group in target.landmarks.group_labels:
+        cropped.landmarks[group] = target.landmarks[group]
+    return cropped, point_map
+
+
+def _point_cloud_normals(locator, n_neighbours=10, outlier_threshold=3,
+                         boundary_threshold=0.4):
+    # Estimate the (unoriented) normal of each point of a point cloud by PCA
+    # of its neighbourhood, and flag the points whose neighbourhood is
+    # unreliable:
+    # - outliers, with a mean distance to their neighbours of more than
+    #   outlier_threshold times the median over the cloud (sparse points,
+    #   such as stray measurements)
+    # - boundary points, whose neighbours are to one side (with a centroid
+    #   more than boundary_threshold times their mean distance away)
+    points = locator.points
+    distances, indices = locator.nearest_neighbours(points, n_neighbours + 1)
+    neighbourhoods = points[indices]
+    centroids = neighbourhoods.mean(axis=1)
+    centred = neighbourhoods - centroids[:, None]
+    covariances = np.einsum('nki,nkj->nij', centred, centred)
+    # the normal is the direction of least variance
+    normals = np.linalg.eigh(covariances)[1][..., 0]
+    # (the first neighbour of each point is itself)
+    spacing = distances[:, 1:].mean(axis=1)
+    outliers = spacing > outlier_threshold * np.median(spacing)
+    offset = np.sqrt(((centroids - points) ** 2).sum(axis=1))
+    boundary = offset > boundary_threshold * spacing
+    return normals, outliers | boundary
+
+
+def _decimate(mesh, fraction):
+    # Quadric decimation of a TriMesh down to about fraction of its triangles
+    import vtk
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputData(trimesh_to_vtk(mesh))
+    decimate.SetTargetReduction(1 - fraction)
+    decimate.Update()
+    decimated = trimesh_from_vtk(decimate.GetOutput())
+    for group in mesh.landmarks.group_labels:
+        decimated.landmarks[group] = mesh.landmarks[group]
+    return decimated
+
+
+def _prolongation_operator(coarse, fine):
+    # The sparse (fine.n_points, coarse.n_points) operator that interpolates
+    # per-vertex values of the coarse mesh at the closest points on it to
+    # each vertex of the fine mesh
+    closest = VTKClosestPointLocator.from_trimesh(coarse).closest_points(
+        fine.points)
+    return barycentric_interpolation_operator(coarse, closest.bcoords,
+                                              closest.tri_indices)
+
+
+class _NICPHierarchy(object):
+    r"""The templates of a coarse-to-fine non-rigid ICP registration.
+
+    ``resolutions`` holds the proportion of the triangles of the source kept
+    for each stiffness value. Each run of equal consecutive values is
+    registered on its own decimated template (with the last at full
+    resolution), and the per-vertex transforms found on one level are
+    interpolated onto the next with a sparse prolongation operator.
+    """
+    def __init__(self, source, resolutions, landmarks=None, dtype=np.float64):
+        resolutions = list(resolutions)
+        if not resolutions or resolutions[-1] != 1:
+            raise ValueError('the last resolution must be 1 (the full '
+                             'resolution source)')
+        if any(not 0 < r <= 1 for r in resolutions):
+            raise ValueError('resolutions must be in (0, 1]')
+        self.resolutions = resolutions
+
+        # the levels, as slices of the stiffness values
+        self.slices, start = [], 0
+        for i in range(1, len(resolutions) + 1):
+            if i == len(resolutions) or resolutions[i] != resolutions[start]:
+                self.slices.append(slice(start, i))
+                start = i
+
+        full = _NICPTemplate(source, landmarks=landmarks, dtype=dtype)
+        meshes = [source if resolutions[s.start] == 1
+                  else _decimate(source, resolutions[s.start])
+                  for s in self.slices]
+        self.levels = [full if mesh is source else
+                       _NICPTemplate(mesh, landmarks=landmarks,
+                                     prepare=full.prepare, dtype=dtype)
+                       for mesh in meshes]
+        self.prolongations = [
+            _prolongation_operator(coarse.source, fine.source)
+            for coarse, fine in zip(self.levels[:-1], self.levels[1:])]
+
+
 def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
-                  verbose=False, landmarks=None, lm_weight=None):
+                  verbose=False, landmarks=None, lm_weight=None, n_workers=1,
+                  cache=False, self_intersection=False, approximate=None,
+                  sdf_resolution=32, solver='auto', resolutions=None,
+                  callback=None, max_iterations=None, min_improvement=None,
+                  adaptive_stiffness=False, dtype=np.float64, crop_margin=None,
+                  crop_radius=None, point_to_plane=0, n_neighbours=10):
     r"""
     Deforms the source trimesh to align with to optimally the target.
-    """
-    # Scale factors completely change the behavior of the algorithm - always
-    # rescale the source down to a sensible size (so it fits inside box of
-    # diagonal 1) and is centred on the origin. We'll undo this after the fit
-    # so the user can use whatever scale they prefer.
-    tr = Translation(-1 * source.centre())
-    sc = UniformScale(1.0 / np.sqrt(np.sum(source.range() ** 2)), 3)
-    prepare = tr.compose_before(sc)
 
-    source = prepare.apply(source)
-    target = prepare.apply(target)
+    The source and target are assumed to be rigidly aligned already (see
+    :func:`rigid_icp`).
 
-    # store how to undo the similarity transform
-    restore = prepare.pseudoinverse()
+    Parameters
+    ----------
+    source : :map:`TriMesh`
+        The template that is deformed.
+    target : :map:`TriMesh` or :map:`PointCloud`
+        The mesh to align to. An unmeshed point cloud (e.g. a depth sensor
+        capture) is matched to its nearest points (see
+        :map:`KDTreeClosestPointLocator`), with normals estimated from
+        ``n_neighbours`` neighbours and compared up to their sign. Outliers
+        and points on the boundary of the cloud take the place of boundary
+        triangles.
+    eps : `float`, optional
+        A stiffness level has converged when an iteration changes the
+        transforms by less than this.
+    stiffness_values : `list` of `float`, optional
+        The stiffness of each level, from the stiffest. If ``None``,
+        ``[50, 20, 5, 2, 0.8, 0.5, 0.35, 0.2]``.
+    verbose : `bool`, optional
+        If ``True``, the progress of each iteration is printed.
+    landmarks : `str`, optional
+        The landmark group of the source and target used as a constraint.
+    lm_weight : `list` of `float`, optional
+        The weight of the landmark constraint at each level. If ``None``,
+        ``[5, 2, .5, 0, 0, 0, 0, 0]``.
+    n_workers : `int` or ``None``, optional
+        The number of threads used for the closest point queries (one per CPU
+        if ``None``). With more than one, or a ``cache``, the closest points
+        are found by a :map:`BVHClosestPointLocator` rather than a
+        :map:`VTKClosestPointLocator`.
+    cache : :map:`BVHCache` or `bool`, optional
+        Where to look up the spatial index of the target, so that registering
+        against the same target again skips building it. ``True`` uses the
+        default cache, which keeps up to 512MB of indices alive for the rest
+        of the process.
+    self_intersection : `bool`, optional
+        If ``True``, correspondences whose segment from the source to the
+        target passes through the source itself are excluded.
+    approximate : `list` of `bool`, optional
+        One per level. Where ``True``, the closest points of that level are
+        looked up in a signed distance grid of the target (see
+        :map:`SDFClosestPointLocator`), which is much cheaper and usually
+        sufficient for the stiffest levels. Not supported for point clouds.
+    sdf_resolution : `int`, optional
+        The number of cells along the longest side of that grid.
+    solver : `str` or solver, optional
+        How the linear system of each iteration is solved: a solver of
+        :mod:`menpo3d.correspond.solvers` by name (``'cholmod'``,
+        ``'superlu'``, ``'cg'``, ``'lsqr'``), ``'auto'`` to pick one based on
+        the problem size, or a solver instance (which can't be used with
+        several ``resolutions``).
+    resolutions : `list` of `float`, optional
+        One per level, the proportion of the triangles of the source to
+        register with. The transforms found on a coarse level start the next
+        finer one. The last value must be ``1``.
+    callback : `callable`, optional
+        Called with each entry of ``'info'`` as soon as its iteration
+        completes.
+    max_iterations : `int`, optional
+        The maximum number of iterations of each level.
+    min_improvement : `float`, optional
+        A level ends when an iteration reduces the mean distance to the
+        correspondences by less than this proportion. The levels after one
+        that improves it by less than this are skipped, bar the last of each
+        resolution.
+    adaptive_stiffness : `bool`, optional
+        If ``True``, the level after one that converged in a single iteration
+        is skipped, and a level half way (geometrically) to the next is
+        inserted after one that reached ``max_iterations``.
+    dtype : `numpy.dtype`, optional
+        The floating point type of the points and the sparse system.
+        ``np.float32`` halves their memory use. Each solve and the results are
+        still in double precision.
+    crop_margin : `float`, optional
+        If given, the target is cropped to the triangles that overlap the
+        bounding box of the source grown by this proportion of its diagonal.
+        No correspondences are made with the cut edge.
+    crop_radius : `float`, optional
+        If given, the target is cropped to the triangles with a vertex within
+        this proportion of the diagonal of the source of one of the
+        ``landmarks`` of the target.
+    point_to_plane : `float`, optional
+        The weight, in ``[0, 1]``, of a point to plane data term (which leaves
+        vertices free to slide along the target) against the point to point
+        one. It costs about twice as much per iteration and takes as many
+        iterations on a template close to the target, but far fewer from a
+        coarse alignment.
+    n_neighbours : `int`, optional
+        The number of neighbours that the normals of a point cloud target
+        are estimated from.
 
-    n_dims = source.n_dims
-    # Homogeneous dimension (1 extra for translation effects)
-    h_dims = n_dims + 1
-    points, trilist = source.points, source.trilist
-    n = points.shape[0]  # record number of points
+    Returns
+    -------
+    result : `dict`
+        ``'deformed_source'``, ``'matched_target'`` and
+        ``'matched_tri_indices'`` (the points of the deformed source, their
+        correspondences and the triangles, or points of a point cloud, that
+        these lie on), ``'info'`` (one `dict` per iteration: its ``'level'``,
+        ``'residual'``, ``'n_points'``, timings, system size and
+        ``'peak_rss'``), ``'schedule'`` (one `dict` per level that was run:
+        its ``'alpha'``, ``'beta'``, ``'approximate'``, ``'iterations'``, the
+        reason it ended under ``'stop'`` and how many levels were
+        ``'skipped'`` after it),
+        ``'solver'`` (a timing report of the solver) and, with
+        ``landmarks``, ``'source_lm_index'``.
 
-    edge_tris = source.boundary_tri_index()
+    Raises
+    ------
+    ValueError
+        If the last of the ``resolutions`` is not ``1``, a solver instance is
+        used with several of them, or ``crop_radius`` is given without
+        ``landmarks``.
+    """
+    if resolutions is not None:
+        hierarchy = _NICPHierarchy(source, resolutions, landmarks=landmarks,
+                                   dtype=dtype)
+        return _non_rigid_icp_multiresolution(
+            hierarchy, target, eps=eps, stiffness_values=stiffness_values,
+            verbose=verbose, lm_weight=lm_weight, n_workers=n_workers,
+            cache=cache, self_intersection=self_intersection,
+            approximate=approximate, sdf_resolution=sdf_resolution,
+            solver=solver, callback=callback, max_iterations=max_iterations,
+            min_improvement=min_improvement,
+            adaptive_stiffness=adaptive_stiffness, crop_margin=crop_margin,
+            crop_radius=crop_radius, point_to_plane=point_to_plane,
+            n_neighbours=n_neighbours)
+    template = _NICPTemplate(source, landmarks=landmarks, dtype=dtype)
+    return _non_rigid_icp(template, target, eps=eps,
+                          stiffness_values=stiffness_values, verbose=verbose,
+                          lm_weight=lm_weight, n_workers=n_workers,
+                          cache=cache, self_intersection=self_intersection,
+                          approximate=approximate,
+                          sdf_resolution=sdf_resolution, solver=solver,
+                          callback=callback, max_iterations=max_iterations,
+                          min_improvement=min_improvement,
+                          adaptive_stiffness=adaptive_stiffness,
+                          crop_margin=crop_margin, crop_radius=crop_radius,
+                          point_to_plane=point_to_plane,
+                          n_neighbours=n_neighbours)
 
-    M_s = node_arc_incidence_matrix(source)
 
-    # weight matrix
-    G = np.identity(n_dims + 1)
+def _non_rigid_icp(template, target, eps=1e-3, stiffness_values=None,
+                   verbose=False, lm_weight=None, n_workers=1, cache=False,
+                   self_intersection=False, approximate=None,
+                   sdf_resolution=32, solver='auto', callback=None,
+                   max_iterations=None, min_improvement=None,
+                   adaptive_stiffness=False, crop_margin=None,
+                   crop_radius=None, point_to_plane=0, n_neighbours=10,
+                   transforms=None):
+    # The registration of a prepared template (see _NICPTemplate) to a
+    # target. If transforms - an (n, h_dims, n_dims) per-vertex affine
+    # transform of the (prepared) template - is given, the registration
+    # starts from the template deformed by it, and the accumulated transforms
+    # are returned under 'transforms'.
+    source = template.source
+    target, tri_map = _crop_target(template, target, crop_margin=crop_margin,
+                                   crop_radius=crop_radius)
+    target = template.prepare.apply(target)
+    restore = template.restore
+    landmarks = template.landmarks
 
-    M_kron_G_s = sp.kron(M_s, G)
+    n_dims, h_dims, n = template.n_dims, template.h_dims, template.n
+    points, dtype = template.points, template.dtype
+    vertex_normals = template.vertex_normals
+    M_kron_G_s = template.M_kron_G_s
 
-    # build octree for finding closest points on target.
-    target_vtk = trimesh_to_vtk(target)
-    closest_points_on_target = VTKClosestPointLocator(target_vtk)
+    # point cloud targets only have normals up to their sign
+    oriented_normals = isinstance(target, TriMesh)
+    if oriented_normals:
+        # build (or fetch) a BVH for finding closest points on target.
+        closest_points_on_target = closest_point_locator(
+            target, n_workers=n_workers, cache=cache)
+        # save out the target normals. We need them for the weight matrix.
+        target_normals = target.tri_normals().astype(dtype)
+        # and which triangles of the target are on its boundary
+        target_boundary = target.boundary_tri_index()
+    else:
+        if approximate is not None and any(approximate):
+            raise ValueError('approximate closest points are only supported '
+                             'for TriMesh targets')
+        # a KD-tree of the points, with estimated normals, and outliers and
+        # boundary points treated as the boundary of a mesh
+        closest_points_on_target = KDTreeClosestPointLocator.from_pointcloud(
+            target, n_workers=n_workers)
+        target_normals, target_boundary = _point_cloud_normals(
+            closest_points_on_target, n_neighbours=n_neighbours)
+        target_normals = target_normals.astype(dtype)
 
-    # save out the target normals. We need them for the weight matrix.
-    target_tri_normals = target.tri_normals()
+    if self_intersection:
+        # an intersector over the source that is refit as it deforms
+        intersect_source = BVHRayIntersector.from_trimesh(
+            source, n_workers=n_workers)
 
     # init transformation
-    X_prev = np.tile(np.zeros((n_dims, h_dims)), n).T
-    v_i = points
+    X_prev = np.zeros((n * h_dims, n_dims), dtype=dtype)
+    if transforms is None:
+        v_i = points.copy()
+    else:
+        v_i = _apply_vertex_transforms(points, transforms)
+        # the accumulated transforms are updated in place from a copy
+        transforms_prev = np.empty_like(transforms)
 
     if stiffness_values is not None:
         stiffness = stiffness_values
@@ -90,7 +597,7 @@ def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
     else:
         # these values have been empirically found to perform well for well
         # rigidly aligned facial meshes
-        stiffness = [50, 20, 5, 2, 0.8, 0.5, 0.35, 0.2]
+        stiffness = _default_stiffness
         if verbose:
             print('using default stiffness values: {}'.format(stiffness))
 
@@ -101,114 +608,271 @@ def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
     else:
         # these values have been empirically found to perform well for well
         # rigidly aligned facial meshes
-        lm_weight = [5,  2, .5, 0,   0,   0,    0,    0]
+        lm_weight = _default_lm_weight
         if verbose:
             print('using default lm_weight values: {}'.format(lm_weight))
 
-    # to store per iteration information
-    info = []
+    if approximate is None:
+        approximate = [False] * len(stiffness)
+    elif verbose:
+        print('using approximate closest points for levels: {}'.format(
+            approximate))
 
-    # we need to prepare some indices for efficient construction of the D
-    # sparse matrix.
-    row = np.hstack((np.repeat(np.arange(n)[:, None], n_dims, axis=1).ravel(),
-                     np.arange(n)))
+    if any(approximate):
+        # build a signed distance grid of the target for the approximate
+        # levels (with a cache, the exact locator's spatial index is reused)
+        approx_closest_points_on_target = SDFClosestPointLocator.from_trimesh(
+            target, resolution=sdf_resolution, n_workers=n_workers,
+            cache=cache)
 
-    x = np.arange(n * h_dims).reshape((n, h_dims))
-    col = np.hstack((x[:, :n_dims].ravel(),
-                     x[:, n_dims]))
+    # to store per iteration information
+    info = []
 
     if landmarks is not None:
         if verbose:
             print("'{}' landmarks will be used as a landmark constraint.".format(landmarks))
-        source_lm_index = source.distance_to(
-            source.landmarks[landmarks].lms).argmin(axis=0)
+        source_lm_index = template.source_lm_index
         target_lms = target.landmarks[landmarks].lms
-        U_L = target_lms.points
-        n_landmarks = target_lms.n_points
-        lm_mask = np.in1d(row, source_lm_index)
-        col_lm = col[lm_mask]
-        # pull out the rows for the lms - but the values are
-        # all wrong! need to map them back to the order of the landmarks
-        row_lm_to_fix = row[lm_mask]
-        source_lm_index_l = list(source_lm_index)
-        row_lm = np.array([source_lm_index_l.index(r) for r in row_lm_to_fix])
-
-    o = np.ones(n)
-
-    for alpha, beta in zip(stiffness, lm_weight):
-        alpha_M_kron_G_s = alpha * M_kron_G_s  # get the term for stiffness
+        U_L = target_lms.points.astype(dtype)
+
+    # A_s has a fixed sparsity pattern, see _NICPTemplate, and B_s is dense
+    # with the same row blocks
+    if point_to_plane:
+        M_kron_G_s, A_s = template.coupled_system()
+        A_s = A_s.copy()
+        n_stiff_rows, nnz_stiff = M_kron_G_s.shape[0], M_kron_G_s.nnz
+        n_x = n * h_dims * n_dims
+        D_data = A_s.data[nnz_stiff:nnz_stiff + n_x].reshape(n, n_dims, h_dims)
+        N_data = A_s.data[nnz_stiff + n_x:nnz_stiff + 2 * n_x].reshape(
+            n, h_dims, n_dims)
+        L_data = A_s.data[nnz_stiff + 2 * n_x:].reshape(-1, n_dims, h_dims)
+        B_s = np.zeros((A_s.shape[0], 1), dtype=dtype)
+        n_data_rows = n * n_dims
+        B_U = B_s[n_stiff_rows:n_stiff_rows + n_data_rows, 0].reshape(n, n_dims)
+        B_N = B_s[n_stiff_rows + n_data_rows:n_stiff_rows + n_data_rows + n, 0]
+        B_L = B_s[n_stiff_rows + n_data_rows + n:, 0].reshape(-1, n_dims)
+        # the split of the weight of each correspondence between the point
+        # to point and the point to plane rows
+        w_point = np.sqrt(1 - point_to_plane)
+        w_plane = np.sqrt(point_to_plane)
+        w_i_data = np.empty(n, dtype=dtype)
+    else:
+        A_s = template.A_s.copy()
+        n_stiff_rows, nnz_stiff = template.n_stiff_rows, template.nnz_stiff
+        D_data = A_s.data[nnz_stiff:nnz_stiff + n * h_dims].reshape(n, h_dims)
+        L_data = A_s.data[nnz_stiff + n * h_dims:].reshape(-1, h_dims)
+        B_s = np.zeros((A_s.shape[0], n_dims), dtype=dtype)
+        B_U = B_s[n_stiff_rows:n_stiff_rows + n]
+        B_L = B_s[n_stiff_rows + n:]
+
+    # each vertex in homogeneous coordinates
+    v_i_h = np.ones((n, h_dims), dtype=dtype)
+
+    # the per vertex quantities of each iteration are written to these
+    # buffers, as are the closest points and intersections found with a
+    # TriangleBVH. What still allocates every iteration is the solve, the
+    # candidate pairs of the BVH queries and the closest points found by the
+    # other locators.
+    u_i_n = np.empty((n, n_dims), dtype=dtype)
+    normals_dot = np.empty(n, dtype=dtype)
+    w_i, w_i_n, w_i_e = (np.empty(n, dtype=bool) for _ in range(3))
+    delta = np.empty((n * h_dims, n_dims), dtype=dtype)
+    residuals = np.empty((n, n_dims), dtype=dtype)
+    distances = np.empty(n, dtype=dtype)
+    if self_intersection:
+        starts = np.empty((n, n_dims), dtype=dtype)
+        hits = RayHitResult(np.empty(n, dtype=bool),
+                            np.empty(n, dtype=np.intp), np.empty(n))
+        w_i_i = np.empty(n, dtype=bool)
+    if isinstance(closest_points_on_target, BVHClosestPointLocator):
+        closest = ClosestPointResult(np.empty((n, n_dims)),
+                                     np.empty(n, dtype=np.intp),
+                                     np.empty(n), np.empty((n, n_dims)))
+
+        def exact_closest_points(points):
+            return closest_points_on_target.closest_points(points,
+                                                           out=closest)[:2]
+    else:
+        exact_closest_points = closest_points_on_target
+    if landmarks is not None:
+        v_lm_h = np.empty((len(source_lm_index), h_dims), dtype=dtype)
+
+    if point_to_plane and isinstance(solver, str) and solver == 'auto':
+        # A factorization of the coupled system has many times the fill of
+        # the point to point system, which is a good approximation of it - so
+        # by default we solve with conjugate gradients, preconditioned by a
+        # factorization of the point to point system (kept up to date here)
+        A_point = template.A_s.copy()
+        D_point_data = A_point.data[template.nnz_stiff:
+                                    template.nnz_stiff + n * h_dims].reshape(
+            n, h_dims)
+        L_point_data = A_point.data[template.nnz_stiff + n * h_dims:].reshape(
+            -1, h_dims)
+        solver = ConjugateGradientSolver(preconditioner_system=A_point)
+    else:
+        A_point = None
+        solver = build_solver(solver, n_unknowns=A_s.shape[1])
+    if verbose:
+        print('using the {} solver'.format(solver.name))
+
+    # warm start for iterative solvers - the identity transform for the
+    # first solve, then the previous solution
+    X_start = np.tile(np.eye(h_dims, n_dims), (n, 1))
+    if point_to_plane:
+        X_start = X_start.reshape(-1, 1)
+
+    # the levels still to run, as (alpha, beta, approximate, inserted) -
+    # with adaptive_stiffness levels are dropped from or added to this as the
+    # registration goes. The levels that were actually run are recorded in
+    # the schedule.
+    levels = [(alpha, beta, approx, False) for alpha, beta, approx
+              in zip(stiffness, lm_weight, approximate)]
+    schedule = []
+    # closest points found by an iteration that ended its level early, which
+    # are reused by the first iteration of the next level
+    reuse = None
+    level = 0
+    while level < len(levels):
+        alpha, beta, approx, inserted = levels[level]
+        # set the term for stiffness
+        np.multiply(M_kron_G_s.data, alpha, out=A_s.data[:nnz_stiff])
+        if A_point is not None:
+            np.multiply(template.M_kron_G_s.data, alpha,
+                        out=A_point.data[:template.nnz_stiff])
+        if approx:
+            find_closest_points = approx_closest_points_on_target
+        else:
+            find_closest_points = exact_closest_points
         j = 0
+        residual_first, residual_prev = None, None
+        stop = 'converged'
         while True:  # iterate until convergence
             # find nearest neighbour and the normals
-            U, tri_indices = closest_points_on_target(v_i)
+            t = time.time()
+            if reuse is not None and reuse[0] == approx:
+                U, tri_indices = reuse[1:]
+            else:
+                U, tri_indices = find_closest_points(v_i)
+            reuse = None
+            closest_points_time = time.time() - t
+
+            # Calculate the normals of the current v_i
+            t = time.time()
+            v_i_n = vertex_normals(v_i)
+            # Extract the corresponding normals from the target
+            np.take(target_normals, tri_indices, axis=0, out=u_i_n)
+            normals_time = time.time() - t
 
             # ---- WEIGHTS ----
+            t = time.time()
             # 1.  Edges
             # Are any of the corresponding tris on the edge of the target?
             # Where they are we return a false weight (we *don't* want to
             # include these points in the solve)
-            w_i_e = np.in1d(tri_indices, edge_tris, invert=True)
+            np.take(target_boundary, tri_indices, out=w_i_e)
+            np.logical_not(w_i_e, out=w_i_e)
 
             # 2. Normals
-            # Calculate the normals of the current v_i
-            v_i_tm = TriMesh(v_i, trilist=trilist, copy=False)
-            v_i_n = v_i_tm.vertex_normals()
-            # Extract the corresponding normals from the target
-            u_i_n = target_tri_normals[tri_indices]
             # If the dot of the normals is lt 0.9 don't contrib to deformation
-            w_i_n = (u_i_n * v_i_n).sum(axis=1) > 0.9
+            np.einsum('ij,ij->i', u_i_n, v_i_n, out=normals_dot)
+            if not oriented_normals:
+                np.abs(normals_dot, out=normals_dot)
+            np.greater(normals_dot, 0.9, out=w_i_n)
 
             # 3. Self-intersection
-            # This adds approximately 12% to the running cost and doesn't seem
-            # to be very critical in helping mesh fitting performance so for
-            # now it's removed. Revisit later.
-            # # Build an intersector for the current deformed target
-            # intersect = build_intersector(to_vtk(v_i_tm))
-            # # budge the source points 1% closer to the target
-            # source = v_i + ((U - v_i) * 0.5)
-            # # if the vector from source to target intersects the deformed
-            # # template we don't want to include it in the optimisation.
-            # problematic = [i for i, (s, t) in enumerate(zip(source, U))
-            #                if len(intersect(s, t)[0]) > 0]
-            # print(len(problematic) * 1.0 / n)
-            # w_i_i = np.ones(v_i_tm.n_points, dtype=np.bool)
-            # w_i_i[problematic] = False
+            if self_intersection:
+                intersect_source.refit(v_i)
+                # budge the source points 1% closer to the target so the
+                # segments don't start on the deformed template itself
+                np.subtract(U, v_i, out=starts)
+                starts *= 0.01
+                starts += v_i
+                # if the vector from source to target intersects the deformed
+                # template we don't want to include it in the optimisation.
+                intersect_source(starts, U, out=hits)
+                np.logical_not(hits.hits, out=w_i_i)
 
             # Form the overall w_i from the normals, edge case
-            w_i = np.logical_and(w_i_n, w_i_e)
-            # we could add self intersection at a later date too...
-            # w_i = np.logical_and(np.logical_and(w_i_n, w_i_e), w_i_i)
+            np.logical_and(w_i_n, w_i_e, out=w_i)
+            if self_intersection:
+                np.logical_and(w_i, w_i_i, out=w_i)
+            weights_time = time.time() - t
+
+            # the mean distance to the (included) correspondences
+            np.subtract(U, v_i, out=residuals)
+            np.einsum('ij,ij->i', residuals, residuals, out=distances)
+            np.sqrt(distances, out=distances)
+            residual = distances.dot(w_i) / max(w_i.sum(), 1)
+            if residual_first is None:
+                residual_first = residual
+            if (min_improvement is not None and residual_prev is not None and
+                    residual_prev - residual <
+                    min_improvement * residual_prev):
+                # the last iteration hardly moved the template any closer -
+                # move on to the next level
+                stop = 'min_improvement'
+                reuse = approx, U, tri_indices
+                break
+            residual_prev = residual
 
             prop_w_i = (n - w_i.sum() * 1.0) / n
             prop_w_i_n = (n - w_i_n.sum() * 1.0) / n
             prop_w_i_e = (n - w_i_e.sum() * 1.0) / n
+            if self_intersection:
+                prop_w_i_i = (n - w_i_i.sum() * 1.0) / n
             j = j + 1
 
-            # Build the sparse diagonal weight matrix
-            W_s = sp.diags(w_i.astype(np.float)[None, :], [0])
-
-            data = np.hstack((v_i.ravel(), o))
-            D_s = sp.coo_matrix((data, (row, col)))
-
-            # nullify the masked U values
-            U[~w_i] = 0
-
-            to_stack_A = [alpha_M_kron_G_s, W_s.dot(D_s)]
-            to_stack_B = [np.zeros((alpha_M_kron_G_s.shape[0], n_dims)), U]
+            # Update the values of the D block (with the weights applied)
+            t = time.time()
+            v_i_h[:, :n_dims] = v_i
+            if point_to_plane:
+                # the point to point rows of each vertex
+                np.multiply(w_i, w_point, out=w_i_data)
+                np.multiply(v_i_h[:, None, :], w_i_data[:, None, None],
+                            out=D_data)
+                np.multiply(U, w_i_data[:, None], out=B_U)
+                # and the point to plane row - the distance along the target
+                # normal, (v_i_h X_i - u_i) . n_i
+                np.multiply(w_i, w_plane, out=w_i_data)
+                np.multiply(v_i_h[:, :, None], u_i_n[:, None, :], out=N_data)
+                N_data *= w_i_data[:, None, None]
+                # (the closest points are always double precision)
+                np.einsum('ij,ij->i', U, u_i_n, out=normals_dot,
+                          casting='same_kind')
+                np.multiply(normals_dot, w_i_data, out=B_N)
+            else:
+                np.multiply(v_i_h, w_i[:, None], out=D_data)
+                # nullify the masked U values
+                np.multiply(U, w_i[:, None], out=B_U)
 
-            if landmarks:
-                D_L = sp.coo_matrix((data[lm_mask], (row_lm, col_lm)),
-                                    shape=(n_landmarks, D_s.shape[1]))
-                to_stack_A.append(beta * D_L)
-                to_stack_B.append(beta * U_L)
+            if landmarks is not None:
+                np.take(v_i_h, source_lm_index, axis=0, out=v_lm_h)
+                if point_to_plane:
+                    np.multiply(v_lm_h[:, None, :], beta, out=L_data)
+                else:
+                    np.multiply(v_lm_h, beta, out=L_data)
+                np.multiply(U_L, beta, out=B_L)
+            if A_point is not None:
+                np.multiply(v_i_h, w_i[:, None], out=D_point_data)
+                if landmarks is not None:
+                    np.multiply(v_lm_h, beta, out=L_point_data)
+            assembly_time = time.time() - t
 
-            A_s = sp.vstack(to_stack_A).tocsr()
-            B_s = sp.vstack(to_stack_B).tocsr()
-            X = spsolve(A_s, B_s)
+            # (solvers work in double precision whatever the dtype)
+            X_start = solver.solve(A_s, B_s, X0=X_start)
+            X = X_start.astype(dtype, copy=False).reshape(n * h_dims, n_dims)
 
             # deform template
-            v_i = D_s.dot(X)
-            err = np.linalg.norm(X_prev - X, ord='fro')
+            X_v = X.reshape(n, h_dims, n_dims)
+            np.einsum('ij,ijk->ik', v_i_h, X_v, out=v_i)
+            if transforms is not None:
+                # compose the step with the accumulated transforms
+                transforms, transforms_prev = transforms_prev, transforms
+                np.einsum('nij,njk->nik', transforms_prev, X_v[:, :n_dims],
+                          out=transforms)
+                transforms[:, n_dims] += X_v[:, n_dims]
+            np.subtract(X_prev, X, out=delta)
+            err = np.linalg.norm(delta.ravel())
 
             if landmarks is not None:
                 src_lms = v_i[source_lm_index]
@@ -218,6 +882,8 @@ def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
                 v_str = ('a: {}, ({}) - total : {:.0%} norms: {:.0%} '
                          'edges: {:.0%}'.format(alpha, j, prop_w_i,
                                                 prop_w_i_n, prop_w_i_e))
+                if self_intersection:
+                    v_str += ' intersections: {:.0%}'.format(prop_w_i_i)
                 if landmarks is not None:
                     v_str += ' beta: {}, lm_err: {:.5f}'.format(beta, lm_err)
 
@@ -229,16 +895,61 @@ def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
                 'prop_omitted': prop_w_i,
                 'prop_omitted_norms': prop_w_i_n,
                 'prop_omitted_edges': prop_w_i_e,
-                'delta': err
+                'delta': err,
+                'residual': residual,
+                'level': len(schedule),
+                'n_points': n,
+                'closest_points_time': closest_points_time,
+                'normals_time': normals_time,
+                'weights_time': weights_time,
+                'assembly_time': assembly_time,
+                'solve_time': solver.times[-1],
+                'A_shape': A_s.shape,
+                'A_nnz': A_s.nnz,
+                'peak_rss': _peak_rss()
             }
-            if landmarks:
+            if self_intersection:
+                info_dict['prop_omitted_intersections'] = prop_w_i_i
+            if landmarks is not None:
                 info_dict['beta'] = beta
                 info_dict['lm_err'] = lm_err
             info.append(info_dict)
+            if callback is not None:
+                callback(info_dict)
             X_prev = X
 
             if err / np.sqrt(np.size(X_prev)) < eps:
                 break
+            if max_iterations is not None and j >= max_iterations:
+                stop = 'max_iterations'
+                break
+
+        # the residual is found before every solve, and once more after the
+        # last one if the level stopped for want of improvement
+        n_residuals = j + 1 if stop == 'min_improvement' else j
+        skipped = 0
+        if (min_improvement is not None and n_residuals > 1 and
+                residual_first - residual < min_improvement * residual_first):
+            # the whole level hardly moved the template any closer - lower
+            # stiffness levels won't either, so go straight to the last
+            skipped = max(len(levels) - level - 2, 0)
+            del levels[level + 1:level + 1 + skipped]
+        schedule.append({'alpha': alpha, 'beta': beta, 'approximate': approx,
+                         'iterations': j, 'stop': stop, 'skipped': skipped})
+        if adaptive_stiffness and not skipped and level + 1 < len(levels):
+            if (j == 1 and stop != 'max_iterations' and
+                    level + 2 < len(levels)):
+                # converged straight away - the deformation at the next
+                # stiffness is (nearly) found too, so jump past it (the last
+                # level is never skipped)
+                del levels[level + 1]
+            elif stop == 'max_iterations' and not inserted:
+                # converging slowly - take a smaller step down in stiffness
+                # by inserting a level half way (geometrically) to the next
+                next_alpha = levels[level + 1][0]
+                levels.insert(level + 1, (float(np.sqrt(alpha * next_alpha)),
+                                          beta, approx, True))
+        level += 1
 
     # final result if we choose closest points
     point_corr = closest_points_on_target(v_i)[0]
@@ -246,11 +957,277 @@ def non_rigid_icp(source, target, eps=1e-3, stiffness_values=None,
     result = {
         'deformed_source': restore.apply(v_i),
         'matched_target': restore.apply(point_corr),
-        'matched_tri_indices': tri_indices,
-        'info': info
+        'matched_tri_indices': (tri_indices if tri_map is None
+                                else tri_map[tri_indices]),
+        'info': info,
+        'schedule': schedule,
+        'solver': solver.report()
     }
 
     if landmarks is not None:
         result['source_lm_index'] = source_lm_index
+    if transforms is not None:
+        result['transforms'] = transforms
 
     return result
+
+
+def _peak_rss():
+    # The peak resident set size of this process in bytes (None where it
+    # can't be found)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes, other than on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _apply_vertex_transforms(points, transforms):
+    # Apply an (n, n_dims + 1, n_dims) per-vertex affine transform
+    return (np.einsum('ij,ijk->ik', points, transforms[:, :-1]) +
+            transforms[:, -1])
+
+
+def _non_rigid_icp_multiresolution(hierarchy, target, stiffness_values=None,
+                                   lm_weight=None, approximate=None,
+                                   crop_margin=None, crop_radius=None,
+                                   **kwargs):
+    # The registration of a _NICPHierarchy to a target - each level is
+    # registered in turn, starting from the transforms of the level before
+    # (the target is cropped once, to the full resolution template)
+    target, tri_map = _crop_target(hierarchy.levels[-1], target,
+                                   crop_margin=crop_margin,
+                                   crop_radius=crop_radius)
+    stiffness = (_default_stiffness if stiffness_values is None
+                 else list(stiffness_values))
+    lm_weight = _default_lm_weight if lm_weight is None else list(lm_weight)
+    if approximate is None:
+        approximate = [False] * len(stiffness)
+    if len(hierarchy.resolutions) != len(stiffness):
+        raise ValueError('{} resolutions were provided for {} stiffness '
+                         'values'.format(len(hierarchy.resolutions),
+                                         len(stiffness)))
+    if (len(hierarchy.levels) > 1 and
+            isinstance(kwargs.get('solver'), SparseLeastSquaresSolver)):
+        # a solver keeps the ordering (or preconditioner) of the system it
+        # first solved, which is of a different size on every level
+        raise ValueError('a solver instance can only be used for a single '
+                         'resolution - pass the name of a solver instead')
+
+    info, schedule = [], []
+    transforms = None
+    for i, (level, s) in enumerate(zip(hierarchy.levels, hierarchy.slices)):
+        if transforms is None:
+            # start from the identity
+            transforms = np.tile(np.eye(level.h_dims, level.n_dims),
+                                 (level.n, 1, 1))
+        else:
+            P = hierarchy.prolongations[i - 1]
+            transforms = (P.dot(transforms.reshape(transforms.shape[0], -1))
+                          .reshape(level.n, level.h_dims, level.n_dims))
+        result = _non_rigid_icp(level, target, stiffness_values=stiffness[s],
+                                lm_weight=lm_weight[s],
+                                approximate=approximate[s],
+                                transforms=transforms, **kwargs)
+        transforms = result.pop('transforms')
+        for info_dict in result['info']:
+            info_dict['level'] += len(schedule)
+        info.extend(result['info'])
+        schedule.extend(result['schedule'])
+
+    # the last level is the full resolution template
+    result['info'] = info
+    result['schedule'] = schedule
+    if tri_map is not None:
+        result['matched_tri_indices'] = tri_map[result['matched_tri_indices']]
+    return result
+
+
+# os.replace is Python 3.3+ (os.rename only overwrites on POSIX)
+_replace = getattr(os, 'replace', os.rename)
+
+
+# The template shared by all registrations in a worker process of
+# non_rigid_icp_many, set once per process by the pool initializer
+_worker_template = None
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _result_path(results_dir, key):
+    return Path(results_dir) / '{}.pkl'.format(key)
+
+
+def _register(template, key, target, results_dir, kwargs):
+    if isinstance(target, (str, Path)):
+        from menpo3d.io import import_mesh
+        target = import_mesh(target)
+    if isinstance(template, _NICPHierarchy):
+        result = _non_rigid_icp_multiresolution(template, target, **kwargs)
+    else:
+        result = _non_rigid_icp(template, target, **kwargs)
+    if results_dir is not None:
+        # write then rename, so an interrupted run never leaves a partial
+        # result behind
+        path = _result_path(results_dir, key)
+        tmp_path = path.with_suffix('.tmp{}'.format(os.getpid()))
+        with open(str(tmp_path), 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        _replace(str(tmp_path), str(path))
+    return key, result
+
+
+def _register_in_worker(key, target, results_dir, kwargs):
+    return _register(_worker_template, key, target, results_dir, kwargs)
+
+
+def non_rigid_icp_many(template, targets, keys=None, results_dir=None,
+                       n_jobs=1, max_pending=None, landmarks=None, **kwargs):
+    r"""
+    Register a single template to many targets, yielding the results as they
+    become available.
+
+    Everything that only depends on the template (the rescaling, the
+    stiffness matrix, the normals accumulator, the sparsity structure of the
+    linear system and, with ``resolutions``, the decimated templates) is
+    computed once and shared by every registration. Worker processes are
+    sent it once each (on Python 3.7+, otherwise it is sent with every
+    target).
+
+    Parameters
+    ----------
+    template : :map:`TriMesh`
+        The source mesh that is deformed to each target.
+    targets : iterable of :map:`TriMesh` or `str` or `pathlib.Path`
+        The targets. Paths are imported with :func:`menpo3d.io.import_mesh`
+        in the worker that registers them, so only the paths themselves are
+        held by this process. Any iterable (such as a generator) can be used;
+        at most ``max_pending`` targets are consumed ahead of the results.
+    keys : iterable of `str`, optional
+        A name for each target, used to identify its result (so there must
+        be as many as there are targets). If ``None``, the stem of the file
+        name is used for paths and the zero padded position in ``targets``
+        otherwise.
+    results_dir : `str` or `pathlib.Path`, optional
+        If provided, each result is pickled to ``<results_dir>/<key>.pkl`` as
+        soon as it is available. Targets that already have a result there
+        (from an earlier, interrupted, run) are not registered again - their
+        stored result is yielded instead.
+    n_jobs : `int` or ``None``, optional
+        The number of worker processes. If ``1``, registrations run in this
+        process. If ``None``, one process per CPU is used. Worker processes
+        need `concurrent.futures` (the ``futures`` backport on Python 2).
+    max_pending : `int`, optional
+        The maximum number of registrations that are queued or running at
+        once, which bounds memory use. If ``None``, ``2 * n_jobs``.
+    landmarks : `str`, optional
+        The landmark group used as a constraint in every registration (it
+        must be present on the template and every target).
+    kwargs : `dict`, optional
+        Any other arguments of :func:`non_rigid_icp`, used for every
+        registration.
+
+    Yields
+    ------
+    key, result : `str`, `dict`
+        The key of a target and the result of :func:`non_rigid_icp` for it,
+        in the order that the registrations finish.
+
+    Raises
+    ------
+    ValueError
+        If there are fewer ``keys`` than ``targets``, or (for targets of a
+        known length) more.
+    """
+    if keys is not None:
+        keys = list(keys)
+        if hasattr(targets, '__len__') and len(targets) != len(keys):
+            raise ValueError('{} keys were provided for {} '
+                             'targets'.format(len(keys), len(targets)))
+    resolutions = kwargs.pop('resolutions', None)
+    dtype = kwargs.pop('dtype', np.float64)
+    if resolutions is not None:
+        prepared = _NICPHierarchy(template, resolutions, landmarks=landmarks,
+                                  dtype=dtype)
+    else:
+        prepared = _NICPTemplate(template, landmarks=landmarks, dtype=dtype)
+    if results_dir is not None:
+        results_dir = Path(results_dir)
+        if not results_dir.is_dir():
+            results_dir.mkdir(parents=True)
+
+    def keyed_targets():
+        for i, target in enumerate(targets):
+            if keys is not None:
+                if i == len(keys):
+                    raise ValueError('only {} keys were provided for more '
+                                     'targets'.format(len(keys)))
+                key = keys[i]
+            elif isinstance(target, (str, Path)):
+                key = Path(target).stem
+            else:
+                key = '{:06d}'.format(i)
+            yield key, target
+
+    def stored_result(key):
+        if results_dir is not None:
+            path = _result_path(results_dir, key)
+            if path.exists():
+                with open(str(path), 'rb') as f:
+                    return pickle.load(f)
+
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    if n_jobs == 1:
+        for key, target in keyed_targets():
+            result = stored_result(key)
+            if result is None:
+                result = _register(prepared, key, target, results_dir,
+                                   kwargs)[1]
+            yield key, result
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    if max_pending is None:
+        max_pending = 2 * n_jobs
+    pending = set()
+    try:
+        # send the prepared template to each worker once
+        pool = ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                   initargs=(prepared,))
+        shared = True
+    except TypeError:
+        # (initializers need Python 3.7+) - send it with every target
+        pool = ProcessPoolExecutor(n_jobs)
+        shared = False
+    try:
+        for key, target in keyed_targets():
+            result = stored_result(key)
+            if result is not None:
+                yield key, result
+                continue
+            if shared:
+                future = pool.submit(_register_in_worker, key, target,
+                                     results_dir, kwargs)
+            else:
+                future = pool.submit(_register, prepared, key, target,
+                                     results_dir, kwargs)
+            pending.add(future)
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # if the caller stops early, don't start any more registrations
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
@@ -0,0 +1,333 @@
+import shutil
+import tempfile
+import numpy as np
+from numpy.testing import assert_allclose
+from nose.tools import raises
+from menpo.shape import PointCloud, TriMesh
+from menpo.transform import Rotation, Translation
+import menpo3d
+from menpo3d.correspond import non_rigid_icp, non_rigid_icp_many
+from menpo3d.correspond.nicp import _VertexNormals
+from menpo3d.correspond.solvers import SuperLUSolver
+from menpo3d.vtkutils import closest_point_locator
+
+
+def deformed_bunnies(n):
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    centre = bunny.centre()
+    bumps = np.sin(20 * (bunny.points - centre))
+    return bunny, [TriMesh(bunny.points + 0.002 * (i + 1) * bumps,
+                           trilist=bunny.trilist) for i in range(n)]
+
+
+def test_non_rigid_icp_many_matches_non_rigid_icp():
+    bunny, targets = deformed_bunnies(2)
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0])
+    results = dict(non_rigid_icp_many(bunny, targets, **kwargs))
+    assert sorted(results) == ['000000', '000001']
+    for key, target in zip(['000000', '000001'], targets):
+        expected = non_rigid_icp(bunny, target, **kwargs)
+        assert_allclose(results[key]['deformed_source'],
+                        expected['deformed_source'])
+
+
+def test_non_rigid_icp_many_resumes_from_results_dir():
+    bunny, targets = deformed_bunnies(3)
+    kwargs = dict(stiffness_values=[50], lm_weight=[0])
+    results_dir = tempfile.mkdtemp()
+    try:
+        # interrupt the run after the first result
+        first_key, first = next(non_rigid_icp_many(
+            bunny, targets, results_dir=results_dir, **kwargs))
+        resumed = dict(non_rigid_icp_many(bunny, targets, n_jobs=2,
+                                          results_dir=results_dir, **kwargs))
+        assert len(resumed) == 3
+        assert_allclose(resumed[first_key]['deformed_source'],
+                        first['deformed_source'])
+    finally:
+        shutil.rmtree(results_dir)
+
+
+@raises(ValueError)
+def test_non_rigid_icp_many_too_few_keys_raises():
+    bunny, targets = deformed_bunnies(2)
+    next(non_rigid_icp_many(bunny, targets, keys=['only_one'],
+                            stiffness_values=[50], lm_weight=[0]))
+
+
+@raises(ValueError)
+def test_non_rigid_icp_many_too_few_keys_for_a_generator_raises():
+    bunny, targets = deformed_bunnies(2)
+    list(non_rigid_icp_many(bunny, (t for t in targets), keys=['only_one'],
+                            stiffness_values=[50], lm_weight=[0]))
+
+
+def test_non_rigid_icp_multiresolution_close_to_full_resolution():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20, 5, 2], lm_weight=[0] * 4)
+    full = non_rigid_icp(bunny, target, **kwargs)
+    multi = non_rigid_icp(bunny, target, resolutions=[0.25, 0.25, 1, 1],
+                          **kwargs)
+    n_points = [i['n_points'] for i in multi['info']]
+    assert n_points[0] < bunny.n_points and n_points[-1] == bunny.n_points
+    assert multi['deformed_source'].shape == bunny.points.shape
+    # both get (about) as close to the target
+    errors = [np.linalg.norm(r['deformed_source'] - target.points,
+                             axis=1).mean() for r in (full, multi)]
+    assert_allclose(errors[1], errors[0], rtol=0.2)
+
+
+@raises(ValueError)
+def test_non_rigid_icp_multiresolution_must_end_at_full_resolution():
+    bunny, (target,) = deformed_bunnies(1)
+    non_rigid_icp(bunny, target, stiffness_values=[50, 20], lm_weight=[0, 0],
+                  resolutions=[1, 0.5])
+
+
+@raises(ValueError)
+def test_non_rigid_icp_multiresolution_rejects_a_solver_instance():
+    bunny, (target,) = deformed_bunnies(1)
+    non_rigid_icp(bunny, target, stiffness_values=[50, 20, 5],
+                  lm_weight=[0] * 3, resolutions=[0.25, 0.25, 1],
+                  solver=SuperLUSolver())
+
+
+def test_non_rigid_icp_solver_instance_at_a_single_resolution():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0])
+    expected = non_rigid_icp(bunny, target, solver='superlu', **kwargs)
+    result = non_rigid_icp(bunny, target, resolutions=[1, 1],
+                           solver=SuperLUSolver(), **kwargs)
+    assert_allclose(result['deformed_source'], expected['deformed_source'])
+
+
+def test_non_rigid_icp_callback_receives_info():
+    bunny, (target,) = deformed_bunnies(1)
+    received = []
+    result = non_rigid_icp(bunny, target, stiffness_values=[50, 20],
+                           lm_weight=[0, 0], callback=received.append)
+    assert received == result['info']
+    for info in received:
+        assert info['closest_points_time'] >= 0
+        assert info['A_nnz'] > 0
+        assert info['A_shape'][1] == 4 * bunny.n_points
+
+
+def test_vertex_normals_match_trimesh():
+    bunny, (target,) = deformed_bunnies(1)
+    vertex_normals = _VertexNormals(bunny.trilist, bunny.n_points)
+    for mesh in (bunny, target):
+        assert_allclose(vertex_normals(mesh.points), mesh.vertex_normals(),
+                        atol=1e-12)
+
+
+def test_non_rigid_icp_max_iterations_caps_each_level():
+    bunny, (target,) = deformed_bunnies(1)
+    result = non_rigid_icp(bunny, target, stiffness_values=[50, 20],
+                           lm_weight=[0, 0], eps=1e-12, max_iterations=2)
+    assert [s['iterations'] for s in result['schedule']] == [2, 2]
+    assert [s['stop'] for s in result['schedule']] == ['max_iterations'] * 2
+    assert [i['level'] for i in result['info']] == [0, 0, 1, 1]
+
+
+def test_non_rigid_icp_adaptive_stiffness_inserts_levels():
+    bunny, (target,) = deformed_bunnies(1)
+    result = non_rigid_icp(bunny, target, stiffness_values=[50, 5],
+                           lm_weight=[0, 0], eps=1e-12, max_iterations=1,
+                           adaptive_stiffness=True)
+    alphas = [s['alpha'] for s in result['schedule']]
+    assert_allclose(alphas, [50, np.sqrt(250), 5])
+
+
+def test_non_rigid_icp_float32_close_to_float64():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20, 5], lm_weight=[0] * 3)
+    double = non_rigid_icp(bunny, target, **kwargs)['deformed_source']
+    single = non_rigid_icp(bunny, target, dtype=np.float32,
+                           **kwargs)['deformed_source']
+    diagonal = np.sqrt(np.sum(bunny.range() ** 2))
+    distances = np.linalg.norm(single - double, axis=1) / diagonal
+    assert distances.mean() < 1e-3
+    assert distances.max() < 1e-2
+
+
+def test_non_rigid_icp_crop_margin_ignores_clutter():
+    bunny, (target,) = deformed_bunnies(1)
+    # a copy of the target far outside of the template is clutter
+    clutter = target.points + 10 * bunny.range()
+    cluttered = TriMesh(np.vstack([clutter, target.points]),
+                        trilist=np.vstack([target.trilist,
+                                           target.trilist + bunny.n_points]))
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0])
+    expected = non_rigid_icp(bunny, target, **kwargs)
+    result = non_rigid_icp(bunny, cluttered, crop_margin=0.1, **kwargs)
+    # triangles are still indexed into the full (cluttered) target
+    assert_allclose(result['matched_tri_indices'] - bunny.n_tris,
+                    expected['matched_tri_indices'])
+    assert_allclose(result['deformed_source'], expected['deformed_source'])
+
+
+def test_non_rigid_icp_point_to_plane_matches_point_to_point_in_the_limit():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0])
+    expected = non_rigid_icp(bunny, target, **kwargs)
+    result = non_rigid_icp(bunny, target, point_to_plane=1e-12, **kwargs)
+    # (up to the tolerance of the iterative solve)
+    assert_allclose(result['deformed_source'], expected['deformed_source'],
+                    atol=1e-5)
+
+
+def test_non_rigid_icp_point_to_plane_closer_to_surface():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20, 5], lm_weight=[0] * 3)
+    distances = []
+    for point_to_plane in (0, 1):
+        result = non_rigid_icp(bunny, target, point_to_plane=point_to_plane,
+                               **kwargs)
+        distances.append(np.linalg.norm(result['deformed_source'] -
+                                        result['matched_target'],
+                                        axis=1).mean())
+    assert distances[1] < distances[0]
+
+
+def test_non_rigid_icp_point_to_plane_fewer_iterations_when_misaligned():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    centre = bunny.centre()
+    rotation = Rotation.init_from_3d_ccw_angle_around_y(6)
+    shift = 0.02 * bunny.range().max()
+    target = Translation(-centre).compose_before(rotation).compose_before(
+        Translation(centre + shift)).apply(bunny)
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0], eps=1e-4)
+    iterations = []
+    for point_to_plane in (0, 0.9):
+        result = non_rigid_icp(bunny, target, point_to_plane=point_to_plane,
+                               **kwargs)
+        iterations.append(sum(l['iterations'] for l in result['schedule']))
+    assert iterations[1] < iterations[0]
+
+
+def test_non_rigid_icp_point_cloud_target():
+    bunny, (target,) = deformed_bunnies(1)
+    cloud = PointCloud(target.points)
+    kwargs = dict(stiffness_values=[50, 20, 5], lm_weight=[0] * 3)
+    result = non_rigid_icp(bunny, cloud, **kwargs)
+    assert result['matched_tri_indices'].max() < cloud.n_points
+    # as the cloud is the vertices of the target, the template gets about as
+    # close to the target as with the mesh
+    errors = [np.linalg.norm(r['deformed_source'] - target.points,
+                             axis=1).mean()
+              for r in (result, non_rigid_icp(bunny, target, **kwargs))]
+    assert errors[0] < 1.5 * errors[1]
+
+
+def test_non_rigid_icp_float32_point_to_plane():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20], lm_weight=[0, 0],
+                  point_to_plane=0.5)
+    double = non_rigid_icp(bunny, target, **kwargs)['deformed_source']
+    single = non_rigid_icp(bunny, target, dtype=np.float32,
+                           **kwargs)['deformed_source']
+    diagonal = np.sqrt(np.sum(bunny.range() ** 2))
+    assert (np.linalg.norm(single - double, axis=1) / diagonal).mean() < 1e-3
+
+
+def test_non_rigid_icp_approximate_close_to_exact():
+    bunny, (target,) = deformed_bunnies(1)
+    kwargs = dict(stiffness_values=[50, 20, 5], lm_weight=[0] * 3)
+    exact = non_rigid_icp(bunny, target, **kwargs)['deformed_source']
+    deformation = np.linalg.norm(target.points - bunny.points, axis=1).mean()
+    differences = []
+    for approximate in ([True, True, True], [True, True, False]):
+        result = non_rigid_icp(bunny, target, approximate=approximate,
+                               **kwargs)
+        assert ([l['approximate'] for l in result['schedule']] ==
+                approximate)
+        differences.append(np.linalg.norm(result['deformed_source'] - exact,
+                                          axis=1).mean())
+    # both are a small fraction of the deformation away from the exact run,
+    # and switching to exact closest points for the last level gets closer
+    assert differences[0] < 0.2 * deformation
+    assert differences[1] < differences[0]
+
+
+def grid_trilist(n_u, n_v):
+    corners = np.arange(n_u * n_v).reshape(n_u, n_v)[:-1, :-1].ravel()
+    return np.vstack([
+        np.column_stack([corners, corners + n_v, corners + n_v + 1]),
+        np.column_stack([corners, corners + n_v + 1, corners + 1])])
+
+
+def test_non_rigid_icp_self_intersection_excludes_occluded_vertices():
+    # a sheet folded into a Z: a bottom and a top layer (at z = 0 and 1) that
+    # face up, and a middle layer (at z = 0.5) that faces down - swept along y
+    flat = np.linspace(0, 1, 11)[:-1]
+    rise = np.linspace(0, 0.5, 6)[:-1]
+    profile = np.vstack([np.column_stack([flat, np.zeros(10)]),
+                         np.column_stack([np.ones(5), rise]),
+                         np.column_stack([1 - flat, np.full(10, 0.5)]),
+                         np.column_stack([np.zeros(5), 0.5 + rise]),
+                         np.column_stack([np.linspace(0, 1, 11),
+                                          np.ones(11)])])
+    y = np.linspace(0, 1, 11)
+    points = np.column_stack([np.repeat(profile[:, 0], len(y)),
+                              np.tile(y, len(profile)),
+                              np.repeat(profile[:, 1], len(y))])
+    source = TriMesh(points, trilist=grid_trilist(len(profile), len(y)))
+    # a (slightly tilted) plane above it all - the segment from each vertex
+    # of the bottom layer to its closest point crosses the other two layers
+    x, y = np.meshgrid(np.linspace(-1, 2, 13), np.linspace(-1, 2, 13),
+                       indexing='ij')
+    target = TriMesh(np.column_stack([x.ravel(), y.ravel(),
+                                      (2 + 0.05 * x + 0.03 * y).ravel()]),
+                     trilist=grid_trilist(13, 13))
+    kwargs = dict(stiffness_values=[50], lm_weight=[0], max_iterations=1)
+    without = non_rigid_icp(source, target, **kwargs)['info'][0]
+    info = non_rigid_icp(source, target, self_intersection=True,
+                         **kwargs)['info'][0]
+    bottom = np.mean(points[:, 2] == 0)
+    top = np.mean(points[:, 2] == 1)
+    # (the middle layer faces away from the target, so it is already
+    # excluded by its normals)
+    assert info['prop_omitted_norms'] == without['prop_omitted_norms']
+    # the bottom layer (bar the vertices on its edges, whose segments pass
+    # by the layers above) is excluded too now, but not the top layer
+    assert 0.75 * bottom < info['prop_omitted'] - without['prop_omitted']
+    assert info['prop_omitted'] - without['prop_omitted'] <= bottom
+    assert info['prop_omitted'] <= 1 - top
+
+
+def test_non_rigid_icp_excludes_boundary_triangles_of_the_target():
+    # a closed template wouldn't do - the boundary of the template and of
+    # the target must differ. A large sheet over a small one: the vertices
+    # outside of the small sheet match the triangles on its boundary.
+    # (off the diagonals of the cells of the small sheet, so that there are
+    # no ties between triangles)
+    x, y = np.meshgrid(np.linspace(0.03, 1.93, 20),
+                       np.linspace(0.07, 1.97, 20), indexing='ij')
+    source = TriMesh(np.column_stack([x.ravel(), y.ravel(),
+                                      np.zeros(x.size)]),
+                     trilist=grid_trilist(20, 20))
+    x, y = np.meshgrid(np.linspace(0.5, 1.5, 11), np.linspace(0.5, 1.5, 11),
+                       indexing='ij')
+    target = TriMesh(np.column_stack([x.ravel(), y.ravel(),
+                                      np.full(x.size, 0.01)]),
+                     trilist=grid_trilist(11, 11))
+    info = non_rigid_icp(source, target, stiffness_values=[50],
+                         lm_weight=[0], max_iterations=1)['info'][0]
+    tri_indices = closest_point_locator(target)(source.points)[1]
+    expected = np.mean(target.boundary_tri_index()[tri_indices])
+    assert 0 < expected < 1
+    assert_allclose(info['prop_omitted_edges'], expected)
+
+
+def test_non_rigid_icp_min_improvement_skips_to_the_last_level():
+    bunny, (target,) = deformed_bunnies(1)
+    stiffness = [50, 20, 5, 2, 0.8]
+    result = non_rigid_icp(bunny, target, stiffness_values=stiffness,
+                           lm_weight=[0] * 5, eps=1e-6, min_improvement=0.05)
+    schedule = result['schedule']
+    skipped = [s['skipped'] for s in schedule]
+    assert any(skipped)
+    assert len(schedule) + sum(skipped) == len(stiffness)
+    # the last level is always run
+    assert schedule[-1]['alpha'] == stiffness[-1]
@@ -0,0 +1,438 @@
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+try:
+    try:
+        # First try the newer scikit-sparse namespace
+        from sksparse.cholmod import analyze_AAt
+    except ImportError:
+        # Fall back to the older scikits.sparse namespace
+        from scikits.sparse.cholmod import analyze_AAt
+    cholmod_available = True
+except ImportError:
+    cholmod_available = False
+
+
+class SparseLeastSquaresSolver(object):
+    r"""Base class for solvers of a sequence of sparse least squares problems
+    ``min ||A X - B||`` that all share the same sparsity pattern of ``A``
+    (such as the iterations of non-rigid ICP).
+
+    Subclasses implement ``_solve(A, B, X0)``. Every solve is timed, see
+    :meth:`report`. Problems are always solved in double precision - a single
+    precision ``A`` (or ``B``) is converted for each solve.
+    """
+    name = None
+
+    def __init__(self):
+        self.times = []
+        self.iterations = []
+
+    def solve(self, A, B, X0=None):
+        r"""Solve ``min ||A X - B||`` for ``X``.
+
+        Parameters
+        ----------
+        A : ``(n_rows, n_cols)`` `scipy.sparse.csr_matrix`
+            The system matrix. Must have the same sparsity pattern on every
+            call.
+        B : ``(n_rows, k)`` `ndarray`
+            The right hand side.
+        X0 : ``(n_cols, k)`` `ndarray`, optional
+            An initial guess at the solution. Only used by iterative solvers,
+            which converge in far fewer steps from a good guess.
+
+        Returns
+        -------
+        X : ``(n_cols, k)`` `ndarray`
+            The least squares solution (in double precision).
+        """
+        t = time.time()
+        if A.dtype != np.float64:
+            A = sp.csr_matrix((A.data.astype(np.float64), A.indices, A.indptr),
+                              shape=A.shape)
+        B = np.asarray(B, dtype=np.float64)
+        if X0 is not None:
+            X0 = np.asarray(X0, dtype=np.float64)
+        X = self._solve(A, B, X0)
+        self.times.append(time.time() - t)
+        return X
+
+    def report(self):
+        r"""A summary of the solves performed so far.
+
+        Returns
+        -------
+        report : `dict`
+            The solver ``name``, the number of solves (``n_solves``), their
+            ``total_time`` and ``mean_time`` in seconds and, for iterative
+            solvers, the total number of ``iterations``.
+        """
+        n_solves = len(self.times)
+        total = sum(self.times)
+        report = {'name': self.name,
+                  'n_solves': n_solves,
+                  'total_time': total,
+                  'mean_time': total / n_solves if n_solves else 0.0}
+        if self.iterations:
+            report['iterations'] = sum(self.iterations)
+        return report
+
+
+class CholmodSolver(SparseLeastSquaresSolver):
+    r"""Solves through the normal equations with a CHOLMOD Cholesky
+    factorization of ``A^T A``.
+
+    The fill-reducing ordering and symbolic factorization are computed on the
+    first solve, after which each solve is only a numeric refactorization.
+    """
+    name = 'cholmod'
+
+    def __init__(self):
+        if not cholmod_available:
+            raise ImportError('CholmodSolver requires scikit-sparse')
+        super(CholmodSolver, self).__init__()
+        self._factor = None
+
+    def _solve(self, A, B, X0):
+        # the transpose of a CSR matrix is a CSC matrix without any copying
+        A_T = A.T
+        if self._factor is None:
+            self._factor = analyze_AAt(A_T)
+        self._factor.cholesky_AAt_inplace(A_T)
+        return self._factor(np.asarray(A_T.dot(B)))
+
+
+class SuperLUSolver(SparseLeastSquaresSolver):
+    r"""Solves through the normal equations with a SuperLU factorization of
+    ``A^T A``.
+
+    A fill-reducing ordering of ``A^T A`` is computed on the first solve and
+    reused: the columns of every following ``A`` are permuted by it, so that
+    later solves only perform a numeric factorization (``A^T A`` is
+    symmetric positive definite, so no pivoting is needed).
+    """
+    name = 'superlu'
+
+    def __init__(self):
+        super(SuperLUSolver, self).__init__()
+        self._permutation = None
+
+    def _factorize(self, AtA, permc_spec):
+        from scipy.sparse.linalg import splu
+        AtA = AtA.tocsc()
+        # SuperLU relies on sorted row indices
+        AtA.sort_indices()
+        return splu(AtA, permc_spec=permc_spec, diag_pivot_thresh=0,
+                    options=dict(SymmetricMode=True))
+
+    def _solve(self, A, B, X0):
+        if self._permutation is None:
+            self._analyze(A)
+        A_p = sp.csr_matrix((A.data, self._inverse[A.indices], A.indptr),
+                            shape=A.shape)
+        lu = self._factorize(A_p.T.dot(A_p), 'NATURAL')
+        A_T_B = np.asarray(A.T.dot(B))
+        X = np.empty_like(A_T_B)
+        X[self._permutation] = lu.solve(A_T_B[self._permutation])
+        return X
+
+    def _analyze(self, A):
+        # The ordering must be found from the structure of A (including any
+        # explicit zeros), not just the current values - a zero weight can
+        # decouple the problem and lead to an ordering with terrible fill
+        # once the weight is non zero. We factorize a (well conditioned)
+        # matrix with the structure of A^T A just for its ordering.
+        pattern = sp.csr_matrix((np.ones_like(A.data), A.indices, A.indptr),
+                                shape=A.shape)
+        AtA = pattern.T.dot(pattern)
+        AtA = AtA + sp.identity(A.shape[1]) * (abs(AtA).sum(axis=1).max())
+        lu = self._factorize(AtA, 'MMD_AT_PLUS_A')
+        # SuperLU orders the columns by perm_c, so the same ordering is
+        # reproduced by permuting with its inverse.
+        self._permutation = np.argsort(lu.perm_c)
+        self._inverse = lu.perm_c
+
+
+class ConjugateGradientSolver(SparseLeastSquaresSolver):
+    r"""Solves the normal equations with preconditioned conjugate gradients,
+    warm started from ``X0``.
+
+    Two preconditioners are supported:
+
+    - ``'jacobi'`` (the diagonal of ``A^T A``) needs no factorization at
+      all, so memory use is minimal, but many iterations are needed for
+      stiff problems.
+    - ``'factorization'`` uses a (possibly stale) SuperLU factorization of
+      ``A^T A`` from an earlier solve. As ``A`` changes little from one
+      solve to the next (in non-rigid ICP only the weights and vertex
+      positions change) a stale factorization is an excellent
+      preconditioner, and only a handful of iterations are needed. A new
+      factorization is made whenever a solve takes more than
+      ``refactorize_after`` iterations.
+
+    The factorization can also be of a different, cheaper, system that
+    approximates ``A^T A`` - ``P^T P`` for a ``preconditioner_system`` ``P``
+    with ``k`` times fewer columns than ``A``, which acts on each of ``k``
+    interleaved blocks of the unknowns (i.e. approximates ``A^T A`` by the
+    Kronecker product of ``P^T P`` and the ``k`` by ``k`` identity).
+    ``P`` is read at each factorization, so its values may be updated in
+    place between solves.
+
+    If any column fails to converge within ``maxiter`` iterations, a warning
+    is raised and the whole system is solved directly instead (with a
+    :map:`SuperLUSolver`), and the preconditioning factorization is renewed
+    for the next solve.
+
+    Parameters
+    ----------
+    tol : `float`, optional
+        The relative residual at which each column is considered solved.
+    maxiter : `int`, optional
+        The maximum number of iterations per column. If ``None``, scipy's
+        default is used.
+    preconditioner : ``{'factorization', 'jacobi'}``, optional
+        The preconditioner to use.
+    refactorize_after : `int`, optional
+        For the ``'factorization'`` preconditioner, how many iterations (of
+        any column) a solve may take before the factorization is renewed.
+    preconditioner_system : `scipy.sparse.csr_matrix`, optional
+        For the ``'factorization'`` preconditioner, the system that is
+        factorized in place of ``A``.
+    """
+    name = 'cg'
+
+    def __init__(self, tol=1e-8, maxiter=None, preconditioner='factorization',
+                 refactorize_after=10, preconditioner_system=None):
+        super(ConjugateGradientSolver, self).__init__()
+        if preconditioner not in ('factorization', 'jacobi'):
+            raise ValueError("preconditioner must be 'factorization' or "
+                             "'jacobi'")
+        self.tol = tol
+        self.maxiter = maxiter
+        self.preconditioner = preconditioner
+        self.refactorize_after = refactorize_after
+        self.preconditioner_system = preconditioner_system
+        self.n_factorizations = 0
+        self._lu = None
+        self._lu_solver = SuperLUSolver()
+        self._refactorize = True
+        self.n_direct_solves = 0
+        self._direct_solver = None
+
+    def _factorization_preconditioner(self, A):
+        from scipy.sparse.linalg import LinearOperator
+        lu_solver = self._lu_solver
+        n_cols = A.shape[1]
+        if self.preconditioner_system is not None:
+            A = self.preconditioner_system
+        # the number of interleaved blocks the factorization acts on
+        k = n_cols // A.shape[1]
+        if self._refactorize:
+            if lu_solver._permutation is None:
+                lu_solver._analyze(A)
+            A_p = sp.csr_matrix((A.data.astype(np.float64, copy=False),
+                                 lu_solver._inverse[A.indices], A.indptr),
+                                shape=A.shape)
+            self._lu = lu_solver._factorize(A_p.T.dot(A_p), 'NATURAL')
+            self.n_factorizations += 1
+            self._refactorize = False
+        lu, permutation = self._lu, lu_solver._permutation
+
+        def matvec(x):
+            x = x.reshape(-1, k)
+            y = np.empty_like(x)
+            y[permutation] = lu.solve(x[permutation])
+            return y.ravel()
+
+        return LinearOperator((n_cols, n_cols), matvec=matvec,
+                              dtype=np.float64)
+
+    def _jacobi_preconditioner(self, AtA):
+        from scipy.sparse.linalg import LinearOperator
+        diagonal = AtA.diagonal()
+        diagonal[diagonal == 0] = 1
+        inv_diagonal = 1.0 / diagonal
+        return LinearOperator(AtA.shape, matvec=lambda x: inv_diagonal * x,
+                              dtype=AtA.dtype)
+
+    def _solve(self, A, B, X0):
+        from scipy.sparse.linalg import cg
+        AtA = A.T.dot(A).tocsr()
+        A_T_B = np.asarray(A.T.dot(B))
+        if self.preconditioner == 'factorization':
+            M = self._factorization_preconditioner(A)
+        else:
+            M = self._jacobi_preconditioner(AtA)
+        X = np.empty_like(A_T_B)
+        for j in range(A_T_B.shape[1]):
+            counter = _IterationCounter()
+            x0 = None if X0 is None else X0[:, j]
+            X[:, j], info = _call_with_tol(cg, AtA, A_T_B[:, j], self.tol,
+                                           x0=x0, M=M, maxiter=self.maxiter,
+                                           callback=counter)
+            self.iterations.append(counter.count)
+            if counter.count > self.refactorize_after:
+                self._refactorize = True
+            if info != 0:
+                warnings.warn('conjugate gradients did not converge in {} '
+                              'iterations (info={}), falling back to a '
+                              'direct solve'.format(counter.count, info))
+                self._refactorize = True
+                return self._solve_directly(A, B)
+        return X
+
+    def _solve_directly(self, A, B):
+        # (a solver of its own, as the ordering of the preconditioner may be
+        # that of the preconditioner_system rather than of A)
+        if self._direct_solver is None:
+            self._direct_solver = SuperLUSolver()
+        self.n_direct_solves += 1
+        return self._direct_solver._solve(A, B, None)
+
+    def report(self):
+        report = super(ConjugateGradientSolver, self).report()
+        if self.preconditioner == 'factorization':
+            report['n_factorizations'] = self.n_factorizations
+        report['n_direct_solves'] = self.n_direct_solves
+        return report
+
+
+class LSQRSolver(SparseLeastSquaresSolver):
+    r"""Solves the least squares problem directly (without forming the normal
+    equations) with LSQR, warm started from ``X0``.
+
+    Parameters
+    ----------
+    tol : `float`, optional
+        Used as both the ``atol`` and ``btol`` stopping tolerances of LSQR.
+    iter_lim : `int`, optional
+        The maximum number of iterations per column. If ``None``, scipy's
+        default is used.
+    """
+    name = 'lsqr'
+
+    def __init__(self, tol=1e-8, iter_lim=None):
+        super(LSQRSolver, self).__init__()
+        self.tol = tol
+        self.iter_lim = iter_lim
+
+    def _solve(self, A, B, X0):
+        from scipy.sparse.linalg import lsqr
+        B = np.asarray(B)
+        X = np.empty((A.shape[1], B.shape[1]))
+        for j in range(B.shape[1]):
+            x0 = None if X0 is None else X0[:, j]
+            result = lsqr(A, B[:, j], atol=self.tol, btol=self.tol,
+                          iter_lim=self.iter_lim, x0=x0)
+            X[:, j] = result[0]
+            self.iterations.append(result[2])
+        return X
+
+
+class _IterationCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, xk):
+        self.count += 1
+
+
+def _call_with_tol(method, A, b, tol, **kwargs):
+    # scipy renamed the relative tolerance of its Krylov solvers from tol to
+    # rtol (and later removed tol)
+    try:
+        return method(A, b, rtol=tol, **kwargs)
+    except TypeError:
+        return method(A, b, tol=tol, **kwargs)
+
+
+# The available solvers by name, see register_solver
+solvers = OrderedDict()
+
+
+def register_solver(name, solver_class):
+    r"""Make a :map:`SparseLeastSquaresSolver` subclass available by name
+    (e.g. to the ``solver`` argument of ``non_rigid_icp``).
+
+    Parameters
+    ----------
+    name : `str`
+        The name of the solver.
+    solver_class : `callable`
+        Called with no arguments to build a new solver.
+    """
+    solvers[name] = solver_class
+
+
+if cholmod_available:
+    register_solver('cholmod', CholmodSolver)
+register_solver('superlu', SuperLUSolver)
+register_solver('cg', ConjugateGradientSolver)
+register_solver('lsqr', LSQRSolver)
+
+# Without CHOLMOD, problems with more unknowns than this are solved with
+# conjugate gradients preconditioned by a stale factorization rather than by
+# factorizing every time.
+auto_direct_max_unknowns = 40000
+
+
+def auto_solver_name(n_unknowns):
+    r"""The name of the solver that ``'auto'`` picks for a problem with
+    ``n_unknowns`` unknowns: CHOLMOD when scikit-sparse is installed,
+    otherwise SuperLU for small problems and conjugate gradients (with a
+    reused factorization as preconditioner) for large ones.
+
+    Parameters
+    ----------
+    n_unknowns : `int`
+        The number of columns of ``A``.
+
+    Returns
+    -------
+    name : `str`
+        The name of a registered solver.
+    """
+    if cholmod_available:
+        return 'cholmod'
+    elif n_unknowns <= auto_direct_max_unknowns:
+        return 'superlu'
+    else:
+        return 'cg'
+
+
+def build_solver(solver='auto', n_unknowns=None):
+    r"""Return a new solver.
+
+    Parameters
+    ----------
+    solver : `str` or :map:`SparseLeastSquaresSolver`, optional
+        The name of a registered solver, ``'auto'`` (see
+        :func:`auto_solver_name`) or a solver instance (which is returned as
+        is).
+    n_unknowns : `int`, optional
+        The number of unknowns, used by ``'auto'``.
+
+    Returns
+    -------
+    solver : :map:`SparseLeastSquaresSolver`
+        The solver.
+
+    Raises
+    ------
+    ValueError
+        If no solver is registered under the given name.
+    """
+    if isinstance(solver, SparseLeastSquaresSolver):
+        return solver
+    if solver == 'auto':
+        solver = auto_solver_name(n_unknowns)
+    if solver not in solvers:
+        raise ValueError('Unknown solver {}, expected one of '
+                         '{}'.format(solver, ['auto'] + list(solvers)))
+    return solvers[solver]()
@@ -0,0 +1,54 @@
+import warnings
+import numpy as np
+import scipy.sparse as sp
+from numpy.testing import assert_allclose
+from nose.tools import raises
+from menpo3d.correspond.solvers import (build_solver, solvers,
+                                        ConjugateGradientSolver)
+
+
+def random_problem(seed):
+    rng = np.random.RandomState(seed)
+    A = sp.random(300, 60, density=0.05, random_state=rng, format='csr')
+    # keep the problem well posed
+    A = sp.vstack([A, sp.identity(60)], format='csr')
+    return A, rng.randn(A.shape[0], 3)
+
+
+def test_solvers_match_dense_least_squares():
+    A, B = random_problem(0)
+    expected = np.linalg.lstsq(A.toarray(), B, rcond=None)[0]
+    for name in solvers:
+        solver = build_solver(name)
+        assert_allclose(solver.solve(A, B), expected, atol=1e-6)
+
+
+def test_solvers_reuse_structure_across_solves():
+    A, B = random_problem(1)
+    for name in solvers:
+        solver = build_solver(name)
+        X = None
+        for scale in [1, 2, 3]:
+            A_scaled = A.copy()
+            A_scaled.data[:10] *= scale
+            expected = np.linalg.lstsq(A_scaled.toarray(), B, rcond=None)[0]
+            X = solver.solve(A_scaled, B, X0=X)
+            assert_allclose(X, expected, atol=1e-6)
+        assert solver.report()['n_solves'] == 3
+
+
+@raises(ValueError)
+def test_build_solver_unknown_name_raises():
+    build_solver('not_a_solver')
+
+
+def test_cg_falls_back_to_a_direct_solve_when_not_converged():
+    A, B = random_problem(2)
+    expected = np.linalg.lstsq(A.toarray(), B, rcond=None)[0]
+    solver = ConjugateGradientSolver(maxiter=1, preconditioner='jacobi')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        X = solver.solve(A, B)
+    assert len(caught) == 1
+    assert_allclose(X, expected, atol=1e-6)
+    assert solver.report()['n_direct_solves'] == 1
@@ -58,27 +58,17 @@ def _construct_shape_type(points, trilist, tcoords, texture, colour_per_vertex):
 
 def vtk_ensure_trilist(polydata):
     try:
-        import vtk
-        from vtk.util.numpy_support import vtk_to_numpy
+        from menpo3d.vtkutils import vtk_trilist_to_numpy, triangulate_vtk
 
-        trilist = vtk_to_numpy(polydata.GetPolys().GetData())
-
-        # 5 is the triangle type - if we have another type we need to
-        # use a vtkTriangleFilter
-        c = vtk.vtkCellTypes()
-        polydata.GetCellTypes(c)
-
-        if c.GetNumberOfTypes() != 1 or polydata.GetCellType(0) != 5:
+        triangulated = triangulate_vtk(polydata)
+        if triangulated is not polydata:
             warnings.warn('Non-triangular mesh connectivity was detected - '
                           'this is currently unsupported and thus the '
                           'connectivity is being coerced into a triangular '
                           'mesh. This may have unintended consequences.')
-            t_filter = vtk.vtkTriangleFilter()
-            t_filter.SetInputData(polydata)
-            t_filter.Update()
-            trilist = vtk_to_numpy(t_filter.GetOutput().GetPolys().GetData())
+            polydata = triangulated
 
-        return trilist.reshape([-1, 4])[:, 1:]
+        return vtk_trilist_to_numpy(polydata)
     except Exception as e:
         warnings.warn(str(e))
         return None
@@ -128,7 +118,8 @@ def wrl_importer(filepath, asset=None, texture_resolver=None, **kwargs):
     polydata = vtk.vtkPolyData.SafeDownCast(mapper_dataset)
 
     # We must have point data!
-    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float)
+    points = np.require(vtk_to_numpy(polydata.GetPoints().GetData()),
+                        dtype=np.float64)
 
     trilist = vtk_ensure_trilist(polydata)
 
@@ -196,7 +187,8 @@ def obj_importer(filepath, asset=None, texture_resolver=None, **kwargs):
     polydata = obj_importer.GetOutput()
 
     # We must have point data!
-    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float)
+    points = np.require(vtk_to_numpy(polydata.GetPoints().GetData()),
+                        dtype=np.float64)
 
     trilist = np.require(vtk_ensure_trilist(polydata), requirements=['C'])
 
@@ -254,7 +246,8 @@ def ply_importer(filepath, asset=None, texture_resolver=None, **kwargs):
     polydata = ply_importer.GetOutput()
 
     # We must have point data!
-    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float)
+    points = np.require(vtk_to_numpy(polydata.GetPoints().GetData()),
+                        dtype=np.float64)
 
     trilist = np.require(vtk_ensure_trilist(polydata), requirements=['C'])
 
@@ -308,7 +301,8 @@ def stl_importer(filepath, asset=None, **kwargs):
     polydata = stl_importer.GetOutput()
 
     # We must have point data!
-    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float)
+    points = np.require(vtk_to_numpy(polydata.GetPoints().GetData()),
+                        dtype=np.float64)
     trilist = np.require(vtk_ensure_trilist(polydata), requirements=['C'])
 
     colour_per_vertex = None
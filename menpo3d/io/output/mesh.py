@@ -1,5 +1,3 @@
-import numpy as np
-
 from menpo.io.output.base import _enforce_only_paths_supported
 from menpo.shape.mesh import TexturedTriMesh
 
@@ -60,21 +58,12 @@ def ply_exporter(mesh, file_path, binary=False, **kwargs):
         Specify whether to format output in binary or ascii, defaults to False
     """
     import vtk
-    from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
+    from vtk.util.numpy_support import numpy_to_vtk
+    from menpo3d.vtkutils import trimesh_to_vtk
 
     file_path = _enforce_only_paths_supported(file_path, 'PLY')
 
-    polydata = vtk.vtkPolyData()
-    points = vtk.vtkPoints()
-    points.SetData(numpy_to_vtk(mesh.points))
-    polydata.SetPoints(points)
-
-    cells = vtk.vtkCellArray()
-    counts = np.empty((mesh.trilist.shape[0], 1), dtype=np.int)
-    counts.fill(3)
-    tris = np.concatenate((counts, mesh.trilist), axis=1)
-    cells.SetCells(mesh.trilist.shape[0], numpy_to_vtkIdTypeArray(tris))
-    polydata.SetPolys(cells)
+    polydata = trimesh_to_vtk(mesh)
 
     if isinstance(mesh, TexturedTriMesh):
         pointdata = polydata.GetPointData()
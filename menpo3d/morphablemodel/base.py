@@ -1,4 +1,5 @@
 import numpy as np
+from menpo.model import PCAModel
 from menpo.shape import ColouredTriMesh
 from menpo.transform import UniformScale
 
@@ -40,3 +41,154 @@ class ColouredMorphableModel(object):
         trimesh.landmarks[landmark_group] = landmarks
 
         return trimesh
+
+    def instances(self, alphas=None, betas=None, model_type='bfm',
+                  max_memory=None):
+        r"""
+        Generate the shapes and colours of many instances at once.
+
+        Unlike :meth:`instance`, no :map:`ColouredTriMesh` is built: each of
+        the shape and texture instances is a single matrix product of the
+        (normalized) weights with the model components.
+
+        Parameters
+        ----------
+        alphas : ``(n_instances, n_alphas)`` `ndarray`, optional
+            The normalized shape weights of each instance, for the first
+            ``n_alphas`` components of the shape model (the rest are zero). If
+            ``None``, the mean shape is used for every instance.
+        betas : ``(n_instances, n_betas)`` `ndarray`, optional
+            The normalized texture weights of each instance, as for
+            ``alphas``.
+        model_type : ``{'bfm', 'lsfm'}``, optional
+            As for :meth:`instance`, the colours of ``'bfm'`` models are
+            scaled to ``[0, 1]``.
+        max_memory : `int`, optional
+            If given, a generator is returned instead, yielding the instances
+            in consecutive chunks of the shapes and colours that take at most
+            this many bytes (or a single instance each, if that doesn't fit).
+
+        Returns
+        -------
+        shapes : ``(n_instances, n_points, 3)`` `ndarray`
+            The points of each instance.
+        colours : ``(n_instances, n_points, 3)`` `ndarray`
+            The colours of each instance.
+
+        Raises
+        ------
+        ValueError
+            If ``alphas`` and ``betas`` don't have the same number of rows, or
+            more weights than their model has components.
+        """
+        alphas, betas = self._instances_weights(alphas, betas)
+        if max_memory is None:
+            return self._instances(alphas, betas, model_type)
+        n_features = (_mean_vector(self.shape_model).size +
+                      _mean_vector(self.texture_model).size)
+        itemsize = np.result_type(self.shape_model.components,
+                                  self.texture_model.components).itemsize
+        chunk_size = max(int(max_memory // (n_features * itemsize)), 1)
+        return self._instances_chunks(alphas, betas, model_type, chunk_size)
+
+    def instance_vertices(self, vertex_indices, alpha=None, beta=None,
+                          model_type='bfm'):
+        r"""
+        Generate the points and colours of an instance at some of its
+        vertices only.
+
+        Only the rows of the model components for those vertices are used,
+        so the cost is proportional to the number of vertices asked for
+        rather than to the size of the model.
+
+        Parameters
+        ----------
+        vertex_indices : ``(n_vertices,)`` `ndarray`
+            The indices of the vertices to generate.
+        alpha : ``(n_alphas,)`` `ndarray`, optional
+            The normalized weights of the first ``n_alphas`` shape components.
+            If ``None``, the mean shape is used.
+        beta : ``(n_betas,)`` `ndarray`, optional
+            The normalized weights of the first ``n_betas`` texture
+            components. If ``None``, the mean texture is used.
+        model_type : ``{'bfm', 'lsfm'}``, optional
+            As for :meth:`instance`.
+
+        Returns
+        -------
+        points : ``(n_vertices, 3)`` `ndarray`
+            The points of the instance at ``vertex_indices``.
+        colours : ``(n_vertices, 3)`` `ndarray`
+            The colours of the instance at ``vertex_indices``.
+        """
+        alphas, betas = self._instances_weights(
+            None if alpha is None else np.asarray(alpha)[None],
+            None if beta is None else np.asarray(beta)[None])
+        features = (3 * np.asarray(vertex_indices)[:, None] +
+                    np.arange(3)).ravel()
+        points = _instance_vectors(self.shape_model, alphas,
+                                   features=features)
+        colours = _instance_vectors(self.texture_model, betas,
+                                    features=features)
+        if model_type == 'bfm':
+            colours *= 1. / 255
+        return points.reshape([-1, 3]), colours.reshape([-1, 3])
+
+    def _instances_weights(self, alphas, betas):
+        if alphas is None and betas is None:
+            alphas = np.zeros((1, 0))
+        if alphas is None:
+            alphas = np.zeros((len(betas), 0))
+        if betas is None:
+            betas = np.zeros((len(alphas), 0))
+        alphas = np.atleast_2d(alphas)
+        betas = np.atleast_2d(betas)
+        if alphas.shape[0] != betas.shape[0]:
+            raise ValueError('alphas and betas must have the same number of '
+                             'rows ({} != {})'.format(alphas.shape[0],
+                                                      betas.shape[0]))
+        for weights, model in ((alphas, self.shape_model),
+                               (betas, self.texture_model)):
+            if weights.shape[1] > model.n_active_components:
+                raise ValueError(
+                    'Number of weightings cannot be greater than '
+                    '{}'.format(model.n_active_components))
+        return alphas, betas
+
+    def _instances_chunks(self, alphas, betas, model_type, chunk_size):
+        for i in range(0, alphas.shape[0], chunk_size):
+            yield self._instances(alphas[i:i + chunk_size],
+                                  betas[i:i + chunk_size], model_type)
+
+    def _instances(self, alphas, betas, model_type):
+        shapes = _instance_vectors(self.shape_model, alphas)
+        colours = _instance_vectors(self.texture_model, betas)
+        if model_type == 'bfm':
+            colours *= 1. / 255
+        n_instances = alphas.shape[0]
+        return (shapes.reshape([n_instances, -1, 3]),
+                colours.reshape([n_instances, -1, 3]))
+
+
+def _instance_vectors(model, weights, features=None):
+    # the instance vectors of a PCA model for normalized weights of its first
+    # components, as a single GEMM (with the mean added in place), optionally
+    # for only some of the features
+    n_weights = weights.shape[1]
+    scaled = weights * np.sqrt(model.eigenvalues[:n_weights])
+    components = model.components[:n_weights]
+    mean = _mean_vector(model)
+    if features is not None:
+        components = components[:, features]
+        mean = mean[features]
+    vectors = scaled.dot(components)
+    vectors += mean
+    return vectors
+
+
+def _mean_vector(model):
+    # PCAModel (of shapes) and PCAVectorModel (of vectors) expose their means
+    # differently
+    if isinstance(model, PCAModel):
+        return model.mean_vector
+    return model.mean()
@@ -0,0 +1,51 @@
+import numpy as np
+from numpy.testing import assert_allclose
+from nose.tools import raises
+from menpo.model import PCAModel, PCAVectorModel
+from menpo.shape import PointCloud, TriMesh
+from menpo3d.morphablemodel import ColouredMorphableModel
+
+rng = np.random.RandomState(0)
+trilist = np.array([[0, 1, 2], [0, 2, 3], [0, 3, 4]])
+shapes = [TriMesh(rng.randn(5, 3), trilist=trilist) for _ in range(10)]
+textures = rng.rand(10, 15) * 255
+mm = ColouredMorphableModel(PCAModel(shapes), PCAVectorModel(textures),
+                            landmarks=PointCloud(rng.randn(2, 3)))
+
+
+def test_instances_match_instance():
+    alphas = rng.randn(4, 5)
+    betas = rng.randn(4, 3)
+    shapes, colours = mm.instances(alphas, betas)
+    assert shapes.shape == (4, 5, 3) and colours.shape == (4, 5, 3)
+    for alpha, beta, shape, colour in zip(alphas, betas, shapes, colours):
+        instance = mm.instance(alpha=alpha, beta=beta)
+        assert_allclose(shape, instance.points)
+        assert_allclose(colour, instance.colours)
+
+
+def test_instances_max_memory_yields_chunks():
+    alphas = rng.randn(7, 5)
+    betas = rng.randn(7, 3)
+    expected = mm.instances(alphas, betas)
+    # room for three instances of 30 doubles
+    chunks = list(mm.instances(alphas, betas, max_memory=3 * 30 * 8))
+    assert [len(s) for s, _ in chunks] == [3, 3, 1]
+    for e, c in zip(expected, zip(*chunks)):
+        assert_allclose(np.concatenate(c), e)
+
+
+@raises(ValueError)
+def test_instances_rows_must_match():
+    mm.instances(rng.randn(3, 5), rng.randn(2, 3))
+
+
+def test_instance_vertices_match_instance():
+    alpha = rng.randn(5)
+    beta = rng.randn(3)
+    vertex_indices = np.array([4, 1, 1])
+    points, colours = mm.instance_vertices(vertex_indices, alpha=alpha,
+                                           beta=beta)
+    instance = mm.instance(alpha=alpha, beta=beta)
+    assert_allclose(points, instance.points[vertex_indices])
+    assert_allclose(colours, instance.colours[vertex_indices])
@@ -35,39 +35,41 @@ def compute_projection_derivatives_warp_parameters(shape_uv, warped_uv,
 
 def compute_ortho_projection_derivatives_shape_parameters(s_pc_uv, rho, r_tot,
                                                           shape_ev):
-    # Precomputations
-    n_parameters = np.size(s_pc_uv, 2)
-    n_points = np.size(s_pc_uv, 0)
-    dp_dalpha = np.zeros([2, n_parameters, n_points])
+    # Derivative of the rotated shape wrt every parameter at once
+    dw_dalpha_uv = _rotate_components(s_pc_uv, r_tot, shape_ev)
 
     const = rho[0]
 
-    for k in range(n_parameters):
-        dw_dalpha_k_uv = r_tot.apply((shape_ev[k] * s_pc_uv[:, :, k])).T
-        dp_dalpha_k_uv = np.vstack((dw_dalpha_k_uv[0], dw_dalpha_k_uv[1]))
-        dp_dalpha[:, k, :] = const*dp_dalpha_k_uv
+    dp_dalpha = const*dw_dalpha_uv[:, :2]
 
-    return dp_dalpha
+    return dp_dalpha.transpose(1, 2, 0)
 
 
 def compute_pers_projection_derivatives_shape_parameters(w_uv, s_pc_uv, rho,
                                                          r_tot, shape_ev):
-    # Precomputations
-    n_parameters = s_pc_uv.shape[2]
-    n_points = s_pc_uv.shape[0]
-    dp_dalpha = np.zeros([2, n_parameters, n_points])
-    
+    # Derivative of the rotated shape wrt every parameter at once
+    dw_dalpha_uv = _rotate_components(s_pc_uv, r_tot, shape_ev)
+
     w = w_uv[:, 2]
     const = rho[0]/(w**2)
 
-    for k in range(n_parameters):
-        dw_dalpha_k_uv = r_tot.apply(shape_ev[k] * s_pc_uv[:, :, k]).T
-        dp_dalpha_k_uv = np.vstack(
-            (dw_dalpha_k_uv[0]*w - w_uv[:, 0]*dw_dalpha_k_uv[2],
-             dw_dalpha_k_uv[1]*w - w_uv[:, 1]*dw_dalpha_k_uv[2]))
-        dp_dalpha[:, k, :] = const*dp_dalpha_k_uv
+    dp_dalpha = (dw_dalpha_uv[:, :2]*w[:, None, None] -
+                 w_uv[:, :2, None]*dw_dalpha_uv[:, 2:])
+    dp_dalpha *= const[:, None, None]
 
-    return dp_dalpha
+    return dp_dalpha.transpose(1, 2, 0)
+
+
+def _rotate_components(s_pc_uv, r_tot, shape_ev):
+    # Apply the (affine) transform r_tot to the (n_points, 3, n_parameters)
+    # components scaled by shape_ev (unless they already are) as a single
+    # batched matrix product, keeping their layout
+    h_matrix = r_tot.h_matrix
+    if shape_ev is not None:
+        s_pc_uv = s_pc_uv * shape_ev[:s_pc_uv.shape[2]]
+    dw_dalpha_uv = np.matmul(h_matrix[:3, :3], s_pc_uv)
+    dw_dalpha_uv += h_matrix[:3, 3, None]
+    return dw_dalpha_uv
 
 
 def compute_pers_projection_derivatives_warp_parameters(s_uv, w_uv, rho, r_phi,
@@ -213,14 +215,10 @@ def compute_ortho_projection_derivatives_warp_parameters(s_uv, w_uv, rho, r_phi,
 
 
 def compute_texture_derivatives_texture_parameters(t_pc, texture_ev):
-    # Initialization
-    n_parameters = np.size(t_pc, 2)
-    n_points = np.size(t_pc, 0)
-    dt_dbeta = np.zeros([3, n_parameters, n_points])
-
-    # Computations
-    for k in range(n_parameters):
-        # Compute the derivative of the linear texture model wrt beta k
-        dt_dbeta[:, k, :] = texture_ev[k]*t_pc[:, :, k].T
+    # Derivative of the linear texture model wrt every parameter at once
+    if texture_ev is None:
+        dt_dbeta = t_pc.copy()
+    else:
+        dt_dbeta = t_pc*texture_ev[:t_pc.shape[2]]
 
-    return dt_dbeta
+    return dt_dbeta.transpose(1, 2, 0)
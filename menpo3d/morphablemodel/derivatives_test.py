@@ -0,0 +1,114 @@
+import timeit
+import numpy as np
+from numpy.testing import assert_allclose
+from menpo.transform import Homogeneous
+from menpo3d.morphablemodel.derivatives import (
+    compute_ortho_projection_derivatives_shape_parameters,
+    compute_pers_projection_derivatives_shape_parameters,
+    compute_texture_derivatives_texture_parameters)
+
+
+# The original per parameter loops, as references
+def ortho_shape_loop(s_pc_uv, rho, r_tot, shape_ev):
+    n_parameters = np.size(s_pc_uv, 2)
+    n_points = np.size(s_pc_uv, 0)
+    dp_dalpha = np.zeros([2, n_parameters, n_points])
+    const = rho[0]
+    for k in range(n_parameters):
+        dw_dalpha_k_uv = r_tot.apply((shape_ev[k] * s_pc_uv[:, :, k])).T
+        dp_dalpha_k_uv = np.vstack((dw_dalpha_k_uv[0], dw_dalpha_k_uv[1]))
+        dp_dalpha[:, k, :] = const*dp_dalpha_k_uv
+    return dp_dalpha
+
+
+def pers_shape_loop(w_uv, s_pc_uv, rho, r_tot, shape_ev):
+    n_parameters = s_pc_uv.shape[2]
+    n_points = s_pc_uv.shape[0]
+    dp_dalpha = np.zeros([2, n_parameters, n_points])
+    w = w_uv[:, 2]
+    const = rho[0]/(w**2)
+    for k in range(n_parameters):
+        dw_dalpha_k_uv = r_tot.apply(shape_ev[k] * s_pc_uv[:, :, k]).T
+        dp_dalpha_k_uv = np.vstack(
+            (dw_dalpha_k_uv[0]*w - w_uv[:, 0]*dw_dalpha_k_uv[2],
+             dw_dalpha_k_uv[1]*w - w_uv[:, 1]*dw_dalpha_k_uv[2]))
+        dp_dalpha[:, k, :] = const*dp_dalpha_k_uv
+    return dp_dalpha
+
+
+def texture_loop(t_pc, texture_ev):
+    n_parameters = np.size(t_pc, 2)
+    n_points = np.size(t_pc, 0)
+    dt_dbeta = np.zeros([3, n_parameters, n_points])
+    for k in range(n_parameters):
+        dt_dbeta[:, k, :] = texture_ev[k]*t_pc[:, :, k].T
+    return dt_dbeta
+
+
+def problem(n_points=1000, n_parameters=100, seed=0):
+    rng = np.random.RandomState(seed)
+    # a random rotation, and a translation too (the rotation from lmalign has
+    # none)
+    h_matrix = np.eye(4)
+    h_matrix[:3, :3] = np.linalg.qr(rng.randn(3, 3))[0]
+    h_matrix[:3, 3] = rng.randn(3)
+    r_tot = Homogeneous(h_matrix)
+    return dict(s_pc_uv=rng.randn(n_points, 3, n_parameters),
+                w_uv=rng.randn(n_points, 3) + [0, 0, 5],
+                rho=rng.rand(6) + 1, r_tot=r_tot,
+                ev=rng.rand(n_parameters + 5))
+
+
+def test_ortho_shape_derivatives_match_loop():
+    p = problem(n_points=50, n_parameters=7)
+    args = (p['s_pc_uv'], p['rho'], p['r_tot'], p['ev'])
+    assert_allclose(
+        compute_ortho_projection_derivatives_shape_parameters(*args),
+        ortho_shape_loop(*args))
+
+
+def test_pers_shape_derivatives_match_loop():
+    p = problem(n_points=50, n_parameters=7)
+    args = (p['w_uv'], p['s_pc_uv'], p['rho'], p['r_tot'], p['ev'])
+    assert_allclose(
+        compute_pers_projection_derivatives_shape_parameters(*args),
+        pers_shape_loop(*args))
+
+
+def test_texture_derivatives_match_loop():
+    p = problem(n_points=50, n_parameters=7)
+    assert_allclose(
+        compute_texture_derivatives_texture_parameters(p['s_pc_uv'], p['ev']),
+        texture_loop(p['s_pc_uv'], p['ev']))
+
+
+def test_derivatives_of_prescaled_components():
+    p = problem(n_points=50, n_parameters=7)
+    scaled = p['s_pc_uv'] * p['ev'][:7]
+    assert_allclose(
+        compute_pers_projection_derivatives_shape_parameters(
+            p['w_uv'], scaled, p['rho'], p['r_tot'], None),
+        pers_shape_loop(p['w_uv'], p['s_pc_uv'], p['rho'], p['r_tot'],
+                        p['ev']))
+    assert_allclose(compute_texture_derivatives_texture_parameters(scaled,
+                                                                   None),
+                    texture_loop(p['s_pc_uv'], p['ev']))
+
+
+if __name__ == '__main__':
+    # micro-benchmark of the derivatives against the loops, for the default
+    # number of samples and parameters of MMFitter
+    p = problem()
+    cases = [
+        ('ortho shape', compute_ortho_projection_derivatives_shape_parameters,
+         ortho_shape_loop, (p['s_pc_uv'], p['rho'], p['r_tot'], p['ev'])),
+        ('pers shape', compute_pers_projection_derivatives_shape_parameters,
+         pers_shape_loop,
+         (p['w_uv'], p['s_pc_uv'], p['rho'], p['r_tot'], p['ev'])),
+        ('texture', compute_texture_derivatives_texture_parameters,
+         texture_loop, (p['s_pc_uv'], p['ev']))]
+    for name, vectorized, loop, args in cases:
+        times = [min(timeit.repeat(lambda: f(*args), number=10, repeat=5)) / 10
+                 for f in (loop, vectorized)]
+        print('{:<12} loop {:8.3f}ms  vectorized {:8.3f}ms  ({:.1f}x)'.format(
+            name, 1e3 * times[0], 1e3 * times[1], times[0] / times[1]))
@@ -4,9 +4,13 @@ import numpy as np
 
 from menpo.feature import gradient
 from menpo.image import Image
+from menpo.shape import TriMesh
 from menpo.transform import Homogeneous
 from menpo3d.rasterize import GLRasterizer
 
+from .base import _mean_vector
+from .linalg import (sd_matrix, compute_hessian, compute_sd_error,
+                     solve_damped)
 from .lmalign import retrieve_view_projection_transforms
 from .derivatives import (compute_texture_derivatives_texture_parameters,
                           compute_projection_derivatives_warp_parameters,
@@ -15,6 +19,123 @@ from .derivatives import (compute_texture_derivatives_texture_parameters,
 
 LM_GROUP = '__3dmm_fit'
 
+# The number of camera parameters (see rho_from_view_projection_matrices)
+N_RHO = 6
+
+
+class FittingContext(object):
+    r"""
+    The parts of a fit that only depend on the model and the number of
+    shape and texture parameters, computed once and shared by every iteration
+    of every fit.
+
+    Parameters
+    ----------
+    mm : :map:`ColouredMorphableModel`
+        The model to fit (with colours scaled as for ``'bfm'`` models).
+    n_alphas : `int`
+        The number of shape parameters that are fitted.
+    n_betas : `int`
+        The number of texture parameters that are fitted.
+
+    Attributes
+    ----------
+    shape_pc : ``(n_points, 3 * n_alphas)`` `ndarray`
+        The first ``n_alphas`` shape components scaled by their eigenvalues,
+        with the ``(3, n_alphas)`` components of each vertex in its row (so
+        that the components of sampled vertices are contiguous rows).
+    tex_pc : ``(n_points, 3 * n_betas)`` `ndarray`
+        The first ``n_betas`` texture components, as for ``shape_pc``.
+    shape_mean : ``(n_points, 3)`` `ndarray`
+        The mean shape.
+    colour_mean : ``(n_points, 3)`` `ndarray`
+        The mean colours.
+    """
+    def __init__(self, mm, n_alphas, n_betas):
+        self.n_alphas = n_alphas
+        self.n_betas = n_betas
+        shape_ev = mm.shape_model.eigenvalues[:n_alphas]
+        tex_ev = mm.texture_model.eigenvalues[:n_betas]
+        self.shape_pc = _scaled_vertex_components(mm.shape_model, n_alphas)
+        self.tex_pc = _scaled_vertex_components(mm.texture_model, n_betas)
+        self.shape_mean = _mean_vector(mm.shape_model).reshape([-1, 3])
+        self.colour_mean = _mean_vector(mm.texture_model).reshape([-1, 3])
+        self.colour_mean = self.colour_mean * (1. / 255)
+        # the normalized weights of a scaled component are rescaled by the
+        # inverse square root of its eigenvalue
+        self._shape_weights_scale = shape_ev ** -0.5
+        self._tex_weights_scale = tex_ev ** -0.5
+
+        # Prior probabilities constants
+        da_prior_db = np.zeros(n_betas)
+        da_prior_da = 2. / (shape_ev ** 2)
+
+        db_prior_da = np.zeros(n_alphas)
+        db_prior_db = 2. / (tex_ev ** 2)
+
+        self._priors = {}
+        for camera_update in (False, True):
+            if camera_update:
+                prior_drho = np.zeros(N_RHO)
+                SD_alpha_prior = np.concatenate((da_prior_da, prior_drho,
+                                                 da_prior_db))
+                SD_beta_prior = np.concatenate((db_prior_da, prior_drho,
+                                                db_prior_db))
+            else:
+                SD_alpha_prior = np.concatenate((da_prior_da,
+                                                 da_prior_db))
+                SD_beta_prior = np.concatenate((db_prior_da,
+                                                db_prior_db))
+            self._priors[camera_update] = (SD_alpha_prior, SD_beta_prior,
+                                           np.diag(SD_alpha_prior),
+                                           np.diag(SD_beta_prior))
+
+    def priors(self, camera_update=False):
+        r"""
+        The prior probability steepest descent vectors and Hessians.
+
+        Parameters
+        ----------
+        camera_update : `bool`, optional
+            Whether the camera parameters are fitted too (they have no
+            prior).
+
+        Returns
+        -------
+        SD_alpha_prior : ``(n_params,)`` `ndarray`
+            The steepest descent vector of the shape prior.
+        SD_beta_prior : ``(n_params,)`` `ndarray`
+            The steepest descent vector of the texture prior.
+        H_alpha_prior : ``(n_params, n_params)`` `ndarray`
+            The Hessian of the shape prior.
+        H_beta_prior : ``(n_params, n_params)`` `ndarray`
+            The Hessian of the texture prior.
+        """
+        return self._priors[camera_update]
+
+    def shape_instance(self, alpha):
+        r"""
+        The points of the instance with normalized shape weights ``alpha``.
+        """
+        points = self.shape_pc.reshape([-1, self.n_alphas]).dot(
+            alpha * self._shape_weights_scale)
+        return self.shape_mean + points.reshape([-1, 3])
+
+    def instance_vertices(self, vertex_indices, alpha, beta):
+        r"""
+        The points and colours of the instance with normalized shape weights
+        ``alpha`` and texture weights ``beta`` at ``vertex_indices``.
+        """
+        n_vertices = len(vertex_indices)
+        points = self.shape_pc[vertex_indices].reshape(
+            [-1, self.n_alphas]).dot(alpha * self._shape_weights_scale)
+        colours = self.tex_pc[vertex_indices].reshape(
+            [-1, self.n_betas]).dot(beta * self._tex_weights_scale)
+        return (self.shape_mean[vertex_indices] +
+                points.reshape([n_vertices, 3]),
+                self.colour_mean[vertex_indices] +
+                colours.reshape([n_vertices, 3]))
+
 
 class MMFitter(object):
     r"""
@@ -23,6 +144,19 @@ class MMFitter(object):
     """
     def __init__(self, mm):
         self.model = mm
+        self._contexts = {}
+
+    def fitting_context(self, n_alphas, n_betas):
+        r"""
+        The :map:`FittingContext` of the model for ``n_alphas`` shape and
+        ``n_betas`` texture parameters, which is only built the first time
+        that it is asked for.
+        """
+        key = (n_alphas, n_betas)
+        if key not in self._contexts:
+            self._contexts[key] = FittingContext(self.model, n_alphas,
+                                                 n_betas)
+        return self._contexts[key]
 
     def fit_from_shape(self, image, shape, n_alphas=100, n_betas=100,
                        n_tris=1000, camera_update=False, max_iters=100):
@@ -61,31 +195,19 @@ class MMFitter(object):
         rho = rho_from_view_projection_matrices(proj_t.h_matrix,
                                                       R.h_matrix)
 
-        # Prior probabilities constants
+        # Components and prior probabilities constants
+        context = self.fitting_context(n_alphas, n_betas)
         alpha = np.zeros(n_alphas)
         beta = np.zeros(n_betas)
 
-        da_prior_db = np.zeros(n_betas)
-        da_prior_da = 2. / (self.model.shape_model.eigenvalues[:n_alphas] ** 2)
-        
-        db_prior_da = np.zeros(n_alphas)
-        db_prior_db = 2. / (self.model.texture_model.eigenvalues[:n_betas] ** 2)
-        
-        if camera_update:
-            prior_drho = np.zeros(len(rho))
-            SD_alpha_prior = np.concatenate((da_prior_da, prior_drho,
-                                             da_prior_db))
-            SD_beta_prior = np.concatenate((db_prior_da, prior_drho,
-                                            db_prior_db))
-        else:
-            SD_alpha_prior = np.concatenate((da_prior_da,
-                                             da_prior_db))
-            SD_beta_prior = np.concatenate((db_prior_da,
-                                            db_prior_db))
-            
-        H_alpha_prior = np.diag(SD_alpha_prior)
-        H_beta_prior = np.diag(SD_beta_prior)
-        
+        SD_alpha_prior, SD_beta_prior, H_alpha_prior, H_beta_prior = (
+            context.priors(camera_update))
+
+        # Only the shape is rebuilt in full every iteration (for the
+        # rasterization), the rest of the instance is evaluated at the sampled
+        # vertices
+        mesh = TriMesh(instance.points, trilist=instance.trilist)
+
         # Initilialize rasterizer
         rasterizer = GLRasterizer(height=image.height, width=image.width,
                                   view_matrix=view_t.h_matrix,
@@ -106,7 +228,7 @@ class MMFitter(object):
             
             # Inverse rendering
             tri_index_img, b_coords_img = (
-                rasterizer.rasterize_barycentric_coordinate_image(instance))
+                rasterizer.rasterize_barycentric_coordinate_image(mesh))
             tri_indices = tri_index_img.as_vector() 
             b_coords = b_coords_img.as_vector(keep_channels=True) 
             yx = tri_index_img.mask.true_indices()
@@ -118,29 +240,33 @@ class MMFitter(object):
             tri_indices = tri_indices[rand[:n_tris]]
 
             # Build the vertex indices (3 per pixel)
-            # for the visible triangle
-            vertex_indices = instance.trilist[tri_indices]
-            
+            # for the visible triangle, into the sampled vertices
+            sampled, vertex_indices = np.unique(mesh.trilist[tri_indices],
+                                                return_inverse=True)
+            vertex_indices = vertex_indices.reshape([-1, 3])
+
+            # Evaluate the instance at the sampled vertices only
+            # The texture is clipped to avoid out of range pixels
+            points, colours = context.instance_vertices(sampled, alpha, beta)
+            colours = np.clip(colours, 0, 1)
+
             # Warp the shape witht the view matrix
-            W = view_t.apply(instance.points)
+            W = view_t.apply(points)
             
             # This solves the perspective projection problems
             # It cancels the axes flip done in the view matrix before the
             # rasterization
             W[:, 1:] *= -1
             
-            # Shape and texture principal components are reshaped before
-            # sampling
-            shape_pc = self.model.shape_model.components.T
-            tex_pc = self.model.texture_model.components.T
-            shape_pc = shape_pc.reshape([instance.n_points, -1])
-            tex_pc = tex_pc.reshape([instance.n_points, -1])
+            # Shape and texture principal components of the sampled vertices
+            shape_pc = context.shape_pc[sampled]
+            tex_pc = context.tex_pc[sampled]
 
             # Sampling
             # norms_uv = sample_object(instance.vertex_normals(),
             #                          vertex_indices, b_coords)
-            shape_uv = sample_object(instance.points, vertex_indices, b_coords)
-            tex_uv = sample_object(instance.colours, vertex_indices, b_coords)
+            shape_uv = sample_object(points, vertex_indices, b_coords)
+            tex_uv = sample_object(colours, vertex_indices, b_coords)
             warped_uv = sample_object(W, vertex_indices, b_coords)
             shape_pc_uv = sample_object(shape_pc, vertex_indices, b_coords)
             tex_pc_uv = sample_object(tex_pc, vertex_indices, b_coords)
@@ -163,17 +289,15 @@ class MMFitter(object):
             if n_alphas > 0:
 
                 # Projection derivative wrt shape parameters
+                # (the components are already scaled by their eigenvalues)
                 dp_dalpha = compute_projection_derivatives_shape_parameters(
-                    shape_pc_uv, rho, warped_uv, R,
-                    self.model.shape_model.eigenvalues, projection_type)
-                dp_dalpha = dp_dalpha[:, :n_alphas, :]
+                    shape_pc_uv, rho, warped_uv, R, None, projection_type)
                 
             if n_betas >0:
             
                 # Texture derivative wrt texture parameters
                 dt_dbeta = compute_texture_derivatives_texture_parameters(
-                    tex_pc_uv, self.model.texture_model.eigenvalues)
-                dt_dbeta = dt_dbeta[:, :n_betas, :]
+                    tex_pc_uv, None)
                 
             if camera_update:
 
@@ -198,6 +322,7 @@ class MMFitter(object):
                 SD_img = -dt_dbeta              
                 
             # Hessian approximation
+            SD_img = sd_matrix(SD_img)
             H_img = compute_hessian(SD_img)
 
             # Compute error
@@ -226,7 +351,7 @@ class MMFitter(object):
                         SD_error_beta_prior)
 
             # Compute increment
-            delta_sigma = -np.dot(np.linalg.inv(H), SD_error)
+            delta_sigma = -solve_damped(H, SD_error)
 
             # Update parameters
             if camera_update:
@@ -237,13 +362,9 @@ class MMFitter(object):
                 alpha += delta_sigma[:n_alphas]
                 beta += delta_sigma[n_alphas:]
 
-            # Generate the updated instance
-            # The texture is scaled by 255 to cancel the 1./255 scaling in the
-            # model class
-            instance = self.model.instance(alpha=alpha, beta=255. * beta)
-            
-            # Clip to avoid out of range pixels
-            instance.colours = np.clip(instance.colours, 0, 1)
+            # Generate the updated shape
+            mesh = TriMesh(context.shape_instance(alpha),
+                           trilist=mesh.trilist, copy=False)
 
             if camera_update:
                 # Compute new view matrix
@@ -256,6 +377,14 @@ class MMFitter(object):
             
             k += 1
             
+        # Generate the final instance
+        # The texture is scaled by 255 to cancel the 1./255 scaling in the
+        # model class
+        instance = self.model.instance(alpha=alpha, beta=255. * beta)
+
+        # Clip to avoid out of range pixels
+        instance.colours = np.clip(instance.colours, 0, 1)
+
         # Rasterize the final mesh
         rasterized_result = rasterizer.rasterize_mesh(instance)
         
@@ -269,6 +398,14 @@ class MMFitter(object):
         }
 
 
+def _scaled_vertex_components(model, n_components):
+    # The first components of a model scaled by their eigenvalues, with the
+    # (x, y, z) components of each vertex side by side in its row
+    components = model.components[:n_components]
+    scaled = components.T * model.eigenvalues[:n_components]
+    return np.ascontiguousarray(scaled).reshape([-1, 3 * n_components])
+
+
 def sample_object(x, vertex_indices, b_coords):
     per_vert_per_pixel = x[vertex_indices]
     return np.sum(per_vert_per_pixel *
@@ -341,26 +478,3 @@ def compute_sd(dp_dgamma, VI_dx_uv, VI_dy_uv):
     permuted_vi_dx = np.transpose(VI_dx_uv[..., None], (0, 2, 1))
     permuted_vi_dy = np.transpose(VI_dy_uv[..., None], (0, 2, 1))
     return permuted_vi_dx*dp_dgamma[0] + permuted_vi_dy*dp_dgamma[1]
-
-
-def compute_hessian(sd):
-    # Computes the hessian as defined in the Lucas Kanade Algorithm
-    n_channels = sd.shape[0]
-    n_params = sd.shape[1]
-    h = np.zeros((n_params, n_params))
-    sd = sd.T
-    for i in range(n_channels):
-        h += np.dot(sd[:, :, i].T, sd[:, :, i])
-    return h
-
-
-def compute_sd_error(sd, error_uv):
-    n_channels = sd.shape[0]
-    n_parameters = sd.shape[1]
-    sd_error_product = np.zeros(n_parameters)
-    sd = sd.T
- 
-    for i in range(n_channels):
-        sd_error_product += np.dot(error_uv[i, :], sd[:, :, i])
-        
-    return sd_error_product.T
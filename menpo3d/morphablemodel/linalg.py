@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+
+
+def sd_matrix(sd):
+    r"""
+    Flatten a steepest descent tensor into a matrix, with one row per
+    channel and sample.
+
+    Parameters
+    ----------
+    sd : ``(n_channels, n_params, n_samples)`` `ndarray`
+        The steepest descent images, sampled.
+
+    Returns
+    -------
+    sd : ``(n_channels * n_samples, n_params)`` `ndarray`
+        The steepest descent matrix (the Jacobian of the vectorized
+        residual).
+    """
+    n_channels, n_params, n_samples = sd.shape
+    return np.ascontiguousarray(sd.transpose(0, 2, 1)).reshape(
+        [n_channels * n_samples, n_params])
+
+
+def compute_hessian(sd):
+    r"""
+    The Gauss-Newton approximation of the Hessian, as a single matrix
+    product.
+
+    Parameters
+    ----------
+    sd : ``(n_channels * n_samples, n_params)`` `ndarray`
+        The steepest descent matrix (see :func:`sd_matrix`). A
+        ``(n_channels, n_params, n_samples)`` tensor is flattened first.
+
+    Returns
+    -------
+    hessian : ``(n_params, n_params)`` `ndarray`
+        The approximation of the Hessian, ``sd^T sd``.
+    """
+    if sd.ndim == 3:
+        sd = sd_matrix(sd)
+    return sd.T.dot(sd)
+
+
+def compute_sd_error(sd, error_uv):
+    r"""
+    The projection of the error onto the steepest descent directions, as a
+    single matrix-vector product.
+
+    Parameters
+    ----------
+    sd : ``(n_channels * n_samples, n_params)`` `ndarray`
+        The steepest descent matrix (see :func:`sd_matrix`). A
+        ``(n_channels, n_params, n_samples)`` tensor is flattened first.
+    error_uv : ``(n_channels, n_samples)`` `ndarray`
+        The error of each channel at each sample.
+
+    Returns
+    -------
+    sd_error : ``(n_params,)`` `ndarray`
+        The steepest descent error, ``sd^T error``.
+    """
+    if sd.ndim == 3:
+        sd = sd_matrix(sd)
+    return sd.T.dot(error_uv.ravel())
+
+
+def solve_damped(H, b, damping=1e-6, max_attempts=10):
+    r"""
+    Solve the symmetric positive (semi-)definite system ``H x = b`` by a
+    Cholesky factorization.
+
+    If ``H`` is not positive definite (numerically), the factorization is
+    retried on ``H + lambda I``, with ``lambda`` starting at ``damping``
+    times the mean of the diagonal of ``H`` and growing tenfold every
+    attempt, as in Levenberg-Marquardt.
+
+    Parameters
+    ----------
+    H : ``(n_params, n_params)`` `ndarray`
+        The system matrix (e.g. a Gauss-Newton Hessian).
+    b : ``(n_params,)`` or ``(n_params, k)`` `ndarray`
+        The right hand side.
+    damping : `float`, optional
+        The first damping, relative to the mean of the diagonal of ``H``.
+    max_attempts : `int`, optional
+        The maximum number of damped factorizations tried.
+
+    Returns
+    -------
+    x : ``(n_params,)`` or ``(n_params, k)`` `ndarray`
+        The solution.
+
+    Raises
+    ------
+    LinAlgError
+        If even the most damped system can't be factorized.
+    """
+    try:
+        return cho_solve(cho_factor(H, check_finite=False), b,
+                         check_finite=False)
+    except LinAlgError:
+        pass
+    scale = np.abs(np.diag(H)).mean()
+    if not scale > 0:
+        scale = 1.
+    damped = H.copy()
+    diagonal = np.diag_indices_from(damped)
+    for i in range(max_attempts):
+        damped[diagonal] = H[diagonal] + damping * 10 ** i * scale
+        try:
+            return cho_solve(cho_factor(damped, check_finite=False), b,
+                             check_finite=False)
+        except LinAlgError:
+            pass
+    raise LinAlgError('the system is not positive definite, even with a '
+                      'damping of {}'.format(damping * 10 ** i * scale))
@@ -0,0 +1,44 @@
+import numpy as np
+from numpy.testing import assert_allclose
+from nose.tools import raises
+from scipy.linalg import LinAlgError
+from menpo3d.morphablemodel.linalg import (sd_matrix, compute_hessian,
+                                           compute_sd_error, solve_damped)
+
+rng = np.random.RandomState(0)
+# (n_channels, n_params, n_samples)
+sd = rng.randn(3, 8, 40)
+error_uv = rng.randn(3, 40)
+
+
+def test_compute_hessian_matches_per_channel_sum():
+    expected = sum(sd[i].dot(sd[i].T) for i in range(3))
+    assert_allclose(compute_hessian(sd_matrix(sd)), expected)
+    assert_allclose(compute_hessian(sd), expected)
+
+
+def test_compute_sd_error_matches_per_channel_sum():
+    expected = sum(sd[i].dot(error_uv[i]) for i in range(3))
+    assert_allclose(compute_sd_error(sd_matrix(sd), error_uv), expected)
+    assert_allclose(compute_sd_error(sd, error_uv), expected)
+
+
+def test_solve_damped_solves_positive_definite_systems():
+    H = compute_hessian(sd)
+    b = rng.randn(8)
+    assert_allclose(solve_damped(H, b), np.linalg.solve(H, b))
+
+
+def test_solve_damped_damps_singular_systems():
+    # a singular Hessian (the last parameter has no effect)
+    J = rng.randn(20, 4)
+    J[:, 3] = 0
+    H = J.T.dot(J)
+    b = J.T.dot(rng.randn(20))
+    # close to the minimum norm solution
+    assert_allclose(solve_damped(H, b), np.linalg.pinv(H).dot(b), atol=1e-4)
+
+
+@raises(LinAlgError)
+def test_solve_damped_raises_for_indefinite_systems():
+    solve_damped(-np.eye(3), np.ones(3), max_attempts=2)
@@ -0,0 +1,186 @@
+import numpy as np
+
+from .bvh import TriangleBVH, closest_points_on_triangles
+
+
+def _vertex_normals(points, trilist):
+    # Area weighted vertex normals (unnormalized face normals are summed)
+    tri_points = points[trilist]
+    face_normals = np.cross(tri_points[:, 1] - tri_points[:, 0],
+                            tri_points[:, 2] - tri_points[:, 0])
+    normals = np.zeros(points.shape)
+    for i in range(3):
+        for axis in range(3):
+            normals[:, axis] += np.bincount(trilist[:, i],
+                                            weights=face_normals[:, axis],
+                                            minlength=points.shape[0])
+    norms = np.sqrt((normals ** 2).sum(axis=1))
+    norms[norms == 0] = 1
+    return normals / norms[:, None]
+
+
+class SignedDistanceGrid(object):
+    r"""A signed distance field of a mesh sampled on a regular voxel grid,
+    together with the closest triangle to each grid node.
+
+    The grid is built once (with one exact closest point query per node) after
+    which distances are answered in constant time by trilinear interpolation
+    and closest points by projecting onto the closest triangle of the nearest
+    node. Both are approximations: the nearest node can be up to
+    ``sqrt(3) / 2`` grid spacings from the query, the interpolated distance
+    can be off by up to about ``sqrt(3)`` spacings, and where two sheets of
+    the surface are closer together than a few spacings the closest triangle
+    of the node may lie on the wrong one, in which case the closest point is
+    off by an amount that isn't bounded by the spacing at all. This is best
+    suited to coarse work (early high stiffness iterations of non-rigid ICP,
+    scan quality metrics...).
+
+    Distances are positive on the side of the surface the vertex normals
+    point to. For an open mesh (e.g. a face scan) this is only meaningful
+    close to the surface.
+
+    Parameters
+    ----------
+    points : ``(n_points, 3)`` `ndarray`
+        The vertices of the mesh.
+    trilist : ``(n_tris, 3)`` `ndarray`
+        The triangle list of the mesh.
+    resolution : `int`, optional
+        The number of grid cells along the longest side of the grid.
+    padding : `float`, optional
+        How far the grid extends beyond the bounding box of the mesh, as a
+        proportion of the longest side of that box.
+    bvh : :map:`TriangleBVH`, optional
+        A tree already built over the mesh, used for building the grid. If
+        ``None``, one is built.
+    n_workers : `int` or ``None``, optional
+        The number of threads that the construction is spread over, see
+        :meth:`TriangleBVH.closest_points`.
+    """
+    def __init__(self, points, trilist, resolution=32, padding=0.1, bvh=None,
+                 n_workers=1):
+        points = np.require(points, dtype=np.float64, requirements=['C'])
+        trilist = np.require(trilist, requirements=['C'])
+        if bvh is None:
+            bvh = TriangleBVH(points, trilist)
+        self.points = points
+        self.trilist = trilist
+
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        longest = (hi - lo).max()
+        self.spacing = longest * (1 + 2 * padding) / resolution
+        self.origin = lo - longest * padding
+        self.shape = np.ceil((hi + longest * padding - self.origin) /
+                             self.spacing).astype(np.intp) + 1
+
+        nodes = self.node_points().reshape(-1, 3)
+        result = bvh.closest_points(nodes, n_workers=n_workers)
+        # sign from the vertex normals interpolated at the closest point
+        normals = _vertex_normals(points, trilist)[trilist[result.tri_indices]]
+        normal = (normals * result.bcoords[..., None]).sum(axis=1)
+        outside = ((nodes - result.points) * normal).sum(axis=1) >= 0
+        sdf = np.where(outside, result.distances, -result.distances)
+        self.distances = sdf.reshape(self.shape)
+        self.tri_indices = result.tri_indices.reshape(self.shape)
+
+    @property
+    def n_nodes(self):
+        r"""The total number of nodes in the grid.
+
+        :type: `int`
+        """
+        return int(np.prod(self.shape))
+
+    def node_points(self):
+        r"""The position of every node of the grid.
+
+        Returns
+        -------
+        node_points : ``(nx, ny, nz, 3)`` `ndarray`
+            The grid node positions.
+        """
+        axes = [o + np.arange(n) * self.spacing
+                for o, n in zip(self.origin, self.shape)]
+        return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+
+    def _grid_coordinates(self, points):
+        points = np.require(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('query points must be of shape (n_points, 3)')
+        return (points - self.origin) / self.spacing
+
+    def signed_distance(self, points):
+        r"""The (trilinearly interpolated) signed distance from each point to
+        the surface.
+
+        Points outside of the grid are clamped to the grid, and the distance
+        to the grid is added to the magnitude of their distance.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The query points.
+
+        Returns
+        -------
+        distances : ``(n_points,)`` `ndarray`
+            The signed distance of each point.
+        """
+        g = self._grid_coordinates(points)
+        clamped = np.clip(g, 0, self.shape - 1)
+        cell = np.minimum(clamped.astype(np.intp), self.shape - 2)
+        f = clamped - cell
+        i, j, k = cell.T
+        fx, fy, fz = f.T
+        d = self.distances
+        # interpolate along x, then y, then z
+        c00 = d[i, j, k] * (1 - fx) + d[i + 1, j, k] * fx
+        c01 = d[i, j, k + 1] * (1 - fx) + d[i + 1, j, k + 1] * fx
+        c10 = d[i, j + 1, k] * (1 - fx) + d[i + 1, j + 1, k] * fx
+        c11 = d[i, j + 1, k + 1] * (1 - fx) + d[i + 1, j + 1, k + 1] * fx
+        c0 = c00 * (1 - fy) + c10 * fy
+        c1 = c01 * (1 - fy) + c11 * fy
+        sdf = c0 * (1 - fz) + c1 * fz
+        outside = np.sqrt(((g - clamped) ** 2).sum(axis=1)) * self.spacing
+        return sdf + np.where(sdf < 0, -outside, outside)
+
+    def closest_tri_indices(self, points):
+        r"""The closest triangle of the grid node nearest to each point.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The query points.
+
+        Returns
+        -------
+        tri_indices : ``(n_points,)`` `ndarray`
+            The (approximate) closest triangle to each point.
+        """
+        g = self._grid_coordinates(points)
+        node = np.clip(np.rint(g), 0, self.shape - 1).astype(np.intp)
+        return self.tri_indices[node[:, 0], node[:, 1], node[:, 2]]
+
+    def closest_points(self, points):
+        r"""Approximate closest points on the mesh, found by projecting each
+        point onto the triangle returned by :meth:`closest_tri_indices`.
+
+        Parameters
+        ----------
+        points : ``(n_points, 3)`` `ndarray`
+            The query points.
+
+        Returns
+        -------
+        closest_points : ``(n_points, 3)`` `ndarray`
+            Points on the surface of the mesh.
+        tri_indices : ``(n_points,)`` `ndarray`
+            The triangle each closest point lies in.
+        """
+        points = np.require(points, dtype=np.float64)
+        tri_indices = self.closest_tri_indices(points)
+        tri_points = self.points[self.trilist[tri_indices]]
+        closest = closest_points_on_triangles(points, tri_points[:, 0],
+                                              tri_points[:, 1],
+                                              tri_points[:, 2])[0]
+        return closest, tri_indices
@@ -1,5 +1,13 @@
+import gc
+import weakref
 import menpo3d
-from menpo3d.vtkutils import trimesh_to_vtk, trimesh_from_vtk
+from menpo3d.vtkutils import (trimesh_to_vtk, trimesh_from_vtk,
+                              vtk_trilist_to_numpy,
+                              VTKClosestPointLocator, BVHClosestPointLocator)
+from menpo3d.barycentric import (barycentric_coordinates_for_indices,
+                                 barycentric_coordinates_for_indices_batch,
+                                 barycentric_coordinates_batch,
+                                 apply_barycentric_interpolation_operator)
 from numpy.testing import assert_allclose
 import numpy as np
 from nose.tools import raises
@@ -13,6 +21,34 @@ def test_trimesh_to_vtk_and_back_is_same():
     assert np.all(bunny.trilist == bunny_back.trilist)
 
 
+def test_trimesh_to_vtk_and_back_shares_points():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    bunny_back = trimesh_from_vtk(trimesh_to_vtk(bunny))
+    assert np.shares_memory(bunny.points, bunny_back.points)
+
+
+def test_trimesh_to_vtk_survives_original_mesh():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    points, trilist = bunny.points.copy(), bunny.trilist.copy()
+    bunny_vtk = trimesh_to_vtk(bunny)
+    del bunny
+    bunny_back = trimesh_from_vtk(bunny_vtk)
+    assert_allclose(points, bunny_back.points)
+    assert np.all(trilist == bunny_back.trilist)
+
+
+def test_trimesh_to_vtk_does_not_keep_trilist_alive():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    for dtype in (np.int32, np.int64):
+        # (one of which is the VTK id type, so can be shared with VTK)
+        mesh = TriMesh(bunny.points, trilist=bunny.trilist.astype(dtype))
+        trilist = weakref.ref(mesh.trilist)
+        trimesh_to_vtk(mesh)
+        del mesh
+        gc.collect()
+        assert trilist() is None
+
+
 @raises(ValueError)
 def test_trimesh_to_vtk_fails_on_2d_mesh():
     points = np.random.random((5, 2))
@@ -27,3 +63,94 @@ def test_barycentric_rebuild_returns_same_as_snapped_points():
     recon_lms = mesh.project_barycentric_coordinates(*bc)
     direct_recon_lms = mesh.snap_pointcloud_to_surface(lms)[0]
     assert_allclose(recon_lms.points, direct_recon_lms.points)
+
+
+def test_barycentric_coordinates_batch_matches_per_point():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(0)
+    tri_indices = rng.randint(0, mesh.n_tris, 100)
+    points = mesh.points[mesh.trilist[tri_indices]].mean(axis=1)
+    points += rng.randn(100, 3) * 0.001
+    bc = barycentric_coordinates_for_indices_batch(mesh, tri_indices, points)
+    expected = [barycentric_coordinates_for_indices(mesh, t, p)
+                for t, p in zip(tri_indices, points)]
+    assert_allclose(bc[:, :2], expected)
+    assert_allclose(bc.sum(axis=1), 1)
+
+
+def test_barycentric_coordinates_batch_degenerate_triangles():
+    a = np.array([[0., 0, 0], [0, 0, 0], [5, 5, 5]])
+    b = np.array([[1., 0, 0], [2, 0, 0], [5, 5, 5]])
+    c = np.array([[2., 0, 0], [1, 0, 0], [5, 5, 5]])
+    points = np.array([[1.5, 1, 0], [0.5, 0, 0], [9, 9, 9]])
+    assert_allclose(barycentric_coordinates_batch(points, a, b, c),
+                    [[0.25, 0, 0.75], [0.75, 0.25, 0], [1, 0, 0]])
+
+
+def test_barycentric_interpolation_operator_matches_interpolation():
+    mesh = menpo3d.io.import_builtin_asset.bunny_obj()
+    rng = np.random.RandomState(1)
+    tri_indices = rng.randint(0, mesh.n_tris, 50)
+    bcoords = rng.dirichlet([1, 1, 1], 50)
+    op = mesh.barycentric_interpolation_operator(bcoords, tri_indices)
+    fields = rng.randn(5, mesh.n_points, 2)
+    batch = apply_barycentric_interpolation_operator(op, fields, chunk_size=2)
+    for f, b in zip(fields, batch):
+        expected = mesh.barycentric_coordinate_interpolation(f, bcoords,
+                                                             tri_indices)
+        assert_allclose(b, expected)
+        assert_allclose(apply_barycentric_interpolation_operator(op, f),
+                        expected)
+
+
+def test_vtk_and_bvh_closest_point_locators_agree():
+    bunny = menpo3d.io.import_builtin_asset.bunny_obj()
+    points = bunny.points[::10] + 0.01 * np.sin(50 * bunny.points[::10])
+    vtk_result = VTKClosestPointLocator.from_trimesh(bunny).closest_points(
+        points)
+    bvh_result = BVHClosestPointLocator.from_trimesh(bunny).closest_points(
+        points)
+    assert_allclose(vtk_result.distances, bvh_result.distances, atol=1e-12)
+    assert_allclose(vtk_result.points, bvh_result.points, atol=1e-9)
+    # the barycentric coordinates rebuild the closest points
+    tris = bunny.points[bunny.trilist[vtk_result.tri_indices]]
+    assert_allclose(np.einsum('ij,ijk->ik', vtk_result.bcoords, tris),
+                    vtk_result.points, atol=1e-12)
+
+
+def quad_and_triangle_polydata():
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk
+    # a unit square (as a single quad) next to a triangle
+    points = np.array([[0., 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                       [2, 0, 0]])
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points, deep=1))
+    polys = vtk.vtkCellArray()
+    for cell in ([0, 1, 2, 3], [1, 4, 2]):
+        polys.InsertNextCell(len(cell))
+        for i in cell:
+            polys.InsertCellPoint(i)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    polydata.SetPolys(polys)
+    return polydata
+
+
+@raises(ValueError)
+def test_vtk_trilist_to_numpy_rejects_quads():
+    vtk_trilist_to_numpy(quad_and_triangle_polydata())
+
+
+def test_trimesh_from_vtk_triangulates_quads():
+    mesh = trimesh_from_vtk(quad_and_triangle_polydata())
+    assert mesh.n_tris == 3
+    assert_allclose(mesh.mean_tri_area(), 0.5)
+
+
+def test_vtk_closest_point_locator_on_quads():
+    locator = VTKClosestPointLocator(quad_and_triangle_polydata())
+    query = np.array([[0.25, 0.75, 1], [0.75, 0.25, -1], [1.5, 0.25, 2]])
+    points, tri_indices = locator(query)
+    assert_allclose(points, query * [1, 1, 0])
+    assert np.all(tri_indices < 3)